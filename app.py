@@ -1,4 +1,4 @@
-import os, requests, logging
+import os, logging
 
 logging.basicConfig(level=logging.WARNING)
 logging.debug("app.py start")
@@ -14,6 +14,7 @@ from flask import (
     g,
     url_for,
     jsonify,
+    abort,
 )
 
 logging.debug("flask imported")
@@ -26,6 +27,20 @@ from sqlalchemy import or_
 logging.debug("modules imported")
 
 
+from cache import cache_from_config
+from catalog import search_page, autocomplete
+from choices import linked_choices, unlinked_choices, user_choices, user_items
+from content_graph import ContentGraph
+from identity import identity_cache
+from linking import link
+from passwords import password_hasher, PasswordHasherBusy
+from plot_layout import PlotLayout
+from prefetch import Prefetcher, link_request
+from profiles import PlantNotFound, PlantProfiles, local_profile
+from ratelimit import rate_limiter_from_config
+from symbols import symbol_cache
+from trefle import TrefleClient, TrefleError
+
 from forms import (
     UserAddForm,
     LoginForm,
@@ -49,7 +64,6 @@ from models import (
     Plot,
     PlantList,
     Plant,
-    Symbol,
     PlantLists_Plants,
     Plot_Cells_Symbols,
     default_plant_symbol,
@@ -74,20 +88,184 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = False
+# A gevent worker (see gunicorn.conf.py) serves up to WEB_CONNECTIONS requests
+# at once, far more than Postgres has connections for, so requests share each
+# worker's DB_POOL_SIZE connections and wait their turn for up to
+# DB_POOL_TIMEOUT seconds. Keep workers * DB_POOL_SIZE under the database's
+# max_connections.
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 0)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+    }
 app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = True
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", FLASK_SECRET)
 
+# Trefle response cache. "memory" is per worker, "disk" is a SQLite file shared
+# by all workers on the box.
+app.config["TREFLE_CACHE_BACKEND"] = os.environ.get("TREFLE_CACHE_BACKEND", "memory")
+app.config["TREFLE_CACHE_PATH"] = os.environ.get(
+    "TREFLE_CACHE_PATH", "/tmp/plot_planner/trefle_cache.sqlite3"
+)
+app.config["TREFLE_CACHE_MAX_BYTES"] = int(
+    os.environ.get("TREFLE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+# Concurrent requests for the same Trefle data share one fetch. With the disk
+# cache, workers coordinate through lock files in this directory. This needs
+# TREFLE_CACHE_BACKEND=disk: with the default per-worker memory cache, workers
+# can't see each other's results, so requests are only coalesced per worker.
+app.config["TREFLE_LOCK_DIR"] = os.environ.get(
+    "TREFLE_LOCK_DIR", "/tmp/plot_planner/locks"
+)
+
+# Trefle HTTP client. Connections are pooled per worker and every request is
+# bounded by these timeouts (in seconds) and retry count. At most
+# TREFLE_POOL_SIZE requests per worker are in flight; others wait up to
+# TREFLE_QUEUE_TIMEOUT seconds for a turn.
+app.config["TREFLE_POOL_SIZE"] = int(os.environ.get("TREFLE_POOL_SIZE", 10))
+app.config["TREFLE_CONNECT_TIMEOUT"] = float(
+    os.environ.get("TREFLE_CONNECT_TIMEOUT", 3.05)
+)
+app.config["TREFLE_READ_TIMEOUT"] = float(os.environ.get("TREFLE_READ_TIMEOUT", 10))
+app.config["TREFLE_MAX_RETRIES"] = int(os.environ.get("TREFLE_MAX_RETRIES", 2))
+app.config["TREFLE_QUEUE_TIMEOUT"] = float(os.environ.get("TREFLE_QUEUE_TIMEOUT", 5))
+
+# Circuit breaker for each kind of Trefle endpoint: once TREFLE_BREAKER_MIN_CALLS
+# requests in the last TREFLE_BREAKER_WINDOW seconds failed at
+# TREFLE_BREAKER_FAILURE_RATE or more, requests fail fast (and searches fall back
+# to the local plants table) for TREFLE_BREAKER_OPEN_FOR seconds.
+app.config["TREFLE_BREAKER_WINDOW"] = float(os.environ.get("TREFLE_BREAKER_WINDOW", 60))
+app.config["TREFLE_BREAKER_MIN_CALLS"] = int(
+    os.environ.get("TREFLE_BREAKER_MIN_CALLS", 10)
+)
+app.config["TREFLE_BREAKER_FAILURE_RATE"] = float(
+    os.environ.get("TREFLE_BREAKER_FAILURE_RATE", 0.5)
+)
+app.config["TREFLE_BREAKER_OPEN_FOR"] = float(
+    os.environ.get("TREFLE_BREAKER_OPEN_FOR", 30)
+)
+
+# After a page of plants is served from Trefle, the next TREFLE_PREFETCH_PAGES
+# pages (and the previous one, with TREFLE_PREFETCH_PREV) are fetched into the
+# cache in the background, by TREFLE_PREFETCH_WORKERS threads per worker with at
+# most TREFLE_PREFETCH_BUDGET prefetches pending. 0 pages turns it off.
+app.config["TREFLE_PREFETCH_PAGES"] = int(os.environ.get("TREFLE_PREFETCH_PAGES", 1))
+app.config["TREFLE_PREFETCH_PREV"] = (
+    os.environ.get("TREFLE_PREFETCH_PREV", "false").lower() == "true"
+)
+app.config["TREFLE_PREFETCH_WORKERS"] = int(
+    os.environ.get("TREFLE_PREFETCH_WORKERS", 2)
+)
+app.config["TREFLE_PREFETCH_BUDGET"] = int(os.environ.get("TREFLE_PREFETCH_BUDGET", 4))
+
+# Plant profiles are served from cache, and refreshed in the background once
+# older than PLANT_PROFILE_SOFT_TTL seconds (dropped after the hard TTL). Unknown
+# slugs and failed fetches are remembered for the missing and error TTLs.
+app.config["PLANT_PROFILE_SOFT_TTL"] = float(
+    os.environ.get("PLANT_PROFILE_SOFT_TTL", 60 * 60)
+)
+app.config["PLANT_PROFILE_HARD_TTL"] = float(
+    os.environ.get("PLANT_PROFILE_HARD_TTL", 7 * 24 * 60 * 60)
+)
+app.config["PLANT_PROFILE_MISSING_TTL"] = float(
+    os.environ.get("PLANT_PROFILE_MISSING_TTL", 10 * 60)
+)
+app.config["PLANT_PROFILE_ERROR_TTL"] = float(
+    os.environ.get("PLANT_PROFILE_ERROR_TTL", 30)
+)
+
+# Where plant searches are answered from: "trefle", or "local" once the catalog
+# has been imported with catalog.py
+app.config["PLANT_SEARCH_SOURCE"] = os.environ.get("PLANT_SEARCH_SOURCE", "trefle")
+
+# Seconds a worker keeps a logged in user's details before reloading them
+app.config["IDENTITY_CACHE_TTL"] = float(os.environ.get("IDENTITY_CACHE_TTL", 10))
+
+# Password hashing. BCRYPT_LOG_ROUNDS is the bcrypt work factor; hashes are
+# run on a pool of PASSWORD_WORKERS threads, with up to PASSWORD_QUEUE_SIZE
+# more waiting at most PASSWORD_QUEUE_TIMEOUT seconds for their turn. Across all
+# the workers on the box, at most PASSWORD_HOST_SLOTS (default: one per CPU)
+# run at once, coordinated through lock files in PASSWORD_LOCK_DIR.
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+app.config["PASSWORD_WORKERS"] = int(os.environ.get("PASSWORD_WORKERS", 2))
+app.config["PASSWORD_QUEUE_SIZE"] = int(os.environ.get("PASSWORD_QUEUE_SIZE", 8))
+app.config["PASSWORD_QUEUE_TIMEOUT"] = float(
+    os.environ.get("PASSWORD_QUEUE_TIMEOUT", 1)
+)
+app.config["PASSWORD_HOST_SLOTS"] = int(
+    os.environ.get("PASSWORD_HOST_SLOTS", os.cpu_count() or 1)
+)
+app.config["PASSWORD_LOCK_DIR"] = os.environ.get(
+    "PASSWORD_LOCK_DIR", "/tmp/plot_planner/locks"
+)
+
+# Rate limits per route, as "<requests>/<period>", e.g. "10/minute" or
+# "100/5 minutes". Buckets are per worker with "memory", or shared by all
+# workers on the box with "sqlite".
+app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+app.config["RATE_LIMIT_PATH"] = os.environ.get(
+    "RATE_LIMIT_PATH", "/tmp/plot_planner/ratelimit.sqlite3"
+)
+app.config["RATE_LIMITS"] = {
+    "login": os.environ.get("RATE_LIMIT_LOGIN", "10/minute"),
+    "plant_search": os.environ.get("RATE_LIMIT_PLANT_SEARCH", "30/minute"),
+}
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 logging.debug("Database Modals connected")
 
 
-# Trefle API base url
-API_BASE_URL = "https://trefle.io/api/v1"
 #TREFLE_API_KEY = os.environ.get("TREFLE_API_KEY")
 CURR_USER_KEY = "curr_user"
 
+trefle = TrefleClient.from_config(
+    app.config, token=TREFLE_API_KEY, cache=cache_from_config(app.config)
+)
+prefetcher = Prefetcher.from_config(app.config, trefle)
+plant_profiles = PlantProfiles.from_config(app.config, trefle, trefle.cache.backend)
+identity_cache.ttl = app.config["IDENTITY_CACHE_TTL"]
+limiter = rate_limiter_from_config(app.config)
+password_hasher.configure(
+    rounds=app.config["BCRYPT_LOG_ROUNDS"],
+    workers=app.config["PASSWORD_WORKERS"],
+    queue_size=app.config["PASSWORD_QUEUE_SIZE"],
+    timeout=app.config["PASSWORD_QUEUE_TIMEOUT"],
+    lock_dir=app.config["PASSWORD_LOCK_DIR"],
+    host_slots=app.config["PASSWORD_HOST_SLOTS"],
+)
+
+
+def search_plant_catalog(endpoint, params=None):
+    """Returns a page of plants for a Trefle /plants or /plants/search request.
+
+    Answered from the local catalog when it is the configured search source and
+    can handle the request, otherwise from Trefle, in which case the pages
+    around it are prefetched. Falls back to the local catalog when Trefle is
+    unavailable, and raises TrefleError if it can't."""
+
+    if app.config["PLANT_SEARCH_SOURCE"] == "local":
+        plants = search_page(endpoint, params)
+        if plants is not None:
+            return plants
+
+    try:
+        plants = trefle.get(endpoint, params)
+    except TrefleError as e:
+        if not e.unavailable:
+            raise
+        plants = search_page(endpoint, params)
+        if plants is None:
+            raise
+        logging.warning(f"Answering {endpoint} from the local catalog: {e}")
+        return plants
+
+    prefetcher.prefetch(plants.get("links", {}))
+    return plants
+
 
 ########################################################################
 # User signup/login/logout
@@ -98,13 +276,23 @@ CURR_USER_KEY = "curr_user"
 def add_user_to_g():
     """If user is logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY in session and request.endpoint != "static":
+        g.user = identity_cache.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Sends the user back to the form they submitted when too many passwords
+    are being checked at once."""
+
+    db.session.rollback()
+    flash("Lots of people are signing in right now, please try again.", "danger")
+    return redirect(request.path)
+
+
 def do_login(user):
     """Log in user to session."""
 
@@ -167,6 +355,7 @@ def signup():
 
 
 @app.route("/login", methods=["GET", "POST"])
+@limiter.limit("login", methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -278,24 +467,28 @@ def user_content(user_id):
         flash("Not authorized to view this page.", "danger")
         return redirect(url_for("homepage"))
 
+    # All of the user's content and its connections, in a fixed number of queries
+    content = ContentGraph.load(user.id)
+
     form_plot = AddPlotForm()
 
     # Load in choices based on users currently connected components
-    form_plot.plots.choices = [(plot.id, plot.name,) for plot in g.user.plots]
+    form_plot.plots.choices = [(plot.id, plot.name,) for plot in content.plots]
 
     form_plantlist = AddPlantListForm()
     form_plantlist.plantlists.choices = [
-        (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
+        (plantlist.id, plantlist.name,) for plantlist in content.plantlists
     ]
 
     form_project = AddProjectForm()
     form_project.projects.choices = [
-        (project.id, project.name,) for project in g.user.projects
+        (project.id, project.name,) for project in content.projects
     ]
 
     return render_template(
         "users/content.html",
         user=user,
+        content=content,
         form_plot=form_plot,
         form_plantlist=form_plantlist,
         form_project=form_project,
@@ -310,6 +503,7 @@ def delete_user():
 
     db.session.delete(g.user)
     db.session.commit()
+    identity_cache.invalidate(g.user.id)
 
     return redirect(url_for("signup"))
 
@@ -325,10 +519,8 @@ def add_projects():
     """Explains what projects are and shows form to add new projects. POST adds new project"""
 
     form = ProjectAddForm()
-    form.plots.choices = [(plot.id, plot.name,) for plot in g.user.plots]
-    form.plantlists.choices = [
-        (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
-    ]
+    form.plots.choices = user_choices("plots")
+    form.plantlists.choices = user_choices("plantlists")
     if form.validate_on_submit():
         try:
             project = Project.add(
@@ -337,16 +529,11 @@ def add_projects():
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.projects.append(project)
+            link("users", g.user.id, "projects", [project.id])
 
-            # Append selected plots to the project
-            for plot in form.plots.data:
-                plot = Plot.query.get(plot)
-                project.plots.append(plot)
-            # Append selected plant list to the project
-            for plantlist in form.plantlists.data:
-                plantlist = PlantList.query.get(plantlist)
-                project.plantlists.append(plantlist)
+            # Link selected plots and plant lists to the project
+            link("projects", project.id, "plots", form.plots.data)
+            link("projects", project.id, "plantlists", form.plantlists.data)
 
             db.session.commit()
 
@@ -372,15 +559,13 @@ def show_project(project_id):
         return redirect(url_for("homepage"))
 
     form_plot = AddPlotForm()
-    form_plot.plots.choices = [
-        (plot.id, plot.name,) for plot in g.user.plots if plot not in project.plots
-    ]
+    form_plot.plots.choices = unlinked_choices(
+        "plots", "projects", project.id, g.user.id
+    )
     form_plantlist = AddPlantListForm()
-    form_plantlist.plantlists.choices = [
-        (plantlist.id, plantlist.name,)
-        for plantlist in g.user.plantlists
-        if plantlist not in project.plantlists
-    ]
+    form_plantlist.plantlists.choices = unlinked_choices(
+        "plantlists", "projects", project.id, g.user.id
+    )
 
     return render_template(
         "projects/show.html",
@@ -402,10 +587,8 @@ def edit_project(project_id):
         return redirect(url_for("homepage"))
 
     form = ProjectAddForm(obj=project)
-    form.plantlists.choices = [
-        (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
-    ]
-    form.plots.choices = [(plot.id, plot.name,) for plot in g.user.plots]
+    form.plantlists.choices = user_choices("plantlists")
+    form.plots.choices = user_choices("plots")
 
     if form.validate_on_submit():
 
@@ -416,16 +599,11 @@ def edit_project(project_id):
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.projects.append(project)
+            link("users", g.user.id, "projects", [project.id])
 
-            # Append selected plots to the project
-            for plot in form.plots.data:
-                plot = Plot.query.get(plot)
-                project.plots.append(plot)
-            # Append plot to selected projects
-            for plantlist in form.plantlists.data:
-                plantlist = PlantList.query.get(plantlist)
-                project.plantlists.append(plantlist)
+            # Link selected plots and plant lists to the project
+            link("projects", project.id, "plots", form.plots.data)
+            link("projects", project.id, "plantlists", form.plantlists.data)
 
             db.session.commit()
 
@@ -474,7 +652,7 @@ def project_add_plot(project_id, plot_id):
     project = Project.query.get_or_404(project_id)
     plot = Plot.query.get_or_404(plot_id)
 
-    project.plots.append(plot)
+    link("projects", project.id, "plots", [plot.id])
     db.session.commit()
 
     return (f"Plot {plot_id} connected to Project {project_id} successfully.", 200)
@@ -507,7 +685,7 @@ def project_add_plantlist(project_id, plantlist_id):
     project = Project.query.get_or_404(project_id)
     plantlist = PlantList.query.get_or_404(plantlist_id)
 
-    project.plantlists.append(plantlist)
+    link("projects", project.id, "plantlists", [plantlist.id])
     db.session.commit()
 
     return (
@@ -526,11 +704,9 @@ def project_add_plantlist(project_id, plantlist_id):
 def add_plots():
     """Explains what plots are and shows form to add new plots. POST adds new plot to user"""
     form = PlotAddForm()
-    form.projects.choices = [(project.id, project.name,) for project in g.user.projects]
+    form.projects.choices = user_choices("projects")
 
-    form.plantlists.choices = [
-        (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
-    ]
+    form.plantlists.choices = user_choices("plantlists")
 
     if form.validate_on_submit():
 
@@ -543,16 +719,11 @@ def add_plots():
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.plots.append(plot)
+            link("users", g.user.id, "plots", [plot.id])
 
-            # Append plot to selected projects
-            for project in form.projects.data:
-                project = Project.query.get(project)
-                plot.projects.append(project)
-            # Append selected plant list to the project
-            for plantlist in form.plantlists.data:
-                plantlist = PlantList.query.get(plantlist)
-                plot.plantlists.append(plantlist)
+            # Link selected projects and plant lists to the plot
+            link("plots", plot.id, "projects", form.projects.data)
+            link("plots", plot.id, "plantlists", form.plantlists.data)
 
             db.session.commit()
 
@@ -578,23 +749,32 @@ def show_plot(plot_id):
         return redirect(url_for("homepage"))
 
     form_plantlist = AddPlantListForm()
-    form_plantlist.plantlists.choices = [
-        (plantlist.id, plantlist.name,)
-        for plantlist in g.user.plantlists
-        if plantlist not in plot.plantlists
-    ]
+    form_plantlist.plantlists.choices = unlinked_choices(
+        "plantlists", "plots", plot.id, g.user.id
+    )
     form_project = AddProjectForm()
-    form_project.projects.choices = [
-        (project.id, project.name,)
-        for project in g.user.projects
-        if project not in plot.projects
-    ]
+    form_project.projects.choices = unlinked_choices(
+        "projects", "plots", plot.id, g.user.id
+    )
+
+    # Cells are rendered with their symbols, so the page needs no further
+    # requests to draw the plot
+    layout = PlotLayout.load(plot)
+    symbols = layout.symbols(default_plant_symbol)
 
     return render_template(
         "plots/show.html",
         form_plantlist=form_plantlist,
         form_project=form_project,
         plot=plot,
+        viewer_rows=layout.render_rows(
+            "plot-viewer col plot-col fa-2x justify-content-center d-flex align-items-center",
+            symbols,
+        ),
+        design_rows=layout.render_rows(
+            "col plot-col fa-lg justify-content-center d-flex align-items-center",
+            symbols,
+        ),
     )
 
 
@@ -608,10 +788,8 @@ def edit_plot(plot_id):
         return redirect(url_for("homepage"))
 
     form = PlotAddForm(obj=plot)
-    form.projects.choices = [(project.id, project.name,) for project in g.user.projects]
-    form.plantlists.choices = [
-        (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
-    ]
+    form.projects.choices = user_choices("projects")
+    form.plantlists.choices = user_choices("plantlists")
 
     if form.validate_on_submit():
 
@@ -624,16 +802,11 @@ def edit_plot(plot_id):
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.plots.append(plot)
+            link("users", g.user.id, "plots", [plot.id])
 
-            # Append selected plantlists to the plot
-            for plantlist in form.plantlists.data:
-                plantlist = PlantList.query.get(plantlist)
-                plot.plantlists.append(plantlist)
-            # Append selected projects to the plot
-            for project in form.projects.data:
-                project = Project.query.get(project)
-                plot.projects.append(project)
+            # Link selected plant lists and projects to the plot
+            link("plots", plot.id, "plantlists", form.plantlists.data)
+            link("plots", plot.id, "projects", form.projects.data)
 
             db.session.commit()
 
@@ -684,7 +857,7 @@ def plot_add_plantlist(plot_id, plantlist_id):
     plot = Plot.query.get_or_404(plot_id)
     plantlist = PlantList.query.get_or_404(plantlist_id)
 
-    plot.plantlists.append(plantlist)
+    link("plots", plot.id, "plantlists", [plantlist.id])
     db.session.commit()
 
     return (
@@ -736,6 +909,39 @@ def plot_cell_delete_row(plot_id, cell_x, cell_y):
     )
 
 
+@app.route("/plots/<int:plot_id>/cells", methods=["POST"])
+@check_authorized
+def plot_cells_update(plot_id):
+    """Sets or clears a batch of plot cells in one transaction. Takes JSON like
+    {"cells": [{"x": 0, "y": 2, "plantlists_plants_id": 5}, ...]}, where a null
+    plantlists_plants_id clears the cell. Later entries for a cell win."""
+
+    plot = Plot.query.get_or_404(plot_id)
+    data = request.get_json(silent=True) or {}
+
+    cells = {}
+    try:
+        for cell in data["cells"]:
+            cell_x, cell_y = int(cell["x"]), int(cell["y"])
+            plantlists_plants_id = cell.get("plantlists_plants_id")
+            if plantlists_plants_id is not None:
+                plantlists_plants_id = int(plantlists_plants_id)
+            if not (0 <= cell_x < plot.width and 0 <= cell_y < plot.length):
+                raise ValueError(f"Cell {cell_x},{cell_y} is outside the plot")
+            cells[(cell_x, cell_y)] = plantlists_plants_id
+    except (KeyError, TypeError, ValueError) as e:
+        return (jsonify(error=f"Invalid plot cells: {e}"), 400)
+
+    try:
+        added, removed = Plot_Cells_Symbols.apply(plot_id, cells)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return (jsonify(error="Invalid plant list plant for plot cells"), 400)
+
+    return jsonify(added=added, removed=removed)
+
+
 ########################################################################
 # Plant List Routes
 ########################################################################
@@ -746,8 +952,8 @@ def plot_cell_delete_row(plot_id, cell_x, cell_y):
 def add_plantlists():
     """Shows existing plant lists, and form to add new plant lists. Post adds new Plant List"""
     form = PlantListAddForm()
-    form.projects.choices = [(project.id, project.name,) for project in g.user.projects]
-    form.plots.choices = [(plot.id, plot.name,) for plot in g.user.plots]
+    form.projects.choices = user_choices("projects")
+    form.plots.choices = user_choices("plots")
 
     if form.validate_on_submit():
 
@@ -758,16 +964,11 @@ def add_plantlists():
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.plantlists.append(plantlist)
+            link("users", g.user.id, "plantlists", [plantlist.id])
 
-            # Append selected plots to the project
-            for plot in form.plots.data:
-                plot = Plot.query.get(plot)
-                plantlist.plots.append(plot)
-            # Append plot to selected projects
-            for project in form.projects.data:
-                project = Project.query.get(project)
-                plantlist.projects.append(project)
+            # Link selected plots and projects to the plant list
+            link("plantlists", plantlist.id, "plots", form.plots.data)
+            link("plantlists", plantlist.id, "projects", form.projects.data)
 
             db.session.commit()
 
@@ -802,15 +1003,13 @@ def show_plantlist(plantlist_id):
     plant_symbol_map = {item.plant_id: item.symbol for item in plantlists_plants}
 
     form_plot = AddPlotForm()
-    form_plot.plots.choices = [
-        (plot.id, plot.name,) for plot in g.user.plots if plot not in plantlist.plots
-    ]
+    form_plot.plots.choices = unlinked_choices(
+        "plots", "plantlists", plantlist.id, g.user.id
+    )
     form_project = AddProjectForm()
-    form_project.projects.choices = [
-        (project.id, project.name,)
-        for project in g.user.projects
-        if project not in plantlist.projects
-    ]
+    form_project.projects.choices = unlinked_choices(
+        "projects", "plantlists", plantlist.id, g.user.id
+    )
 
     return render_template(
         "plantlists/show.html",
@@ -832,8 +1031,8 @@ def edit_plantlist(plantlist_id):
         return redirect(url_for("homepage"))
 
     form = PlantListAddForm(obj=plantlist)
-    form.projects.choices = [(project.id, project.name,) for project in g.user.projects]
-    form.plots.choices = [(plot.id, plot.name,) for plot in g.user.plots]
+    form.projects.choices = user_choices("projects")
+    form.plots.choices = user_choices("plots")
 
     if form.validate_on_submit():
 
@@ -844,16 +1043,11 @@ def edit_plantlist(plantlist_id):
                 # is_public=form.is_public.data,
             )
             db.session.commit()
-            g.user.plantlists.append(plantlist)
+            link("users", g.user.id, "plantlists", [plantlist.id])
 
-            # Append selected plots to the project
-            for plot in form.plots.data:
-                plot = Plot.query.get(plot)
-                plantlist.plots.append(plot)
-            # Append plot to selected projects
-            for project in form.projects.data:
-                project = Project.query.get(project)
-                plantlist.projects.append(project)
+            # Link selected plots and projects to the plant list
+            link("plantlists", plantlist.id, "plots", form.plots.data)
+            link("plantlists", plantlist.id, "projects", form.projects.data)
 
             db.session.commit()
 
@@ -889,7 +1083,7 @@ def plantlist_add_plant(plantlist_id, plant_id):
     plant = Plant.query.get_or_404(plant_id)
     plantlist = PlantList.query.get_or_404(plantlist_id)
 
-    plantlist.plants.append(plant)
+    link("plantlists", plantlist.id, "plants", [plant.id])
     db.session.commit()
 
     return (
@@ -937,25 +1131,17 @@ def add_symbol(plantlist_id, plant_id):
         PlantLists_Plants.plant_id == plant_id,
     ).first()
 
-    # Check to see if they symbol has been created before, and use it as opposed to creating a duplicate
-    symbol = Symbol.query.filter(Symbol.symbol == request.json["symbol"]).first()
-    # If the symbol hasn't been created by anyone yet, create a new one
-    if not symbol:
-        try:
-            symbol = Symbol.add(symbol=request.json["symbol"])
-            db.session.commit()
-
-        except IntegrityError as e:
-            flash("Failed to create symbol.", "danger")
-            return redirect(url_for("show_plantlist", plantlist_id=plantlist_id))
+    # Use the symbol if it's been created before, or else create it
+    symbol = request.json["symbol"]
+    symbol_id = symbol_cache.intern(symbol)
 
     # Update which symbol is connected to plant on plantlist
     plantlists_plants.edit(
-        plantlist_id=plantlist_id, plant_id=plant_id, symbol_id=symbol.id
+        plantlist_id=plantlist_id, plant_id=plant_id, symbol_id=symbol_id
     )
 
     # return symbol for display on frontend
-    return jsonify(symbol.symbol)
+    return jsonify(symbol)
 
 
 ########################################################################
@@ -968,19 +1154,19 @@ def plants_search_table():
     """Shows Plant search form and default plant table"""
     form = PlantSearchForm()
 
+    plantlist = []
+    links = {}
+
     # Default plant list. api/plants/search route replaces this list when search is submitted.
-    payload = {
-        "token": TREFLE_API_KEY,
-    }
     try:
-        plants = requests.get(f"{API_BASE_URL}/plants", params=payload)
+        plants = search_plant_catalog("plants")
         # Build list of plants to be generated into a plant table on frontend
-        print("###################", plants)
-        plantlist = [plant for plant in plants.json()["data"]]
+        plantlist = [plant for plant in plants["data"]]
         # Trefle returns links to the next set of plants in a search. We use this for pagination
-        links = plants.json()["links"]
-    except KeyError:
+        links = plants["links"]
+    except (KeyError, TrefleError):
         logging.warning("Error getting plant data from Trefle API")
+        flash("Plants are unavailable right now, try again shortly.", "danger")
 
     return render_template(
         "plants/search_table.html", form=form, plantlist=plantlist, links=links
@@ -991,13 +1177,22 @@ def plants_search_table():
 def plant_profile(plant_slug):
     """Shows specific plant profile page"""
 
-    payload = {
-        "token": TREFLE_API_KEY,
-    }
+    try:
+        trefle_plant = plant_profiles.get(plant_slug)
+    except PlantNotFound:
+        abort(404)
+    except TrefleError:
+        logging.warning(f"Error getting plant {plant_slug} from Trefle API")
+        # Show what we have on the plant, if anything
+        plant = Plant.query.filter(Plant.slug == plant_slug).first()
+        if plant is None:
+            flash(
+                "Plant details are unavailable right now, try again shortly.", "danger"
+            )
+            return redirect(url_for("plants_search_table"))
+        flash("Full plant details are unavailable right now.", "warning")
+        trefle_plant = local_profile(plant)
 
-    trefle_plant = requests.get(
-        f"{API_BASE_URL}/plants/{plant_slug}", params=payload
-    ).json()["data"]
     # Some responses have data nested in "main_species"
     if "main_species" in trefle_plant:
         main_species = trefle_plant["main_species"]
@@ -1033,24 +1228,18 @@ def plant_profile(plant_slug):
                         "plants/profile.html", main_species=main_species, form=form
                     )
 
-            # Append selected plantlists to the plant
-            for plantlist in form.plantlists.data:
-                plantlist = PlantList.query.get(plantlist)
-                plant.plantlists.append(plantlist)
+            # Link selected plantlists to the plant
+            link("plants", plant.id, "plantlists", form.plantlists.data)
 
             db.session.commit()
 
         if plant:
-            form.plantlists.choices = [
-                (plantlist.id, plantlist.name,)
-                for plantlist in g.user.plantlists
-                if plantlist not in plant.plantlists
-            ]
+            form.plantlists.choices = unlinked_choices(
+                "plantlists", "plants", plant.id, g.user.id
+            )
 
         else:
-            form.plantlists.choices = [
-                (plantlist.id, plantlist.name,) for plantlist in g.user.plantlists
-            ]
+            form.plantlists.choices = user_items("plantlists", g.user.id).all()
 
     return render_template("plants/profile.html", main_species=main_species, form=form)
 
@@ -1069,19 +1258,14 @@ def query_connections(primary_type, primary_id, secondary_type):
     # Gets options to be placed in HTML select form. Only returns
     # options that are not currently connected to primary type
     def get_options(primary):
-        return [
-            (getattr(item, "id"), getattr(item, "name"))
-            for item in getattr(g.user, secondary_type)
-            if item not in getattr(primary, secondary_type)
-        ]
+        return unlinked_choices(
+            secondary_type, primary.__tablename__, primary.id, g.user.id
+        )
 
     # Gets list items to be placed in HTML connected list. Only returns
     # items that are  currently connected to primary type
     def get_list(primary):
-        return [
-            (getattr(item, "id"), getattr(item, "name"))
-            for item in getattr(primary, secondary_type)
-        ]
+        return linked_choices(secondary_type, primary.__tablename__, primary.id)
 
     if primary_type == "project":
         project = Project.query.get_or_404(primary_id)
@@ -1107,20 +1291,30 @@ def query_plantlist(plantlist_id):
     """Returns plants from a plant list and a plant - symbol map. Currently used 
     for generating plant - symbol lists for plot design."""
     plantlist = PlantList.query.get_or_404(plantlist_id)
-    plantlist_plants = PlantLists_Plants.query.filter(
-        PlantLists_Plants.plantlist_id == plantlist_id
-    ).all()
+    plantlist_plants = (
+        db.session.query(
+            PlantLists_Plants.id,
+            PlantLists_Plants.symbol_id,
+            Plant.id,
+            Plant.common_name,
+        )
+        .join(Plant, Plant.id == PlantLists_Plants.plant_id)
+        .filter(PlantLists_Plants.plantlist_id == plantlist_id)
+        .order_by(PlantLists_Plants.id)
+        .all()
+    )
+    symbols = symbol_cache.symbols(row.symbol_id for row in plantlist_plants)
 
     plantlist_plants_symbols = []
     response = {
         "plantlist_plants_symbols": plantlist_plants_symbols,
     }
-    for item in plantlist_plants:
+    for plantlist_plants_id, symbol_id, plant_id, common_name in plantlist_plants:
         plant_data = {}
-        plant_data["plantlist_plants_id"] = item.id
-        plant_data["plant_id"] = item.plant.id
-        plant_data["plant_name"] = item.plant.common_name.capitalize()
-        plant_data["symbol"] = item.symbol.symbol
+        plant_data["plantlist_plants_id"] = plantlist_plants_id
+        plant_data["plant_id"] = plant_id
+        plant_data["plant_name"] = common_name.capitalize()
+        plant_data["symbol"] = symbols.get(symbol_id, default_plant_symbol)
         plantlist_plants_symbols.append(plant_data)
 
     return response
@@ -1130,52 +1324,79 @@ def query_plantlist(plantlist_id):
 @check_authorized
 def query_plot_cells(plot_id):
     """Returns a specific plot's plot cell - symbol map. Currently used for 
-    populating the correct symbol for each cell of a plot."""
-    plot_cells_symbols = Plot_Cells_Symbols.query.filter(
-        Plot_Cells_Symbols.plot_id == plot_id
-    ).all()
+    populating the correct symbol for each cell of a plot. Cells, their plant
+    list entries' symbol ids are fetched together in a single query, and the
+    symbols themselves come from the symbol cache."""
+    plot_cells_symbols = (
+        db.session.query(
+            Plot_Cells_Symbols.cell_x,
+            Plot_Cells_Symbols.cell_y,
+            PlantLists_Plants.symbol_id,
+        )
+        .join(
+            PlantLists_Plants,
+            PlantLists_Plants.id == Plot_Cells_Symbols.plantlists_plants_id,
+        )
+        .filter(Plot_Cells_Symbols.plot_id == plot_id)
+        .all()
+    )
+    symbols = symbol_cache.symbols(row.symbol_id for row in plot_cells_symbols)
 
     cells_symbols = []
 
-    for item in plot_cells_symbols:
-        plantlists_plants = PlantLists_Plants.query.get_or_404(
-            item.plantlists_plants_id
-        )
-        symbol = plantlists_plants.symbol.symbol
+    for cell_x, cell_y, symbol_id in plot_cells_symbols:
         cell = {}
-        cell["cell_x"] = item.cell_x
-        cell["cell_y"] = item.cell_y
-        cell["symbol"] = symbol
+        cell["cell_x"] = cell_x
+        cell["cell_y"] = cell_y
+        cell["symbol"] = symbols.get(symbol_id, default_plant_symbol)
         cells_symbols.append(cell)
 
     return jsonify(cells_symbols)
 
 
+@app.route("/query/plot_layout/<int:plot_id>", methods=["GET"])
+@check_authorized
+def query_plot_layout(plot_id):
+    """Returns a plot's painted cells as a compact layout: a palette of plant
+    list entries with their symbols, and a base64, run-length encoded grid of
+    palette indexes (see plot_layout.py)."""
+
+    plot = Plot.query.get_or_404(plot_id)
+
+    return jsonify(PlotLayout.load(plot).serialize(default_plant_symbol))
+
+
 ########################################################################
 # Trefle API Routes
 ########################################################################
 
 
+def plants_unavailable():
+    """API error response for when plants can't be fetched."""
+
+    return {"errors": {"plants": ["Plants are unavailable right now."]}}
+
+
 @app.route("/api/plants/search", methods=["POST", "GET"])
+@limiter.limit("plant_search")
 def search_plants():
     """Lists all plants from Trefle API, 20 plants at a time"""
     form_data = request.json
     form = PlantSearchForm(obj=form_data)
 
     if form.validate():
-        # Intialize payload with api key
-        payload = {"token": TREFLE_API_KEY}
+        payload = {}
 
         # If the search filter was used, use the API's /search endpoint
         if "search" in form_data and form_data["search"][0] != "":
             search_term = form_data["search"][0]
             payload["q"] = search_term
-            request_string = f"{API_BASE_URL}/plants/search"
+            endpoint = "plants/search"
 
         # Otherwise use /plants endpoint, which should only return main_species of
         # plants, not subspecies/varieties
         else:
-            request_string = f"{API_BASE_URL}/plants"
+            endpoint = "plants"
 
         # For any of the filters applied, add them to the payload
         if "edible_part" in form_data:
@@ -1205,13 +1426,13 @@ def search_plants():
         if "evergreen" in form_data:
             payload["filter[leaf_retention]"] = "true"
 
-        # Create a request string "manually", as requests built in feature was replacing
-        # characters and resulting in an error from API
-        payload_str = "&".join("%s=%s" % (k, v) for k, v in payload.items())
-        plants = requests.get(request_string, params=payload_str)
+        try:
+            plants = search_plant_catalog(endpoint, payload)
+        except TrefleError:
+            return jsonify(plants_unavailable()), 503
 
-        plantlist = [plant for plant in plants.json()["data"]]
-        links = plants.json()["links"]
+        plantlist = [plant for plant in plants["data"]]
+        links = plants["links"]
         return jsonify(plantlist, links)
 
     else:
@@ -1219,19 +1440,32 @@ def search_plants():
         return jsonify(response)
 
 
+@app.route("/api/plants/autocomplete", methods=["GET"])
+def plant_autocomplete():
+    """Returns plant name suggestions from the local catalog for the search box.
+    Called on every keystroke, so it never goes to Trefle."""
+
+    q = request.args.get("q", "")[:100]
+
+    return jsonify(autocomplete(q))
+
+
 @app.route("/api/plants/pagination", methods=["POST"])
+@limiter.limit("plant_search")
 def plant_pagination():
     """Allows for navigation through Trefle's Pagination routes. Takes in the 
     agination link and adds API Key"""
 
-    pagination_link = request.json["pagination_link"][7:]
-    auth_pagination_link = pagination_link + f"&token={TREFLE_API_KEY}"
+    endpoint, query = link_request(request.json["pagination_link"])
 
     # requests next set of plants
-    plants = requests.get(f"{API_BASE_URL}{auth_pagination_link}")
+    try:
+        plants = search_plant_catalog(endpoint, query)
+    except TrefleError:
+        return jsonify(plants_unavailable()), 503
 
-    plantlist = [plant for plant in plants.json()["data"]]
-    links = plants.json()["links"]
+    plantlist = [plant for plant in plants["data"]]
+    links = plants["links"]
 
     return jsonify(plantlist, links)
 
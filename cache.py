@@ -0,0 +1,292 @@
+"""Response cache for Trefle API requests.
+
+Responses are keyed on the endpoint plus its normalized query params, so the
+same search asked in a different parameter order (or with a different API
+token) hits the same entry. Two backends are available: an in-process LRU and
+a SQLite file that every gunicorn worker on the box can share."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+# Params that never change the response and must not end up in keys
+IGNORED_PARAMS = {"token"}
+
+# Time to live (in seconds) for each kind of Trefle endpoint
+DEFAULT_TTLS = {
+    "plants": 60 * 60,
+    "search": 15 * 60,
+    "profile": 24 * 60 * 60,
+}
+DEFAULT_TTL = 10 * 60
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def endpoint_kind(endpoint):
+    """Classifies an endpoint path (e.g. 'plants/search') for TTL lookup."""
+
+    parts = [part for part in endpoint.strip("/").split("/") if part]
+    if parts == ["plants"]:
+        return "plants"
+    if parts == ["plants", "search"]:
+        return "search"
+    if len(parts) == 2 and parts[0] == "plants":
+        return "profile"
+    return "/".join(parts)
+
+
+def normalize_params(params):
+    """Returns params as a sorted list of (key, value) pairs.
+
+    Accepts a dict, a list of pairs or a query string. Comma separated filter
+    values are sorted, since Trefle treats them as a set."""
+
+    if not params:
+        return []
+    if isinstance(params, str):
+        pairs = parse_qsl(params.lstrip("?"), keep_blank_values=True)
+    elif isinstance(params, dict):
+        pairs = list(params.items())
+    else:
+        pairs = list(params)
+
+    normalized = []
+    for key, value in pairs:
+        if key in IGNORED_PARAMS:
+            continue
+        value = str(value)
+        if key.startswith("filter[") and "," in value:
+            value = ",".join(sorted(value.split(",")))
+        normalized.append((key, value))
+
+    return sorted(normalized)
+
+
+def make_key(endpoint, params=None):
+    """Builds the cache key for an endpoint and its query params."""
+
+    endpoint = endpoint.strip("/")
+    query = urlencode(normalize_params(params))
+    raw = f"{endpoint}?{query}" if query else endpoint
+    return hashlib.sha1(raw.encode("UTF-8")).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU store bounded by total value size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        expires, value = self._entries.pop(key)
+        self.size -= len(value)
+
+
+class DiskBackend:
+    """LRU store in a SQLite file, shared by every process using the same path.
+
+    Each thread (and each forked worker) opens its own connection."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, expires FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        now = time.time()
+        if expires < now:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return bytes(value)
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + ttl, now),
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        total = self._total_size(conn)
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we are back under the limit
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM responses")
+
+    @property
+    def size(self):
+        return self._total_size(self._connect())
+
+    @staticmethod
+    def _total_size(conn):
+        row = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return row[0]
+
+
+class ResponseCache:
+    """Caches parsed JSON responses per endpoint, with per-endpoint TTLs and
+    hit/miss counters."""
+
+    def __init__(self, backend, ttls=None, default_ttl=DEFAULT_TTL):
+        self.backend = backend
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, endpoint):
+        return self.ttls.get(endpoint_kind(endpoint), self.default_ttl)
+
+    def get(self, endpoint, params=None):
+        """Returns the cached response for endpoint + params, or None."""
+
+        value = self.backend.get(make_key(endpoint, params))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def contains(self, endpoint, params=None):
+        """Whether a response is cached, without counting a hit or miss."""
+
+        return self.backend.get(make_key(endpoint, params)) is not None
+
+    def set(self, endpoint, params, data, ttl=None):
+        """Stores a parsed response for endpoint + params."""
+
+        value = json.dumps(data, separators=(",", ":")).encode("UTF-8")
+        self.backend.set(
+            make_key(endpoint, params),
+            value,
+            ttl if ttl is not None else self.ttl_for(endpoint),
+        )
+
+    def delete(self, endpoint, params=None):
+        self.backend.delete(make_key(endpoint, params))
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self.backend.size,
+        }
+
+
+def cache_from_config(config):
+    """Builds a ResponseCache from Flask app config."""
+
+    max_bytes = int(config.get("TREFLE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+    if config.get("TREFLE_CACHE_BACKEND") == "disk":
+        backend = DiskBackend(config["TREFLE_CACHE_PATH"], max_bytes=max_bytes)
+    else:
+        backend = MemoryBackend(max_bytes=max_bytes)
+
+    return ResponseCache(backend, ttls=config.get("TREFLE_CACHE_TTLS"))
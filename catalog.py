@@ -0,0 +1,468 @@
+"""Local mirror of the Trefle plant catalog.
+
+Plants are streamed in from Trefle-format JSON pages, either fetched from the
+API or read from a local dump file, and upserted on trefle_id into the plants
+table in batches. Imports are resumable: progress is saved to a checkpoint file
+after each page, and re-running an import never creates duplicates.
+
+Once the catalog is filled, search_page() answers plant list and search
+requests from the database in the same shape Trefle would.
+
+Usage (after applying migrations with python migrations.py):
+    python catalog.py --file plants.jsonl
+    python catalog.py --trefle --start-page 1
+"""
+
+import json
+import logging
+import math
+import os
+import re
+from datetime import datetime
+from difflib import SequenceMatcher
+from urllib.parse import urlencode
+
+from sqlalchemy import or_, text
+
+from cache import normalize_params
+from facets import filter_engine
+from models import db, Plant, PLANT_SEARCH_DOCUMENT
+
+BATCH_SIZE = 500
+PER_PAGE = 20
+AUTOCOMPLETE_LIMIT = 10
+
+# Fuzzy (typo tolerant) matching on SQLite: how many candidates to score and
+# the minimum similarity for a term to count as a match
+FUZZY_CANDIDATES = 2000
+FUZZY_THRESHOLD = 0.7
+
+# Most text search matches considered when a search is also filtered
+MAX_FILTERED_MATCHES = 5000
+
+# Trefle plant item keys stored on the Plant model
+CATALOG_FIELDS = (
+    "slug",
+    "common_name",
+    "scientific_name",
+    "family",
+    "family_common_name",
+    "image_url",
+    "genus",
+    "year",
+    "author",
+    "rank",
+    "status",
+)
+
+
+########################################################################
+# Import
+########################################################################
+
+
+def plant_row(item):
+    """Maps a Trefle plant item to Plant column values."""
+
+    # Species detail responses nest the interesting data in "main_species"
+    item = item.get("main_species", item)
+
+    row = {"trefle_id": item["id"]}
+    for field in CATALOG_FIELDS:
+        value = item.get(field)
+        # Detail responses have objects where list items have names
+        if isinstance(value, dict):
+            value = value.get("name")
+        row[field] = value
+
+    row.update(filter_engine.encode(item))
+
+    return row
+
+
+def iter_dump(path):
+    """Yields (position, items) for each line of a JSON lines dump file.
+
+    Each line is either a Trefle page ({"data": [...], ...}) or a single plant.
+    Position is the line number, used for resuming."""
+
+    with open(path) as dump:
+        for position, line in enumerate(dump, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            page = json.loads(line)
+            items = page["data"] if "data" in page else [page]
+            yield position, items
+
+
+def iter_trefle_pages(client, start_page=1):
+    """Yields (page number, items) for every page of Trefle's /plants endpoint."""
+
+    page = start_page
+    while True:
+        resp = client.get("plants", {"page": page})
+        yield page, resp["data"]
+
+        if "next" not in resp.get("links", {}):
+            return
+        page += 1
+
+
+def upsert_plants(rows):
+    """Inserts new plants and updates existing ones, matched on trefle_id.
+
+    Costs one lookup query plus one bulk insert and one bulk update."""
+
+    # Last occurrence wins if a batch has the same plant twice
+    rows = {row["trefle_id"]: row for row in rows}
+    if not rows:
+        return 0, 0
+
+    existing = dict(
+        db.session.query(Plant.trefle_id, Plant.id).filter(
+            Plant.trefle_id.in_(list(rows))
+        )
+    )
+
+    now = datetime.utcnow()
+    inserts = []
+    updates = []
+    for trefle_id, row in rows.items():
+        row = dict(row, synced_at=now)
+        if trefle_id in existing:
+            updates.append(dict(row, id=existing[trefle_id]))
+        else:
+            inserts.append(row)
+
+    if inserts:
+        db.session.bulk_insert_mappings(Plant, inserts)
+    if updates:
+        db.session.bulk_update_mappings(Plant, updates)
+
+    return len(inserts), len(updates)
+
+
+class Checkpoint:
+    """Remembers the last imported position of a source in a small JSON file."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get("source") != self.source:
+            return 0
+        return state["position"]
+
+    def save(self, position):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"source": self.source, "position": position}, f)
+        os.replace(tmp_path, self.path)
+
+
+def import_plants(pages, checkpoint=None, batch_size=BATCH_SIZE):
+    """Imports plants from an iterable of (position, items) pages.
+
+    Pages at or before the checkpointed position are skipped. The transaction
+    is committed and the checkpoint saved after each page."""
+
+    done = checkpoint.load() if checkpoint else 0
+    inserted = updated = 0
+
+    for position, items in pages:
+        if position <= done:
+            continue
+
+        rows = [plant_row(item) for item in items]
+        for start in range(0, len(rows), batch_size):
+            new, changed = upsert_plants(rows[start : start + batch_size])
+            inserted += new
+            updated += changed
+
+        db.session.commit()
+        if checkpoint:
+            checkpoint.save(position)
+        logging.info(f"Imported catalog position {position}")
+
+    return inserted, updated
+
+
+########################################################################
+# Search
+########################################################################
+
+
+def search_terms(q):
+    """Splits a search string into lowercase word terms."""
+
+    return re.findall(r"\w+", q.lower())
+
+
+def text_search(q, limit=PER_PAGE, offset=0):
+    """Searches plant names, family and family common name.
+
+    Every term is prefix matched and results are ranked by relevance, with
+    close misspellings still matching. Returns (ranked plant ids, total matches)."""
+
+    terms = search_terms(q)
+    if not terms:
+        return [], 0
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return _search_postgres(terms, limit, offset)
+    if dialect == "sqlite":
+        return _search_sqlite(terms, limit, offset)
+    return _search_like(terms, limit, offset)
+
+
+POSTGRES_SEARCH = text(
+    f"""SELECT plants.id, count(*) OVER () AS total
+    FROM plants, to_tsquery('simple', :tsquery) AS query
+    WHERE to_tsvector('simple', {PLANT_SEARCH_DOCUMENT}) @@ query
+        OR lower(common_name) % :q
+        OR lower(scientific_name) % :q
+    ORDER BY ts_rank(to_tsvector('simple', {PLANT_SEARCH_DOCUMENT}), query)
+        + greatest(similarity(lower(common_name), :q), similarity(lower(scientific_name), :q)) DESC,
+        plants.id
+    LIMIT :limit OFFSET :offset"""
+)
+
+
+def _search_postgres(terms, limit, offset):
+    """tsvector prefix search (GIN index) OR'ed with trigram similarity."""
+
+    rows = db.session.execute(
+        POSTGRES_SEARCH,
+        {
+            "tsquery": " & ".join(f"{term}:*" for term in terms),
+            "q": " ".join(terms),
+            "limit": limit,
+            "offset": offset,
+        },
+    ).fetchall()
+
+    return [row.id for row in rows], rows[0].total if rows else 0
+
+
+def _search_sqlite(terms, limit, offset):
+    """FTS5 prefix search, falling back to fuzzy matching when nothing matches."""
+
+    match = " ".join(f'"{term}"*' for term in terms)
+    total = db.session.execute(
+        text("SELECT count(*) FROM plants_fts WHERE plants_fts MATCH :match"),
+        {"match": match},
+    ).scalar()
+
+    if total:
+        rows = db.session.execute(
+            text(
+                """SELECT rowid FROM plants_fts WHERE plants_fts MATCH :match
+                ORDER BY bm25(plants_fts, 4.0, 4.0, 1.0, 1.0), rowid
+                LIMIT :limit OFFSET :offset"""
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        ).fetchall()
+        return [row[0] for row in rows], total
+
+    # Nothing matched as typed. Score plants sharing a two letter prefix with
+    # any term by how closely their words match the terms.
+    candidates = db.session.execute(
+        text(
+            """SELECT rowid, common_name, scientific_name FROM plants_fts
+            WHERE plants_fts MATCH :match LIMIT :limit"""
+        ),
+        {
+            "match": " OR ".join(f'"{term[:2]}"*' for term in terms),
+            "limit": FUZZY_CANDIDATES,
+        },
+    ).fetchall()
+
+    scored = []
+    for plant_id, common_name, scientific_name in candidates:
+        words = search_terms(f"{common_name or ''} {scientific_name or ''}")
+        score = fuzzy_score(terms, words)
+        if score >= FUZZY_THRESHOLD:
+            scored.append((-score, plant_id))
+    scored.sort()
+
+    return (
+        [plant_id for score, plant_id in scored[offset : offset + limit]],
+        len(scored),
+    )
+
+
+def fuzzy_score(terms, words):
+    """Average, over terms, of the best similarity between a term and any word."""
+
+    if not words:
+        return 0
+    total = 0
+    for term in terms:
+        total += max(
+            SequenceMatcher(None, term, word[: len(term) + 2]).ratio() for word in words
+        )
+    return total / len(terms)
+
+
+def _search_like(terms, limit, offset):
+    """Unindexed fallback for other databases."""
+
+    query = Plant.query
+    for term in terms:
+        pattern = f"%{term}%"
+        query = query.filter(
+            or_(
+                Plant.common_name.ilike(pattern),
+                Plant.scientific_name.ilike(pattern),
+                Plant.family.ilike(pattern),
+                Plant.family_common_name.ilike(pattern),
+            )
+        )
+
+    total = query.count()
+    rows = query.with_entities(Plant.id).order_by(Plant.trefle_id)
+    return [row.id for row in rows.offset(offset).limit(limit)], total
+
+
+def plants_by_ids(ids):
+    """Loads plants in a single query, keeping the order of ids."""
+
+    plants = {plant.id: plant for plant in Plant.query.filter(Plant.id.in_(ids))}
+    return [plants[plant_id] for plant_id in ids if plant_id in plants]
+
+
+def autocomplete(q, limit=AUTOCOMPLETE_LIMIT):
+    """Returns the best name matches for a partially typed search."""
+
+    ids, total = text_search(q, limit=limit)
+    return [
+        {
+            "slug": plant.slug,
+            "common_name": plant.common_name,
+            "scientific_name": plant.scientific_name,
+        }
+        for plant in plants_by_ids(ids)
+    ]
+
+
+def search_page(endpoint, params=None, per_page=PER_PAGE):
+    """Answers a Trefle /plants or /plants/search request from the local catalog.
+
+    Takes the same endpoint and params that would be sent to Trefle and returns
+    a response in Trefle's shape, or None if the request uses something the
+    catalog can't answer."""
+
+    endpoint = endpoint.strip("/")
+    if endpoint not in ("plants", "plants/search"):
+        return None
+
+    params = dict(normalize_params(params))
+    selections = filter_engine.parse(params)
+    if selections is None:
+        return None
+
+    try:
+        page = max(int(params.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    q = params.get("q", "").strip()
+    offset = (page - 1) * per_page
+    base = None
+
+    if q and selections:
+        # Filter the best text matches, keeping their ranking
+        ids, _ = text_search(q, limit=MAX_FILTERED_MATCHES)
+        base = Plant.id.in_(ids)
+        matches = {
+            row.id
+            for row in db.session.query(Plant.id).filter(
+                base, filter_engine.condition(selections)
+            )
+        }
+        ids = [plant_id for plant_id in ids if plant_id in matches]
+        total = len(ids)
+        plants = plants_by_ids(ids[offset : offset + per_page])
+    elif q:
+        ids, total = text_search(q, limit=per_page, offset=offset)
+        plants = plants_by_ids(ids)
+    else:
+        query = Plant.query.filter(filter_engine.condition(selections))
+        total = query.count()
+        plants = query.order_by(Plant.trefle_id).offset(offset).limit(per_page).all()
+
+    meta = {"total": total}
+    if selections:
+        meta["facets"] = filter_engine.counts(selections, base)
+
+    link_params = {key: value for key, value in params.items() if key != "page"}
+
+    return {
+        "data": [plant.serialize() for plant in plants],
+        "links": page_links(endpoint, link_params, page, total, per_page),
+        "meta": meta,
+    }
+
+
+def page_links(endpoint, params, page, total, per_page=PER_PAGE):
+    """Builds Trefle style pagination links (e.g. /api/v1/plants?page=2)."""
+
+    last = max(math.ceil(total / per_page), 1)
+
+    def link(number):
+        return f"/api/v1/{endpoint}?" + urlencode(dict(params, page=number))
+
+    links = {"self": link(page), "first": link(1), "last": link(last)}
+    if page > 1:
+        links["prev"] = link(page - 1)
+    if page < last:
+        links["next"] = link(page + 1)
+    return links
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from app import app, trefle
+    from migrations import pending_migrations
+
+    parser = argparse.ArgumentParser(description="Import plants into the catalog.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="JSON lines dump of Trefle pages or plants")
+    source.add_argument("--trefle", action="store_true", help="page through Trefle")
+    parser.add_argument("--start-page", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--checkpoint",
+        default="catalog_import.checkpoint",
+        help="file used to resume an interrupted import",
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    # The catalog columns are added to an existing plants table by migrations
+    pending = pending_migrations()
+    if pending:
+        versions = ", ".join(migration.version for migration in pending)
+        parser.exit(
+            1, f"Migrations {versions} are pending, run python migrations.py first.\n"
+        )
+
+    if args.file:
+        pages = iter_dump(args.file)
+        checkpoint = Checkpoint(args.checkpoint, f"file:{os.path.abspath(args.file)}")
+    else:
+        checkpoint = Checkpoint(args.checkpoint, "trefle")
+        start_page = max(args.start_page, checkpoint.load() + 1)
+        pages = iter_trefle_pages(trefle, start_page=start_page)
+
+    inserted, updated = import_plants(pages, checkpoint, batch_size=args.batch_size)
+    print(f"Imported {inserted} new plants, updated {updated}.")
@@ -0,0 +1,87 @@
+"""Choices for the forms that link projects, plots and plant lists.
+
+Choices are (id, name) tuples read straight from the database, rather than
+built by loading whole collections of ORM objects and comparing them. The
+current user's own choices are memoized for the rest of the request, until
+something changes their projects, plots or plant lists."""
+
+from flask import g, has_app_context
+from sqlalchemy import and_, event, exists
+from sqlalchemy.orm import Session
+
+from models import db, CONTENT_MODELS, ASSOCIATIONS, association
+
+# Changes to these mean memoized choices may be out of date
+CHOICE_MODELS = tuple(CONTENT_MODELS.values()) + tuple(
+    model for model, *kinds in ASSOCIATIONS
+)
+
+
+def user_items(kind, user_id):
+    """Query of (id, name) for the user's projects, plots or plant lists."""
+
+    model = CONTENT_MODELS[kind]
+    owned, user_column, item_column = association("users", kind)
+
+    return (
+        db.session.query(model.id, model.name)
+        .join(owned, item_column == model.id)
+        .filter(user_column == user_id)
+        .order_by(owned.id)
+    )
+
+
+def user_choices(kind):
+    """(id, name) of the current user's projects, plots or plant lists,
+    memoized for the request."""
+
+    choices = g.setdefault("user_choices", {})
+    if kind not in choices:
+        choices[kind] = user_items(kind, g.user.id).all()
+    return choices[kind]
+
+
+def invalidate_choices():
+    if has_app_context():
+        g.pop("user_choices", None)
+
+
+@event.listens_for(Session, "after_flush")
+def invalidate_changed_choices(session, flush_context):
+    """Drops memoized choices when a flush writes any content or links."""
+
+    changed = session.new | session.dirty | session.deleted
+    if any(isinstance(obj, CHOICE_MODELS) for obj in changed):
+        invalidate_choices()
+
+
+def linked_choices(kind, primary_kind, primary_id):
+    """(id, name) of the projects, plots or plant lists linked to a record,
+    e.g. the plots of a project."""
+
+    model = CONTENT_MODELS[kind]
+    linked, primary_column, item_column = association(primary_kind, kind)
+
+    return (
+        db.session.query(model.id, model.name)
+        .join(linked, item_column == model.id)
+        .filter(primary_column == primary_id)
+        .order_by(linked.id)
+        .all()
+    )
+
+
+def unlinked_choices(kind, primary_kind, primary_id, user_id):
+    """(id, name) of the user's projects, plots or plant lists that aren't yet
+    linked to a record, in one anti-join query."""
+
+    model = CONTENT_MODELS[kind]
+    linked, primary_column, item_column = association(primary_kind, kind)
+
+    return (
+        user_items(kind, user_id)
+        .filter(
+            ~exists().where(and_(item_column == model.id, primary_column == primary_id))
+        )
+        .all()
+    )
@@ -0,0 +1,132 @@
+"""Circuit breaker for calls to an unreliable dependency (Trefle).
+
+Outcomes are tracked per key (for Trefle, the kind of endpoint) over a sliding
+window of `window` seconds. Once at least `min_calls` have been made in the
+window and `failure_rate` of them failed, the circuit opens: calls fail at once
+for `open_for` seconds instead of queueing up behind a dead upstream. After
+that it is half-open, letting `probes` calls through; if they succeed it
+closes again, if one fails it opens for another `open_for` seconds.
+
+State is per worker process."""
+
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of making a call while its circuit is open."""
+
+    def __init__(self, key, retry_after):
+        super().__init__(f"Circuit for {key} is open, retry in {retry_after:.0f}s")
+        self.key = key
+        self.retry_after = retry_after
+
+
+class Circuit:
+    """Outcomes and state for one key."""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque()
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+
+
+class CircuitBreaker:
+    """Tracks failures per key, and stops calls for keys that keep failing."""
+
+    def __init__(
+        self, window=60, min_calls=10, failure_rate=0.5, open_for=30, probes=1
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_for = open_for
+        self.probes = probes
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a breaker from Flask app config."""
+
+        return cls(
+            window=float(config.get("TREFLE_BREAKER_WINDOW", 60)),
+            min_calls=int(config.get("TREFLE_BREAKER_MIN_CALLS", 10)),
+            failure_rate=float(config.get("TREFLE_BREAKER_FAILURE_RATE", 0.5)),
+            open_for=float(config.get("TREFLE_BREAKER_OPEN_FOR", 30)),
+        )
+
+    def state(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                return CLOSED
+            if circuit.state == OPEN and self._retry_after(circuit) <= 0:
+                return HALF_OPEN
+            return circuit.state
+
+    def before_call(self, key):
+        """Raises CircuitOpen if a call for key must not be made now."""
+
+        with self._lock:
+            circuit = self._circuits.setdefault(key, Circuit())
+
+            if circuit.state == OPEN:
+                retry_after = self._retry_after(circuit)
+                if retry_after > 0:
+                    raise CircuitOpen(key, retry_after)
+                circuit.state = HALF_OPEN
+                circuit.probes = 0
+
+            if circuit.state == HALF_OPEN:
+                if circuit.probes >= self.probes:
+                    raise CircuitOpen(key, self.open_for)
+                circuit.probes += 1
+
+    def record(self, key, ok):
+        """Records the outcome of a call allowed by before_call()."""
+
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuits.setdefault(key, Circuit())
+
+            if circuit.state == HALF_OPEN:
+                if ok:
+                    circuit.state = CLOSED
+                    circuit.outcomes.clear()
+                    circuit.failures = 0
+                else:
+                    self._open(circuit, now)
+                return
+
+            circuit.outcomes.append((now, ok))
+            if not ok:
+                circuit.failures += 1
+            while circuit.outcomes and circuit.outcomes[0][0] < now - self.window:
+                _, old_ok = circuit.outcomes.popleft()
+                if not old_ok:
+                    circuit.failures -= 1
+
+            calls = len(circuit.outcomes)
+            if (
+                circuit.state == CLOSED
+                and calls >= self.min_calls
+                and circuit.failures >= self.failure_rate * calls
+            ):
+                self._open(circuit, now)
+
+    def _open(self, circuit, now):
+        circuit.state = OPEN
+        circuit.opened_at = now
+        circuit.outcomes.clear()
+        circuit.failures = 0
+
+    def _retry_after(self, circuit):
+        return circuit.opened_at + self.open_for - time.monotonic()
@@ -0,0 +1,127 @@
+"""Everything a user has made, and how it's connected, for the content page.
+
+The page lists each of the user's projects, plots and plant lists with the
+items connected to them. Walking those through ORM relationships lazy loads
+every inner list separately, so the graph is instead read straight from the
+association tables in six column-only queries, however much content there is,
+into plain nodes the template walks the same way."""
+
+from sqlalchemy.orm import aliased
+
+from models import (
+    db,
+    Project,
+    Plot,
+    PlantList,
+    Users_Projects,
+    Users_Plots,
+    Users_PlantLists,
+    Projects_Plots,
+    Projects_PlantLists,
+    Plots_PlantLists,
+)
+
+
+class Node:
+    """A project, plot or plant list, with the items connected to it."""
+
+    __slots__ = ("id", "name", "description", "projects", "plots", "plantlists")
+
+    def __init__(self, id, name, description=None):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.projects = []
+        self.plots = []
+        self.plantlists = []
+
+
+# (kind, model, user association, its column for the model)
+OWNED = [
+    ("projects", Project, Users_Projects, Users_Projects.project_id),
+    ("plots", Plot, Users_Plots, Users_Plots.plot_id),
+    ("plantlists", PlantList, Users_PlantLists, Users_PlantLists.plantlist_id),
+]
+
+# (association, first kind, its column, second kind, its column)
+LINKS = [
+    (
+        Projects_Plots,
+        "projects",
+        Projects_Plots.project_id,
+        "plots",
+        Projects_Plots.plot_id,
+    ),
+    (
+        Projects_PlantLists,
+        "projects",
+        Projects_PlantLists.project_id,
+        "plantlists",
+        Projects_PlantLists.plantlist_id,
+    ),
+    (
+        Plots_PlantLists,
+        "plots",
+        Plots_PlantLists.plot_id,
+        "plantlists",
+        Plots_PlantLists.plantlist_id,
+    ),
+]
+
+MODELS = {kind: model for kind, model, association, column in OWNED}
+
+
+class ContentGraph:
+    """A user's projects, plots and plant lists."""
+
+    def __init__(self):
+        self.projects = []
+        self.plots = []
+        self.plantlists = []
+        self._nodes = {kind: {} for kind in MODELS}
+
+    def node(self, kind, id, name, description=None):
+        nodes = self._nodes[kind]
+        if id not in nodes:
+            nodes[id] = Node(id, name, description)
+        return nodes[id]
+
+    @classmethod
+    def load(cls, user_id):
+        graph = cls()
+
+        owned_ids = {}
+        for kind, model, association, column in OWNED:
+            query = (
+                db.session.query(model.id, model.name, model.description)
+                .join(association, column == model.id)
+                .filter(association.user_id == user_id)
+                .order_by(association.id)
+            )
+            for id, name, description in query:
+                getattr(graph, kind).append(graph.node(kind, id, name, description))
+
+            owned_ids[kind] = db.session.query(column).filter(
+                association.user_id == user_id
+            )
+
+        for association, kind_a, column_a, kind_b, column_b in LINKS:
+            model_a, model_b = aliased(MODELS[kind_a]), aliased(MODELS[kind_b])
+            query = (
+                db.session.query(model_a.id, model_a.name, model_b.id, model_b.name)
+                .select_from(association)
+                .join(model_a, model_a.id == column_a)
+                .join(model_b, model_b.id == column_b)
+                .filter(
+                    column_a.in_(owned_ids[kind_a].subquery())
+                    | column_b.in_(owned_ids[kind_b].subquery())
+                )
+                .order_by(association.id)
+            )
+            for id_a, name_a, id_b, name_b in query:
+                node_a = graph.node(kind_a, id_a, name_a)
+                node_b = graph.node(kind_b, id_b, name_b)
+                getattr(node_a, kind_b).append(node_b)
+                getattr(node_b, kind_a).append(node_a)
+
+        return graph
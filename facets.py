@@ -0,0 +1,213 @@
+"""Faceted filtering over plant attributes in the local catalog.
+
+Multi-valued attributes (flower colors, growth/bloom/fruit months, edible parts
+and durations) are stored as integer bitsets with one bit per choice in
+forms.py, ligneous type as the index of its choice and vegetable/evergreen as
+booleans. A filter on any combination of them is a handful of bitwise tests in
+a single query, and the counts for every facet value are computed in one
+aggregate pass over the table."""
+
+from sqlalchemy import and_, case, func, true
+
+from forms import (
+    TREFLE_COLOR_CHOICES,
+    TREFLE_MONTH_CHOICES,
+    TREFLE_EDIBLE_PART_CHOICES,
+    TREFLE_DURATION_CHOICES,
+    TREFLE_LIGNEOUS_TYPE_CHOICES,
+)
+from models import db, Plant
+
+
+class Facet:
+    """Multi-valued attribute stored as a bitset column.
+
+    `path` is where the attribute lives in a Trefle species item."""
+
+    def __init__(self, name, column, choices, path):
+        self.name = name
+        self.column = column
+        self.values = [value for value, label in choices]
+        self.path = path
+
+    def extract(self, item):
+        for key in self.path:
+            if not isinstance(item, dict):
+                return None
+            item = item.get(key)
+        return item
+
+    def bit(self, value):
+        return 1 << self.values.index(value)
+
+    def encode(self, values):
+        bits = 0
+        for value in values or []:
+            value = str(value).lower()
+            if value in self.values:
+                bits |= self.bit(value)
+        return bits
+
+    def condition(self, values):
+        """Plant has any of the values."""
+
+        return self.column.op("&")(self.encode(values)) != 0
+
+    def value_condition(self, value):
+        return self.column.op("&")(self.bit(value)) != 0
+
+
+class EnumFacet(Facet):
+    """Single-valued attribute stored as the index of its choice."""
+
+    def encode(self, value):
+        value = str(value).lower() if value else None
+        return self.values.index(value) if value in self.values else None
+
+    def condition(self, values):
+        return self.column.in_(
+            [self.values.index(v) for v in values if v in self.values]
+        )
+
+    def value_condition(self, value):
+        return self.column == self.values.index(value)
+
+
+class FlagFacet(Facet):
+    """Yes/no attribute, only ever filtered on being true."""
+
+    def __init__(self, name, column, path):
+        super().__init__(name, column, [("true", "Yes")], path)
+
+    def encode(self, value):
+        return bool(value)
+
+    def condition(self, values):
+        return self.column.is_(True)
+
+    def value_condition(self, value):
+        return self.column.is_(True)
+
+
+FACETS = [
+    Facet(
+        "flower_color",
+        Plant.flower_color_bits,
+        TREFLE_COLOR_CHOICES,
+        ("flower", "color"),
+    ),
+    Facet(
+        "growth_months",
+        Plant.growth_months_bits,
+        TREFLE_MONTH_CHOICES,
+        ("growth", "growth_months"),
+    ),
+    Facet(
+        "bloom_months",
+        Plant.bloom_months_bits,
+        TREFLE_MONTH_CHOICES,
+        ("growth", "bloom_months"),
+    ),
+    Facet(
+        "fruit_months",
+        Plant.fruit_months_bits,
+        TREFLE_MONTH_CHOICES,
+        ("growth", "fruit_months"),
+    ),
+    Facet(
+        "edible_part",
+        Plant.edible_part_bits,
+        TREFLE_EDIBLE_PART_CHOICES,
+        ("edible_part",),
+    ),
+    Facet("duration", Plant.duration_bits, TREFLE_DURATION_CHOICES, ("duration",)),
+    EnumFacet(
+        "ligneous_type",
+        Plant.ligneous_type,
+        TREFLE_LIGNEOUS_TYPE_CHOICES,
+        ("specifications", "ligneous_type"),
+    ),
+    FlagFacet("vegetable", Plant.vegetable, ("vegetable",)),
+    FlagFacet("leaf_retention", Plant.leaf_retention, ("foliage", "leaf_retention")),
+]
+
+
+class FilterEngine:
+    """Evaluates Trefle style filter[...] params against the local catalog."""
+
+    def __init__(self, facets=FACETS):
+        self.facets = {facet.name: facet for facet in facets}
+
+    def parse(self, params):
+        """Reads filter[...] params into {facet name: [values]}.
+
+        Returns None if a filter is on something not stored locally."""
+
+        selections = {}
+        for key, value in params.items():
+            if not key.startswith("filter["):
+                continue
+            name = key[len("filter[") : -1]
+            if name not in self.facets:
+                return None
+            values = [v for v in str(value).lower().split(",") if v]
+            if values:
+                selections[name] = values
+        return selections
+
+    def encode(self, item):
+        """Returns Plant column values for a Trefle species item's attributes.
+
+        Plain list items carry no attributes, and get nothing back, so that
+        re-importing them doesn't wipe attributes imported from details."""
+
+        if not any(facet.path[0] in item for facet in self.facets.values()):
+            return {}
+
+        return {
+            facet.column.key: facet.encode(facet.extract(item))
+            for facet in self.facets.values()
+        }
+
+    def condition(self, selections, exclude=None):
+        """SQL condition for the selections, optionally leaving one facet out."""
+
+        conditions = [
+            self.facets[name].condition(values)
+            for name, values in selections.items()
+            if name != exclude
+        ]
+        return and_(*conditions) if conditions else true()
+
+    def counts(self, selections, base=None):
+        """Counts plants for every value of every facet in one query.
+
+        Each facet's counts apply the selections on all the other facets, so
+        they show how many results picking that value would add. Also returns
+        the total matching all selections under "total"."""
+
+        columns = [func.sum(case([(self.condition(selections), 1)], else_=0))]
+        keys = [None]
+        for facet in self.facets.values():
+            others = self.condition(selections, exclude=facet.name)
+            for value in facet.values:
+                columns.append(
+                    func.sum(
+                        case([(and_(others, facet.value_condition(value)), 1)], else_=0)
+                    )
+                )
+                keys.append((facet.name, value))
+
+        query = db.session.query(*columns).select_from(Plant)
+        if base is not None:
+            query = query.filter(base)
+        row = query.one()
+
+        counts = {"total": row[0] or 0}
+        for key, count in zip(keys[1:], row[1:]):
+            name, value = key
+            counts.setdefault(name, {})[value] = count or 0
+        return counts
+
+
+filter_engine = FilterEngine()
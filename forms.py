@@ -47,6 +47,27 @@ TREFLE_MONTH_CHOICES = [
     ("nov", "NOV"),
     ("dec", "DEC"),
 ]
+TREFLE_EDIBLE_PART_CHOICES = [
+    ("roots", "Roots"),
+    ("stem", "Stem"),
+    ("leaves", "Leaves"),
+    ("flowers", "Flowers"),
+    ("fruits", "Fruits"),
+    ("seeds", "Seeds"),
+    ("tubers", "Tubers"),
+]
+TREFLE_DURATION_CHOICES = [
+    ("annual", "Annual"),
+    ("biennial", "Biennial"),
+    ("perennial", "Perennial"),
+]
+TREFLE_LIGNEOUS_TYPE_CHOICES = [
+    ("liana", "Liana"),
+    ("subshrub", "Subshrub"),
+    ("shrub", "Shrub"),
+    ("tree", "Tree"),
+    ("parasite", "Parasite"),
+]
 
 
 class UserAddForm(FlaskForm):
@@ -79,22 +100,12 @@ class PlantSearchForm(FlaskForm):
     search = StringField("Search", validators=[Optional()])
     duration = SelectMultipleField(
         "Duration (life cycle)",
-        choices=[
-            ("annual", "Annual"),
-            ("biennial", "Biennial"),
-            ("perennial", "Perennial"),
-        ],
+        choices=TREFLE_DURATION_CHOICES,
         validators=[Optional()],
     )
     ligneous_type = SelectMultipleField(
         "Woody Plant Type",
-        choices=[
-            ("liana", "Liana"),
-            ("subshrub", "Subshrub"),
-            ("shrub", "Shrub"),
-            ("tree", "Tree"),
-            ("parasite", "Parasite"),
-        ],
+        choices=TREFLE_LIGNEOUS_TYPE_CHOICES,
         validators=[Optional()],
     )
     flower_color = SelectMultipleField(
@@ -110,17 +121,7 @@ class PlantSearchForm(FlaskForm):
         "Fruit Months", choices=TREFLE_MONTH_CHOICES, validators=[Optional()],
     )
     edible_part = SelectMultipleField(
-        "Edible Parts",
-        choices=[
-            ("roots", "Roots"),
-            ("stem", "Stem"),
-            ("leaves", "Leaves"),
-            ("flowers", "Flowers"),
-            ("fruits", "Fruits"),
-            ("seeds", "Seeds"),
-            ("tubers", "Tubers"),
-        ],
-        validators=[Optional()],
+        "Edible Parts", choices=TREFLE_EDIBLE_PART_CHOICES, validators=[Optional()],
     )
     vegetable = BooleanField("Vegetable", validators=[Optional()])
     evergreen = BooleanField("Evergreen", validators=[Optional()])
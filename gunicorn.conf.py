@@ -0,0 +1,21 @@
+"""gunicorn settings (see the Procfile).
+
+Workers are gevent workers: each request runs in a greenlet, and waiting on
+Trefle, Postgres or a lock file lets the worker's other requests run, so a
+few processes can serve hundreds of concurrent searches while Trefle is slow.
+Views stay plain Flask functions; gevent patches the standard library so their
+blocking calls yield instead."""
+
+import os
+
+worker_class = "gevent"
+# Requests each worker serves at once
+worker_connections = int(os.environ.get("WEB_CONNECTIONS", 1000))
+
+
+def post_fork(server, worker):
+    # psycopg2 talks to Postgres in C, out of gevent's reach, so have it wait
+    # on gevent instead of blocking the whole worker
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
@@ -0,0 +1,87 @@
+"""Per-worker cache of logged in users.
+
+Loading the current user is the first thing every request does. The user's
+column values are kept here for a few seconds, and on a hit the User is
+attached to the session without a query. Anything that changes or deletes a
+user invalidates its entry; other workers see the change once the TTL runs out,
+so it's kept short.
+
+Form choices for the user's projects, plots and plant lists come from
+choices.user_choices, which selects just ids and names, so routes don't need
+the user's collections loaded."""
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+# Cached columns. The password hash is left out, and loads on access.
+USER_COLUMNS = ("id", "email", "username", "image_url")
+
+
+class IdentityCache:
+    """Short lived, size bounded map of user id to User column values."""
+
+    def __init__(self, ttl=10, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns the user, attached to the current session, or None if there
+        is no such user."""
+
+        with self._lock:
+            entry = self._users.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            user = User(**entry[1])
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        self.misses += 1
+        user = User.query.get(user_id)
+        if user is not None:
+            self.set(user)
+        return user
+
+    def set(self, user):
+        values = {column: getattr(user, column) for column in USER_COLUMNS}
+        with self._lock:
+            if len(self._users) >= self.max_size:
+                self._evict()
+            self._users[user.id] = (time.monotonic() + self.ttl, values)
+
+    def _evict(self):
+        now = time.monotonic()
+        for user_id, (expires, values) in list(self._users.items()):
+            if expires <= now:
+                del self._users[user_id]
+        if len(self._users) >= self.max_size:
+            del self._users[next(iter(self._users))]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+identity_cache = IdentityCache()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_user(mapper, connection, user):
+    """Drops users from the cache whenever they're changed or deleted,
+    including through User.edit."""
+
+    identity_cache.invalidate(user.id)
@@ -0,0 +1,47 @@
+"""Linking records through the association tables in bulk.
+
+Forms let users connect a project, plot or plant list to any number of others
+at once. Rather than loading and appending each selected record, the selected
+ids are checked with one IN query, and the missing links are added with one
+multi-row insert."""
+
+from choices import invalidate_choices
+from models import db, association, CONTENT_MODELS, Plant, User
+
+# Rows per insert statement, well under the databases' bind parameter limits
+INSERT_CHUNK_SIZE = 1000
+
+MODELS = dict(CONTENT_MODELS, users=User, plants=Plant)
+
+
+def link(kind, item_id, other_kind, other_ids):
+    """Links a record to records of another kind, e.g. a project to plots.
+
+    Ids of records that don't exist, and records already linked, are skipped.
+    The caller commits. Returns the number of links added."""
+
+    other_ids = {int(other_id) for other_id in other_ids}
+    if not other_ids:
+        return 0
+
+    model = MODELS[other_kind]
+    through, item_column, other_column = association(kind, other_kind)
+
+    existing = db.session.query(model.id).filter(model.id.in_(other_ids))
+    linked = db.session.query(other_column).filter(
+        item_column == item_id, other_column.in_(other_ids)
+    )
+    new_ids = {id for id, in existing} - {id for id, in linked}
+
+    rows = [
+        {item_column.key: item_id, other_column.key: other_id}
+        for other_id in sorted(new_ids)
+    ]
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(
+            through.__table__.insert().values(rows[i : i + INSERT_CHUNK_SIZE])
+        )
+
+    if rows:
+        invalidate_choices()
+    return len(rows)
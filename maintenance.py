@@ -0,0 +1,166 @@
+"""One-off database maintenance tasks.
+
+Usage:
+    python maintenance.py compact-plot-cells
+    python maintenance.py dedupe-links
+    python maintenance.py dedupe-symbols
+"""
+
+import logging
+
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import aliased
+
+from models import db, ASSOCIATIONS, PlantLists_Plants, Plot_Cells_Symbols, Symbol
+
+
+def index_exists(table, name):
+    return any(index["name"] == name for index in inspect(db.engine).get_indexes(table))
+
+
+def create_missing_indexes(model):
+    for index in model.__table__.indexes:
+        if not index_exists(model.__tablename__, index.name):
+            index.create(bind=db.engine)
+
+
+def compact_plot_cells(create_indexes=True):
+    """Removes duplicate rows for the same plot cell, keeping the latest one,
+    then adds the unique (plot_id, cell_x, cell_y) index if it's missing.
+
+    Before the index existed, repainting a cell inserted another row for it.
+    migrations.py passes create_indexes=False and builds the index itself.
+    Returns the number of rows removed."""
+
+    latest = (
+        db.session.query(func.max(Plot_Cells_Symbols.id))
+        .group_by(
+            Plot_Cells_Symbols.plot_id,
+            Plot_Cells_Symbols.cell_x,
+            Plot_Cells_Symbols.cell_y,
+        )
+        .subquery()
+    )
+    removed = Plot_Cells_Symbols.query.filter(
+        ~Plot_Cells_Symbols.id.in_(latest)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    if create_indexes:
+        create_missing_indexes(Plot_Cells_Symbols)
+
+    logging.info(f"Removed {removed} duplicate plot cell rows")
+    return removed
+
+
+def dedupe_links(create_indexes=True):
+    """Removes duplicate links from every through table, keeping the first row
+    for each pair of ids, then adds the tables' indexes if they're missing.
+
+    Before the unique indexes existed, saving a project, plot or plant list
+    linked it to the selected records again. Plot cells pointing at a
+    duplicate plant list plant are moved to the row that's kept.
+    migrations.py passes create_indexes=False and builds the indexes itself.
+    Returns the number of rows removed."""
+
+    removed = 0
+    for model, kind_a, column_a, kind_b, column_b in ASSOCIATIONS:
+        column_a, column_b = getattr(model, column_a), getattr(model, column_b)
+        first = (
+            db.session.query(func.min(model.id)).group_by(column_a, column_b).subquery()
+        )
+
+        if model is PlantLists_Plants:
+            kept = aliased(PlantLists_Plants)
+            duplicate = aliased(PlantLists_Plants)
+            kept_id = (
+                db.session.query(func.min(kept.id))
+                .filter(
+                    kept.plantlist_id == duplicate.plantlist_id,
+                    kept.plant_id == duplicate.plant_id,
+                    duplicate.id == Plot_Cells_Symbols.plantlists_plants_id,
+                )
+                .as_scalar()
+            )
+            Plot_Cells_Symbols.query.filter(
+                ~Plot_Cells_Symbols.plantlists_plants_id.in_(first)
+            ).update(
+                {Plot_Cells_Symbols.plantlists_plants_id: kept_id},
+                synchronize_session=False,
+            )
+
+        count = model.query.filter(~model.id.in_(first)).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        if create_indexes:
+            create_missing_indexes(model)
+
+        logging.info(f"Removed {count} duplicate {model.__tablename__} rows")
+        removed += count
+
+    return removed
+
+
+def dedupe_symbols(create_indexes=True):
+    """Removes duplicate symbols, keeping the first row for each hash, then
+    adds the unique hash index if it's missing.
+
+    Before the index existed, two requests adding the same symbol could both
+    create it. Plant list plants using a duplicate are moved to the symbol
+    that's kept. Symbols with no hash yet are left alone; migrations.py fills
+    them in first, and passes create_indexes=False to build the index itself.
+    Returns the number of rows removed."""
+
+    first = (
+        db.session.query(func.min(Symbol.id))
+        .filter(Symbol.hash.isnot(None))
+        .group_by(Symbol.hash)
+        .subquery()
+    )
+    kept = aliased(Symbol)
+    duplicate = aliased(Symbol)
+    kept_id = (
+        db.session.query(func.min(kept.id))
+        .filter(
+            kept.hash == duplicate.hash, duplicate.id == PlantLists_Plants.symbol_id,
+        )
+        .as_scalar()
+    )
+    duplicates = db.session.query(Symbol.id).filter(
+        Symbol.hash.isnot(None), ~Symbol.id.in_(first)
+    )
+
+    PlantLists_Plants.query.filter(
+        PlantLists_Plants.symbol_id.in_(duplicates.subquery())
+    ).update({PlantLists_Plants.symbol_id: kept_id}, synchronize_session=False)
+    removed = Symbol.query.filter(
+        Symbol.hash.isnot(None), ~Symbol.id.in_(first)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    if create_indexes:
+        create_missing_indexes(Symbol)
+
+    logging.info(f"Removed {removed} duplicate symbols")
+    return removed
+
+
+TASKS = {
+    "compact-plot-cells": compact_plot_cells,
+    "dedupe-links": dedupe_links,
+    "dedupe-symbols": dedupe_symbols,
+}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Run a database maintenance task.")
+    parser.add_argument("task", choices=sorted(TASKS))
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    print(f"{args.task}: {TASKS[args.task]()}")
@@ -0,0 +1,487 @@
+"""Versioned schema migrations.
+
+The database used to be built by seed.py with drop_all/create_all, which
+can't change a database that already holds data. Migrations listed here are
+applied in order, and each is recorded in the schema_migrations table so it
+only runs once per database.
+
+Every step checks the schema before changing it, so a migration that fails
+part way through can simply be run again. On Postgres indexes are built with
+CREATE INDEX CONCURRENTLY, which doesn't block writes to the table while it
+runs; that can't be done inside a transaction, so each step commits on its
+own. Backfills update rows in batches, one transaction per batch, so they
+never hold locks on a large part of a table.
+
+Usage:
+    python migrations.py             # apply pending migrations
+    python migrations.py --dry-run   # print what would be done
+    python migrations.py --status
+"""
+
+import logging
+import re
+from datetime import datetime
+from functools import partial
+
+from sqlalchemy import bindparam, func, inspect, select, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from maintenance import compact_plot_cells, dedupe_links, dedupe_symbols
+from models import (
+    db,
+    genus_of,
+    symbol_hash,
+    ASSOCIATIONS,
+    Plant,
+    Plot_Cells_Symbols,
+    Symbol,
+    PLANT_SEARCH_FTS,
+    PLANT_SEARCH_INDEXES,
+)
+
+BATCH_SIZE = 1000
+
+schema_migrations = db.Table(
+    "schema_migrations",
+    db.Column("version", db.Text, primary_key=True),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+
+def has_table(conn, table):
+    return conn.dialect.has_table(conn, table)
+
+
+class CreateTables:
+    """Creates any tables that don't exist yet, with all their columns and
+    indexes. On a new database this is the whole schema."""
+
+    def plan(self, conn):
+        return [
+            f"CREATE TABLE {table.name}"
+            for table in db.metadata.sorted_tables
+            if not has_table(conn, table.name)
+        ]
+
+    def run(self, engine):
+        db.metadata.create_all(bind=engine, checkfirst=True)
+
+
+class AddColumn:
+    """Adds a column from the models to an existing table."""
+
+    def __init__(self, table, name):
+        self.table = table
+        self.column = table.columns[name]
+
+    def plan(self, conn):
+        if not has_table(conn, self.table.name):
+            return []
+        columns = {
+            column["name"] for column in inspect(conn).get_columns(self.table.name)
+        }
+        if self.column.name in columns:
+            return []
+
+        definition = CreateColumn(self.column).compile(dialect=conn.dialect)
+        return [f"ALTER TABLE {self.table.name} ADD COLUMN {definition}"]
+
+    def run(self, engine):
+        with engine.begin() as conn:
+            for statement in self.plan(conn):
+                conn.execute(statement)
+
+
+class AddIndex:
+    """Builds an index from the models, concurrently on Postgres.
+
+    A CREATE INDEX CONCURRENTLY that fails leaves an invalid index behind under
+    the same name, which Postgres maintains but never uses. Such an index is
+    dropped and built again rather than taken as done."""
+
+    def __init__(self, index):
+        self.index = index
+        self.name = index.name
+        self.table = index.table.name
+
+    def create_statement(self, conn):
+        return str(CreateIndex(self.index).compile(dialect=conn.dialect))
+
+    def plan(self, conn):
+        if not has_table(conn, self.table):
+            return []
+
+        statements = []
+        if conn.dialect.name == "postgresql":
+            valid = conn.execute(
+                text(
+                    "SELECT indisvalid FROM pg_index "
+                    "WHERE indexrelid = to_regclass(:name)"
+                ),
+                name=self.name,
+            ).scalar()
+            if valid:
+                return []
+            if valid is not None:
+                statements.append(f"DROP INDEX CONCURRENTLY {self.name}")
+        elif any(
+            index["name"] == self.name
+            for index in inspect(conn).get_indexes(self.table)
+        ):
+            return []
+
+        statement = self.create_statement(conn)
+        if conn.dialect.name == "postgresql":
+            statement = statement.replace("INDEX ", "INDEX CONCURRENTLY ", 1)
+        return statements + [statement]
+
+    def run(self, engine):
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            for statement in self.plan(conn):
+                conn.execute(statement)
+
+
+class AddPostgresIndex(AddIndex):
+    """Builds an index the models only create on Postgres with raw DDL, such
+    as the search indexes over expressions."""
+
+    def __init__(self, ddl):
+        match = re.match(r"CREATE INDEX (\w+) ON (\w+)", ddl)
+        self.ddl = ddl
+        self.name, self.table = match.groups()
+
+    def create_statement(self, conn):
+        return self.ddl
+
+    def plan(self, conn):
+        if conn.dialect.name != "postgresql":
+            return []
+        return super().plan(conn)
+
+
+class AddSQLiteSearch:
+    """Creates a table or trigger of the SQLite full text search over plants,
+    which the models only create along with the plants table. A new search
+    table is filled from the rows already there."""
+
+    def __init__(self, ddl):
+        match = re.match(r"CREATE (VIRTUAL TABLE|TRIGGER) (\w+)", ddl)
+        self.ddl = ddl
+        self.kind, self.name = match.groups()
+
+    def plan(self, conn):
+        if conn.dialect.name != "sqlite" or not has_table(conn, "plants"):
+            return []
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"), name=self.name
+        ).scalar()
+        if exists:
+            return []
+        if self.kind == "TRIGGER":
+            return [self.ddl]
+        return [
+            self.ddl,
+            f"INSERT INTO {self.name}({self.name}) VALUES ('rebuild')",
+        ]
+
+    def run(self, engine):
+        with engine.connect() as conn:
+            for statement in self.plan(conn):
+                conn.execute(statement)
+
+
+class RunSQL:
+    """Runs statements that are safe to repeat, optionally on one dialect only,
+    outside a transaction."""
+
+    def __init__(self, *statements, dialect=None):
+        self.statements = statements
+        self.dialect = dialect
+
+    def plan(self, conn):
+        if self.dialect and conn.dialect.name != self.dialect:
+            return []
+        return list(self.statements)
+
+    def run(self, engine):
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            for statement in self.plan(conn):
+                conn.execute(statement)
+
+
+class Backfill:
+    """Updates rows in batches, walking the table in id order.
+
+    `batch(conn, after_id, batch_size)` updates the next rows after `after_id`
+    and returns the last id it looked at, or None once there are none left.
+    `pending(conn)` counts the rows still to do."""
+
+    def __init__(self, description, table, batch, pending, batch_size=BATCH_SIZE):
+        self.description = description
+        self.table = table
+        self.batch = batch
+        self.pending = pending
+        self.batch_size = batch_size
+
+    def plan(self, conn):
+        if not has_table(conn, self.table.name):
+            return []
+        count = self.pending(conn)
+        if not count:
+            return []
+        return [f"{self.description}: {count} rows, {self.batch_size} per batch"]
+
+    def run(self, engine):
+        after_id = 0
+        while after_id is not None:
+            with engine.begin() as conn:
+                after_id = self.batch(conn, after_id, self.batch_size)
+
+
+class Task:
+    """Runs a maintenance function, such as removing duplicate rows before a
+    unique index is built."""
+
+    def __init__(self, description, func):
+        self.description = description
+        self.func = func
+
+    def plan(self, conn):
+        return [self.description]
+
+    def run(self, engine):
+        self.func()
+
+
+class Migration:
+    def __init__(self, version, description, steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+def plants_missing_genus():
+    plants = Plant.__table__
+    return plants.c.genus.is_(None) & plants.c.scientific_name.isnot(None)
+
+
+def count_plants_missing_genus(conn):
+    query = select([func.count()]).where(plants_missing_genus())
+    return conn.execute(query).scalar()
+
+
+def backfill_plant_genus(conn, after_id, batch_size):
+    """Sets the genus of plants saved from Trefle search results, which only
+    have a scientific name, to its first word."""
+
+    plants = Plant.__table__
+    rows = conn.execute(
+        select([plants.c.id, plants.c.scientific_name])
+        .where(plants_missing_genus() & (plants.c.id > after_id))
+        .order_by(plants.c.id)
+        .limit(batch_size)
+    ).fetchall()
+    if not rows:
+        return None
+
+    updates = [
+        {"plant_id": id, "genus": genus_of(scientific_name)}
+        for id, scientific_name in rows
+        if genus_of(scientific_name)
+    ]
+    if updates:
+        conn.execute(
+            plants.update()
+            .where(plants.c.id == bindparam("plant_id"))
+            .values(genus=bindparam("genus")),
+            updates,
+        )
+    return rows[-1].id
+
+
+def count_symbols_missing_hash(conn):
+    symbols = Symbol.__table__
+    query = select([func.count()]).where(symbols.c.hash.is_(None))
+    return conn.execute(query).scalar()
+
+
+def backfill_symbol_hash(conn, after_id, batch_size):
+    symbols = Symbol.__table__
+    rows = conn.execute(
+        select([symbols.c.id, symbols.c.symbol])
+        .where(symbols.c.hash.is_(None) & (symbols.c.id > after_id))
+        .order_by(symbols.c.id)
+        .limit(batch_size)
+    ).fetchall()
+    if not rows:
+        return None
+
+    conn.execute(
+        symbols.update()
+        .where(symbols.c.id == bindparam("symbol_id"))
+        .values(hash=bindparam("hash")),
+        [{"symbol_id": id, "hash": symbol_hash(symbol)} for id, symbol in rows],
+    )
+    return rows[-1].id
+
+
+CATALOG_COLUMNS = [
+    "genus",
+    "year",
+    "author",
+    "rank",
+    "status",
+    "synced_at",
+    "flower_color_bits",
+    "growth_months_bits",
+    "bloom_months_bits",
+    "fruit_months_bits",
+    "edible_part_bits",
+    "duration_bits",
+    "ligneous_type",
+    "vegetable",
+    "leaf_retention",
+]
+
+MIGRATIONS = [
+    Migration("0001", "Create tables", [CreateTables()]),
+    Migration(
+        "0002",
+        "Plant catalog, facet and search columns and indexes",
+        [AddColumn(Plant.__table__, name) for name in CATALOG_COLUMNS]
+        + [AddIndex(index) for index in Plant.__table__.indexes]
+        + [RunSQL("CREATE EXTENSION IF NOT EXISTS pg_trgm", dialect="postgresql")]
+        + [AddPostgresIndex(ddl) for ddl in PLANT_SEARCH_INDEXES],
+    ),
+    Migration(
+        "0003",
+        "Backfill plant genus from scientific name",
+        [
+            Backfill(
+                "Set plant genus",
+                Plant.__table__,
+                backfill_plant_genus,
+                count_plants_missing_genus,
+            )
+        ],
+    ),
+    Migration(
+        "0004",
+        "One row per plot cell",
+        [
+            Task(
+                "Remove duplicate plot cells",
+                partial(compact_plot_cells, create_indexes=False),
+            )
+        ]
+        + [AddIndex(index) for index in Plot_Cells_Symbols.__table__.indexes],
+    ),
+    Migration(
+        "0005",
+        "Unique and reverse indexes on association tables",
+        [Task("Remove duplicate links", partial(dedupe_links, create_indexes=False))]
+        + [
+            AddIndex(index)
+            for model, *kinds in ASSOCIATIONS
+            for index in model.__table__.indexes
+        ],
+    ),
+    Migration(
+        "0006",
+        "Symbols keyed by a unique hash",
+        [
+            AddColumn(Symbol.__table__, "hash"),
+            Backfill(
+                "Set symbol hash",
+                Symbol.__table__,
+                backfill_symbol_hash,
+                count_symbols_missing_hash,
+            ),
+            Task(
+                "Remove duplicate symbols",
+                partial(dedupe_symbols, create_indexes=False),
+            ),
+        ]
+        + [AddIndex(index) for index in Symbol.__table__.indexes],
+    ),
+    Migration(
+        "0007",
+        "Plant full text search on SQLite",
+        [AddSQLiteSearch(ddl) for ddl in PLANT_SEARCH_FTS],
+    ),
+]
+
+
+def applied_versions(engine):
+    with engine.connect() as conn:
+        if not has_table(conn, schema_migrations.name):
+            return set()
+        return {
+            version for version, in conn.execute(select([schema_migrations.c.version]))
+        }
+
+
+def pending_migrations(migrations=MIGRATIONS):
+    applied = applied_versions(db.engine)
+    return [migration for migration in migrations if migration.version not in applied]
+
+
+def migrate(dry_run=False, migrations=MIGRATIONS, out=print):
+    """Applies pending migrations in order, or with dry_run only prints what
+    they would do. Returns the versions that were (or would be) applied."""
+
+    engine = db.engine
+    pending = pending_migrations(migrations)
+
+    if not dry_run:
+        schema_migrations.create(bind=engine, checkfirst=True)
+
+    for migration in pending:
+        out(f"{migration.version} {migration.description}")
+
+        if dry_run:
+            with engine.connect() as conn:
+                for step in migration.steps:
+                    for line in step.plan(conn):
+                        out(f"    {line}")
+            continue
+
+        for step in migration.steps:
+            step.run(engine)
+        with engine.begin() as conn:
+            conn.execute(
+                schema_migrations.insert().values(
+                    version=migration.version, applied_at=datetime.utcnow()
+                )
+            )
+        logging.info(f"Applied migration {migration.version}")
+
+    return [migration.version for migration in pending]
+
+
+def status(migrations=MIGRATIONS, out=print):
+    applied = applied_versions(db.engine)
+    for migration in migrations:
+        state = "applied" if migration.version in applied else "pending"
+        out(f"{migration.version} {state:8} {migration.description}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Apply database migrations.")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan only")
+    parser.add_argument("--status", action="store_true", help="list migrations")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    if args.status:
+        status()
+    else:
+        pending = migrate(dry_run=args.dry_run)
+        if not pending:
+            print("No pending migrations.")
@@ -1,31 +1,73 @@
 """SQLAlchemy models for Plot Planner."""
 
+import hashlib
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, bindparam, event, or_
+from sqlalchemy.dialects import postgresql
+
+from passwords import password_hasher, PasswordHasherBusy
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 default_plant_pic = "/static/images/default-pic.png"
 default_plant_symbol = "<i class='symbol fas fa-seedling' style='color:#228B22;'></i>"
 
 
+def bitset_column():
+    """Integer column holding a set of choices, one bit per choice."""
+
+    return db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+
+def genus_of(scientific_name):
+    """The genus in a scientific name, e.g. "Rosa" in "Rosa canina"."""
+
+    words = (scientific_name or "").split()
+    return words[0] if words else None
+
+
 class Plant(db.Model):
     """Plant Model - Not user specific. This is based of trefle API data and is a much shortened version for displaying basics on a plant list and plot design.
+    Also serves as the local catalog mirror of Trefle, filled in bulk by catalog.py.
     Methods for adding a new plant."""
 
     __tablename__ = "plants"
 
     id = db.Column(db.Integer, primary_key=True)
     trefle_id = db.Column(db.Integer, nullable=False, unique=True)
-    slug = db.Column(db.Text, nullable=False)
+    slug = db.Column(db.Text, nullable=False, index=True)
     common_name = db.Column(db.Text)
     scientific_name = db.Column(db.Text)
     family = db.Column(db.Text)
     family_common_name = db.Column(db.Text)
     image_url = db.Column(db.Text)
 
+    # Catalog columns, only set for plants imported from a Trefle dump
+    genus = db.Column(db.Text)
+    year = db.Column(db.Integer)
+    author = db.Column(db.Text)
+    rank = db.Column(db.Text)
+    status = db.Column(db.Text)
+    synced_at = db.Column(db.DateTime)
+
+    # Filterable attributes, stored compactly for facets.py. The *_bits columns are
+    # bitsets over the matching choices in forms.py, ligneous_type is the index of
+    # its choice.
+    flower_color_bits = bitset_column()
+    growth_months_bits = bitset_column()
+    bloom_months_bits = bitset_column()
+    fruit_months_bits = bitset_column()
+    edible_part_bits = bitset_column()
+    duration_bits = bitset_column()
+    ligneous_type = db.Column(db.SmallInteger, index=True)
+    vegetable = db.Column(
+        db.Boolean, nullable=False, default=False, server_default=db.false()
+    )
+    leaf_retention = db.Column(
+        db.Boolean, nullable=False, default=False, server_default=db.false()
+    )
+
     @classmethod
     def add(
         cls,
@@ -47,12 +89,81 @@ class Plant(db.Model):
             family=family,
             family_common_name=family_common_name,
             image_url=image_url,
+            genus=genus_of(scientific_name),
         )
 
         db.session.add(plant)
 
         return plant
 
+    def serialize(self):
+        """Returns plant in the same shape as a Trefle plant list item."""
+
+        return {
+            "id": self.trefle_id,
+            "slug": self.slug,
+            "common_name": self.common_name,
+            "scientific_name": self.scientific_name,
+            "family": self.family,
+            "family_common_name": self.family_common_name,
+            "genus": self.genus,
+            "year": self.year,
+            "author": self.author,
+            "rank": self.rank,
+            "status": self.status,
+            "image_url": self.image_url,
+        }
+
+
+# Text search over plant names. On Postgres this is a GIN index over a tsvector of
+# the name columns plus trigram indexes for typo tolerance; on SQLite (tests) an
+# FTS5 table kept in sync with triggers. catalog.text_search uses whichever exists.
+PLANT_SEARCH_DOCUMENT = (
+    "coalesce(common_name, '') || ' ' || coalesce(scientific_name, '') || ' ' || "
+    "coalesce(family, '') || ' ' || coalesce(family_common_name, '')"
+)
+PLANT_SEARCH_COLUMNS = "common_name, scientific_name, family, family_common_name"
+
+event.listen(
+    Plant.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+PLANT_SEARCH_INDEXES = [
+    f"CREATE INDEX ix_plants_search_document ON plants USING gin (to_tsvector('simple', {PLANT_SEARCH_DOCUMENT}))",
+    "CREATE INDEX ix_plants_common_name_trgm ON plants USING gin (lower(common_name) gin_trgm_ops)",
+    "CREATE INDEX ix_plants_scientific_name_trgm ON plants USING gin (lower(scientific_name) gin_trgm_ops)",
+]
+for ddl in PLANT_SEARCH_INDEXES:
+    event.listen(
+        Plant.__table__, "after_create", DDL(ddl).execute_if(dialect="postgresql")
+    )
+
+PLANT_SEARCH_FTS = [
+    f"CREATE VIRTUAL TABLE plants_fts USING fts5({PLANT_SEARCH_COLUMNS}, content='plants', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    f"""CREATE TRIGGER plants_fts_insert AFTER INSERT ON plants BEGIN
+        INSERT INTO plants_fts(rowid, {PLANT_SEARCH_COLUMNS})
+        VALUES (new.id, new.common_name, new.scientific_name, new.family, new.family_common_name);
+    END""",
+    f"""CREATE TRIGGER plants_fts_delete AFTER DELETE ON plants BEGIN
+        INSERT INTO plants_fts(plants_fts, rowid, {PLANT_SEARCH_COLUMNS})
+        VALUES ('delete', old.id, old.common_name, old.scientific_name, old.family, old.family_common_name);
+    END""",
+    f"""CREATE TRIGGER plants_fts_update AFTER UPDATE ON plants BEGIN
+        INSERT INTO plants_fts(plants_fts, rowid, {PLANT_SEARCH_COLUMNS})
+        VALUES ('delete', old.id, old.common_name, old.scientific_name, old.family, old.family_common_name);
+        INSERT INTO plants_fts(rowid, {PLANT_SEARCH_COLUMNS})
+        VALUES (new.id, new.common_name, new.scientific_name, new.family, new.family_common_name);
+    END""",
+]
+for ddl in PLANT_SEARCH_FTS:
+    event.listen(Plant.__table__, "after_create", DDL(ddl).execute_if(dialect="sqlite"))
+event.listen(
+    Plant.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS plants_fts").execute_if(dialect="sqlite"),
+)
+
 
 class User(db.Model):
     """User Model - handles users in the database.
@@ -81,7 +192,7 @@ class User(db.Model):
         """Sign up user. Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(username=username, email=email, password=hashed_pwd)
 
@@ -96,13 +207,23 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        Hashes made with an outdated work factor are replaced by one made with
+        the current factor.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    try:
+                        user.password = password_hasher.hash(password)
+                        db.session.commit()
+                    except PasswordHasherBusy:
+                        # Rehashed on a later login instead
+                        pass
                 return user
 
         return False
@@ -229,6 +350,15 @@ class Plot(db.Model):
         db.session.commit()
 
 
+def symbol_hash(symbol):
+    return hashlib.sha256(symbol.encode("UTF-8")).hexdigest()
+
+
+def hash_default(context):
+    symbol = context.get_current_parameters().get("symbol")
+    return symbol_hash(symbol or default_plant_symbol)
+
+
 class Symbol(db.Model):
     """Symbol to represent a plant within a plot design."""
 
@@ -236,6 +366,8 @@ class Symbol(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     symbol = db.Column(db.Text, nullable=False, default=default_plant_symbol)
+    # Hash of the symbol HTML, so each symbol is stored once and found by index
+    hash = db.Column(db.String(64), unique=True, index=True, default=hash_default)
 
     def __repr__(self):
         # return f"<Symbol(id={self.id})>"
@@ -252,10 +384,21 @@ class Symbol(db.Model):
         return symbol
 
 
+def association_indexes(table, column, other_column):
+    """Indexes for a through table: a unique one on the pair of linked ids, so
+    each link is stored once, and one for looking links up from the other side."""
+
+    return (
+        db.Index(f"{table}_link_idx", column, other_column, unique=True),
+        db.Index(f"{table}_{other_column}_idx", other_column),
+    )
+
+
 class Users_Projects(db.Model):
     """Through table for user's projects."""
 
     __tablename__ = "users_projects"
+    __table_args__ = association_indexes("users_projects", "user_id", "project_id")
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -266,6 +409,7 @@ class Users_PlantLists(db.Model):
     """Through table for user's plant lists."""
 
     __tablename__ = "users_plantlists"
+    __table_args__ = association_indexes("users_plantlists", "user_id", "plantlist_id")
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -276,6 +420,7 @@ class Users_Plots(db.Model):
     """Through table for user's plots."""
 
     __tablename__ = "users_plots"
+    __table_args__ = association_indexes("users_plots", "user_id", "plot_id")
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -286,6 +431,9 @@ class Projects_PlantLists(db.Model):
     """Through table for projects' plants lists."""
 
     __tablename__ = "projects_plantlists"
+    __table_args__ = association_indexes(
+        "projects_plantlists", "project_id", "plantlist_id"
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey("projects.id"))
@@ -296,6 +444,7 @@ class Projects_Plots(db.Model):
     """Through table for projects' plots."""
 
     __tablename__ = "projects_plots"
+    __table_args__ = association_indexes("projects_plots", "project_id", "plot_id")
 
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey("projects.id"))
@@ -306,6 +455,7 @@ class Plots_PlantLists(db.Model):
     """Through table for plot's lists."""
 
     __tablename__ = "plots_plantlists"
+    __table_args__ = association_indexes("plots_plantlists", "plot_id", "plantlist_id")
 
     id = db.Column(db.Integer, primary_key=True)
     plot_id = db.Column(db.Integer, db.ForeignKey("plots.id"))
@@ -313,9 +463,21 @@ class Plots_PlantLists(db.Model):
 
 
 class Plot_Cells_Symbols(db.Model):
-    """Plot cell and plant symbol map."""
+    """Plot cell and plant symbol map. Each cell of a plot has at most one row."""
 
     __tablename__ = "plot_cells_symbols"
+    __table_args__ = (
+        db.Index(
+            "plot_cells_symbols_plot_cell_idx",
+            "plot_id",
+            "cell_x",
+            "cell_y",
+            unique=True,
+        ),
+    )
+
+    # Rows per upsert statement, well under Postgres' and SQLite's bind limits
+    UPSERT_CHUNK_SIZE = 1000
 
     id = db.Column(db.Integer, primary_key=True)
     plot_id = db.Column(
@@ -333,24 +495,125 @@ class Plot_Cells_Symbols(db.Model):
     def add(
         cls, plot_id, cell_x, cell_y, plantlists_plants_id,
     ):
-        """Adds new plot for user."""
+        """Sets the symbol of a plot cell, replacing any it already had."""
+
+        cls.upsert(plot_id, [(cell_x, cell_y, plantlists_plants_id)])
 
-        plot_cells_symbols = Plot_Cells_Symbols(
-            plot_id=plot_id,
-            plantlists_plants_id=plantlists_plants_id,
-            cell_x=cell_x,
-            cell_y=cell_y,
+        return cls.query.filter_by(plot_id=plot_id, cell_x=cell_x, cell_y=cell_y).one()
+
+    @classmethod
+    def upsert(cls, plot_id, cells):
+        """Inserts (cell_x, cell_y, plantlists_plants_id) rows for a plot, updating
+        cells that already have a row. Each cell should appear only once."""
+
+        rows = [
+            dict(
+                plot_id=plot_id,
+                cell_x=cell_x,
+                cell_y=cell_y,
+                plantlists_plants_id=plantlists_plants_id,
+            )
+            for cell_x, cell_y, plantlists_plants_id in cells
+        ]
+        if not rows:
+            return
+
+        if db.session.get_bind().dialect.name != "postgresql":
+            cls.update_then_insert(plot_id, rows)
+            return
+
+        for i in range(0, len(rows), cls.UPSERT_CHUNK_SIZE):
+            stmt = postgresql.insert(cls.__table__).values(
+                rows[i : i + cls.UPSERT_CHUNK_SIZE]
+            )
+            db.session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["plot_id", "cell_x", "cell_y"],
+                    set_={"plantlists_plants_id": stmt.excluded.plantlists_plants_id},
+                )
+            )
+
+    @classmethod
+    def update_then_insert(cls, plot_id, rows):
+        """Portable upsert for databases without ON CONFLICT: updates the cells
+        that have a row in place, keeping their ids, then inserts the rest.
+
+        Unlike the Postgres upsert this isn't atomic; a concurrent insert of the
+        same cell fails on the unique index instead of being merged."""
+
+        existing = set(
+            db.session.query(cls.cell_x, cls.cell_y).filter(
+                cls.plot_id == plot_id, cls.cell_x.in_({row["cell_x"] for row in rows}),
+            )
         )
+        updates = [row for row in rows if (row["cell_x"], row["cell_y"]) in existing]
+        inserts = [
+            row for row in rows if (row["cell_x"], row["cell_y"]) not in existing
+        ]
+
+        if updates:
+            table = cls.__table__
+            db.session.execute(
+                table.update()
+                .where(
+                    and_(
+                        table.c.plot_id == bindparam("b_plot_id"),
+                        table.c.cell_x == bindparam("b_cell_x"),
+                        table.c.cell_y == bindparam("b_cell_y"),
+                    )
+                )
+                .values(plantlists_plants_id=bindparam("b_plantlists_plants_id")),
+                [{f"b_{key}": value for key, value in row.items()} for row in updates],
+            )
+        for i in range(0, len(inserts), cls.UPSERT_CHUNK_SIZE):
+            db.session.execute(
+                cls.__table__.insert().values(inserts[i : i + cls.UPSERT_CHUNK_SIZE])
+            )
 
-        db.session.add(plot_cells_symbols)
+    @classmethod
+    def apply(cls, plot_id, cells):
+        """Sets or clears many cells of a plot at once.
+
+        `cells` maps (cell_x, cell_y) to a plantlists_plants id, or to None to
+        clear the cell. Cleared cells are removed with one delete and set cells
+        upserted in bulk; the caller commits. Returns the number of cells set
+        and cleared."""
+
+        cleared = [cell for cell, plp_id in cells.items() if plp_id is None]
+        cols = {}
+        for cell_x, cell_y in cleared:
+            cols.setdefault(cell_x, []).append(cell_y)
+
+        if cols:
+            cls.query.filter(
+                cls.plot_id == plot_id,
+                or_(
+                    *[
+                        and_(cls.cell_x == cell_x, cls.cell_y.in_(cell_ys))
+                        for cell_x, cell_ys in cols.items()
+                    ]
+                ),
+            ).delete(synchronize_session=False)
+
+        cls.upsert(
+            plot_id,
+            [
+                (cell_x, cell_y, plp_id)
+                for (cell_x, cell_y), plp_id in cells.items()
+                if plp_id is not None
+            ],
+        )
 
-        return plot_cells_symbols
+        return len(cells) - len(cleared), len(cleared)
 
 
 class PlantLists_Plants(db.Model):
     """Through table for plant lists's plants. Also handles specific symbol for a plant, for each plantlist."""
 
     __tablename__ = "plantlists_plants"
+    __table_args__ = association_indexes(
+        "plantlists_plants", "plantlist_id", "plant_id"
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     plantlist_id = db.Column(db.Integer, db.ForeignKey("plantlists.id"))
@@ -371,6 +634,34 @@ class PlantLists_Plants(db.Model):
         db.session.commit()
 
 
+# Models of the content users make, by the name of their collections
+CONTENT_MODELS = {"projects": Project, "plots": Plot, "plantlists": PlantList}
+
+# Through tables linking two kinds of record, as (model, first kind, its id
+# column, second kind, its id column)
+ASSOCIATIONS = [
+    (Users_Projects, "users", "user_id", "projects", "project_id"),
+    (Users_Plots, "users", "user_id", "plots", "plot_id"),
+    (Users_PlantLists, "users", "user_id", "plantlists", "plantlist_id"),
+    (Projects_Plots, "projects", "project_id", "plots", "plot_id"),
+    (Projects_PlantLists, "projects", "project_id", "plantlists", "plantlist_id"),
+    (Plots_PlantLists, "plots", "plot_id", "plantlists", "plantlist_id"),
+    (PlantLists_Plants, "plantlists", "plantlist_id", "plants", "plant_id"),
+]
+
+
+def association(kind, other_kind):
+    """Returns (through model, id column for kind, id column for other_kind)
+    for two kinds of record, e.g. ("projects", "plots")."""
+
+    for model, kind_a, column_a, kind_b, column_b in ASSOCIATIONS:
+        if (kind_a, kind_b) == (kind, other_kind):
+            return model, getattr(model, column_a), getattr(model, column_b)
+        if (kind_b, kind_a) == (kind, other_kind):
+            return model, getattr(model, column_b), getattr(model, column_a)
+    raise KeyError(f"No association between {kind} and {other_kind}")
+
+
 def connect_db(app):
     """Connect this database to provided Flask app."""
 
@@ -0,0 +1,171 @@
+"""Password hashing off the request greenlets.
+
+bcrypt is deliberately slow: hashing or checking a password at the default
+cost takes 100-300ms of CPU. That work is run on a small, per-worker pool of
+OS threads (bcrypt releases the GIL, so the pool runs in parallel with the
+worker's event loop, which keeps serving other requests), and at most
+`workers + queue_size` password operations can be running or waiting at a
+time. Past that, callers get PasswordHasherBusy straight away instead of
+queueing, so a burst of logins can't tie up the workers serving everything
+else.
+
+The pool bounds hashing within a worker process, but together the workers on
+the box could still run more hashes than there are CPUs. So with `lock_dir`
+set, a password operation also has to hold one of `host_slots` flocked lock
+files there, shared by every worker on the box, or the caller gets
+PasswordHasherBusy after the same timeout.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made with another cost
+are rehashed the next time their user logs in."""
+
+import fcntl
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+from gevent import monkey
+from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+
+
+def thread_pool(workers, name):
+    """A pool of OS threads. Under gevent's workers, threading makes greenlets,
+    which would run bcrypt on the event loop, so gevent's own pool is used."""
+
+    if monkey.is_module_patched("threading"):
+        return NativeThreadPoolExecutor(workers)
+    return ThreadPoolExecutor(workers, thread_name_prefix=name)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many passwords are already being hashed or checked."""
+
+
+class HostSlots:
+    """At most `count` holders at a time across all processes on the box, each
+    holding an flock on one of `count` lock files."""
+
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, lock_dir, count):
+        self.paths = [
+            os.path.join(lock_dir, f"passwords-{i:02d}.lock") for i in range(count)
+        ]
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def acquire(self, timeout):
+        """Returns the fd of the slot taken, or None after `timeout` seconds."""
+
+        deadline = time.monotonic() + timeout
+        while True:
+            # Start at a random slot so waiters don't all pile onto the first
+            start = random.randrange(len(self.paths))
+            for path in self.paths[start:] + self.paths[:start]:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded thread pool."""
+
+    def __init__(
+        self,
+        rounds=12,
+        workers=2,
+        queue_size=8,
+        timeout=1,
+        lock_dir=None,
+        host_slots=None,
+    ):
+        self.bcrypt = Bcrypt()
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        self.configure(rounds, workers, queue_size, timeout, lock_dir, host_slots)
+
+    def configure(
+        self,
+        rounds=12,
+        workers=2,
+        queue_size=8,
+        timeout=1,
+        lock_dir=None,
+        host_slots=None,
+    ):
+        """`timeout` is how long a caller may wait for a free slot, in seconds.
+        `host_slots` defaults to the number of CPUs."""
+
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self.host_slots = (
+            HostSlots(lock_dir, host_slots or os.cpu_count() or 1) if lock_dir else None
+        )
+
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def executor(self):
+        """Thread pool for the current process, as threads don't survive gunicorn
+        forking its workers."""
+
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._executor_lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = thread_pool(self.workers, "passwords")
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def run(self, func, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy("Too many password checks in progress")
+        try:
+            if self.host_slots is None:
+                return self.executor.submit(func, *args).result()
+
+            fd = self.host_slots.acquire(self.timeout)
+            if fd is None:
+                raise PasswordHasherBusy("Too many password checks on this host")
+            try:
+                return self.executor.submit(func, *args).result()
+            finally:
+                self.host_slots.release(fd)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Returns the bcrypt hash of a password, as text."""
+
+        hashed = self.run(self.bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode("UTF-8")
+
+    def check(self, hashed, password):
+        return self.run(self.bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """True if the hash wasn't made with the configured work factor."""
+
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
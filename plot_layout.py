@@ -0,0 +1,183 @@
+"""Compact plot layouts.
+
+A layout is a palette of the distinct plantlists_plants ids painted on a plot
+plus a row-major grid of palette indexes, one unsigned 16 bit value per cell,
+where 0 is an empty cell and i is palette[i - 1]. Grids are run-length encoded
+as (value, run length) pairs, so a 200x200 plot painted with a few plants is a
+handful of bytes rather than 40,000 rows of cell JSON.
+
+The plot_cells_symbols rows stay the source of truth; layouts are built from
+them in one query and are cheap to store or send as bytes."""
+
+import base64
+import sys
+from array import array
+
+from markupsafe import Markup, escape
+
+from models import db, Plot_Cells_Symbols, PlantLists_Plants
+from symbols import symbol_cache
+
+EMPTY = 0
+MAX_RUN = 0xFFFF
+# Palette indexes are stored as uint16, and 0 means empty
+MAX_PALETTE = 0xFFFF
+
+
+def encode_rle(grid):
+    """Run-length encodes a sequence of uint16 values as (value, run) pairs."""
+
+    pairs = array("H")
+    value, run = None, 0
+    for cell in grid:
+        if cell == value and run < MAX_RUN:
+            run += 1
+            continue
+        if run:
+            pairs.extend((value, run))
+        value, run = cell, 1
+    if run:
+        pairs.extend((value, run))
+    return pairs
+
+
+def decode_rle(pairs):
+    grid = array("H")
+    for i in range(0, len(pairs), 2):
+        grid.extend(array("H", [pairs[i]]) * pairs[i + 1])
+    return grid
+
+
+def to_bytes(values):
+    """Little-endian bytes of a uint16 array, whatever the platform."""
+
+    if sys.byteorder != "little":
+        values = array("H", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_bytes(data):
+    values = array("H")
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+class PlotLayout:
+    """Palette and grid of a plot's painted cells."""
+
+    def __init__(self, width, length, palette=None, grid=None):
+        self.width = width
+        self.length = length
+        self.palette = list(palette or [])
+        self.grid = grid if grid is not None else array("H", [EMPTY]) * (width * length)
+
+    @classmethod
+    def load(cls, plot):
+        """Builds the layout of a plot from its cells in one query.
+
+        Cells outside the plot, left over from before it was resized, are
+        skipped."""
+
+        layout = cls(plot.width, plot.length)
+        indexes = {}
+
+        cells = db.session.query(
+            Plot_Cells_Symbols.cell_x,
+            Plot_Cells_Symbols.cell_y,
+            Plot_Cells_Symbols.plantlists_plants_id,
+        ).filter(Plot_Cells_Symbols.plot_id == plot.id)
+
+        for cell_x, cell_y, plantlists_plants_id in cells:
+            if not (0 <= cell_x < layout.width and 0 <= cell_y < layout.length):
+                continue
+            index = indexes.get(plantlists_plants_id)
+            if index is None:
+                if len(layout.palette) == MAX_PALETTE:
+                    raise ValueError(f"Plot {plot.id} has too many plants to encode")
+                layout.palette.append(plantlists_plants_id)
+                index = indexes[plantlists_plants_id] = len(layout.palette)
+            layout.grid[cell_y * layout.width + cell_x] = index
+
+        return layout
+
+    def cells(self):
+        """Yields (cell_x, cell_y, plantlists_plants_id) for every painted cell."""
+
+        for i, index in enumerate(self.grid):
+            if index != EMPTY:
+                cell_y, cell_x = divmod(i, self.width)
+                yield cell_x, cell_y, self.palette[index - 1]
+
+    def symbols(self, default=None):
+        """Symbol HTML for each palette entry, in palette order. The palette's
+        symbol ids are loaded in one query, and their HTML comes from the
+        symbol cache."""
+
+        if not self.palette:
+            return []
+
+        symbol_ids = dict(
+            db.session.query(PlantLists_Plants.id, PlantLists_Plants.symbol_id).filter(
+                PlantLists_Plants.id.in_(self.palette)
+            )
+        )
+        symbols = symbol_cache.symbols(
+            symbol_id for symbol_id in symbol_ids.values() if symbol_id is not None
+        )
+        return [
+            symbols.get(symbol_ids.get(plp_id)) or default for plp_id in self.palette
+        ]
+
+    def render_rows(self, cell_class, symbols):
+        """HTML for the cells of each row, with their symbols painted.
+
+        Rows are built as strings here rather than with nested template
+        loops, which are slow for plots with tens of thousands of cells.
+        `symbols` are trusted HTML, as returned by symbols()."""
+
+        cell_class = escape(cell_class)
+        contents = [""] + list(symbols)
+        rows = []
+        for cell_y in range(self.length):
+            start = cell_y * self.width
+            rows.append(
+                Markup(
+                    "".join(
+                        f'<div class="{cell_class}" data-row="{cell_y}" '
+                        f'data-col="{cell_x}">{contents[index]}</div>'
+                        for cell_x, index in enumerate(
+                            self.grid[start : start + self.width]
+                        )
+                    )
+                )
+            )
+        return rows
+
+    def encode(self):
+        """RLE grid as bytes, for storage."""
+
+        return to_bytes(encode_rle(self.grid))
+
+    @classmethod
+    def decode(cls, width, length, palette, data):
+        grid = decode_rle(from_bytes(data))
+        if len(grid) != width * length:
+            raise ValueError("Layout grid doesn't match the plot size")
+        return cls(width, length, palette, grid)
+
+    def serialize(self, default_symbol=None):
+        """JSON friendly layout, with the palette's symbols and the RLE grid
+        base64 encoded."""
+
+        return {
+            "width": self.width,
+            "length": self.length,
+            "palette": [
+                {"plantlists_plants_id": plp_id, "symbol": symbol}
+                for plp_id, symbol in zip(self.palette, self.symbols(default_symbol))
+            ],
+            "cells": base64.b64encode(self.encode()).decode("ascii"),
+        }
@@ -0,0 +1,126 @@
+"""Background prefetching of Trefle pagination pages.
+
+After a page of plants is served from Trefle, the pages its links point to
+(the next `pages` pages, and the previous one if `prev` is set) are fetched
+on a small thread pool, so they are in the response cache by the time the
+user pages to them. A page the user asks for while it's still being
+prefetched waits for that fetch rather than making its own (see
+singleflight.py).
+
+Each worker keeps at most `budget` prefetches queued or running; beyond that
+they are dropped, so prefetching never competes with users for long. Nothing
+is prefetched while the endpoint's circuit breaker isn't closed."""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import endpoint_kind, make_key
+from circuitbreaker import CLOSED
+from trefle import TrefleError
+
+
+def link_request(link):
+    """Splits a Trefle pagination link (e.g. '/api/v1/plants?page=2') into the
+    endpoint and query string to request it with."""
+
+    path, _, query = link.partition("?")
+    if path.startswith("/api/v1"):
+        path = path[len("/api/v1") :]
+    return path.strip("/"), query
+
+
+class Prefetcher:
+    """Warms the response cache with the pages next to the one just served."""
+
+    def __init__(self, client, pages=1, prev=False, workers=2, budget=4):
+        self.client = client
+        self.pages = pages
+        self.prev = prev
+        self.workers = workers
+        self.budget = budget
+        self.prefetched = 0
+
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_config(cls, config, client):
+        """Builds a prefetcher from Flask app config."""
+
+        return cls(
+            client,
+            pages=int(config.get("TREFLE_PREFETCH_PAGES", 1)),
+            prev=bool(config.get("TREFLE_PREFETCH_PREV", False)),
+            workers=int(config.get("TREFLE_PREFETCH_WORKERS", 2)),
+            budget=int(config.get("TREFLE_PREFETCH_BUDGET", 4)),
+        )
+
+    @property
+    def executor(self):
+        """Prefetch pool for the current process, as threads don't survive
+        gunicorn forking its workers."""
+
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="prefetch"
+                    )
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def prefetch(self, links):
+        """Queues prefetches of the pages around a page with these links."""
+
+        if self.pages > 0 and links.get("next"):
+            self.submit(links["next"], self.pages - 1)
+        if self.prev and links.get("prev"):
+            self.submit(links["prev"], 0)
+
+    def submit(self, link, more):
+        """Queues a prefetch of the page at link, then `more` pages after it.
+        Returns whether it was queued."""
+
+        endpoint, query = link_request(link)
+        if not self.wanted(endpoint, query):
+            return False
+
+        key = make_key(endpoint, query)
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self.budget:
+                return False
+            self._pending.add(key)
+
+        self.executor.submit(self._prefetch, key, endpoint, query, more)
+        return True
+
+    def wanted(self, endpoint, query):
+        """Whether a page is worth prefetching: not cached yet, and Trefle
+        isn't failing."""
+
+        cache = self.client.cache
+        if cache is None or cache.contains(endpoint, query):
+            return False
+        breaker = self.client.breaker
+        return breaker is None or breaker.state(endpoint_kind(endpoint)) == CLOSED
+
+    def _prefetch(self, key, endpoint, query, more):
+        try:
+            plants = self.client.get(endpoint, query)
+            self.prefetched += 1
+
+            # Queued while this one still counts against the budget
+            next_link = plants.get("links", {}).get("next")
+            if more > 0 and next_link:
+                self.submit(next_link, more - 1)
+        except TrefleError as e:
+            logging.info(f"Couldn't prefetch {endpoint}?{query}: {e}")
+        except Exception:
+            logging.exception(f"Couldn't prefetch {endpoint}?{query}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
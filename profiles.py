@@ -0,0 +1,222 @@
+"""Plant profiles from Trefle, served stale-while-revalidate.
+
+A profile is served from the cache whenever there is one. Once it's older than
+`soft_ttl` it is still served straight away, and refreshed from Trefle in the
+background for the next visitor; only after `hard_ttl` is it gone. Slugs Trefle
+doesn't know are remembered for `missing_ttl`, and failed fetches for
+`error_ttl`, so a bad link or an outage doesn't send every request upstream.
+
+Entries live in the Trefle response cache's backend, so with the disk backend
+they are shared by every worker on the box. Fetches of a slug go through the
+client's single flight, and re-read the entry once they have the lock, so a
+worker that waited on another's fetch uses its result instead of fetching
+again."""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from trefle import TrefleCircuitOpen, TrefleError
+
+# Detail sections of a Trefle species that the profile page lists
+DETAIL_SECTIONS = (
+    "flower",
+    "foliage",
+    "fruit_or_seed",
+    "images",
+    "distribution",
+    "specifications",
+    "growth",
+)
+
+
+class PlantNotFound(Exception):
+    """Raised when Trefle has no plant with the slug."""
+
+
+def local_profile(plant):
+    """A profile with what the plants table has on a plant, for when Trefle
+    can't be reached. The detail sections are left empty."""
+
+    profile = plant.serialize()
+    profile.update({section: {} for section in DETAIL_SECTIONS})
+    profile["sources"] = []
+    return profile
+
+
+class PlantProfiles:
+    """Trefle plant data by slug, behind a stale-while-revalidate cache."""
+
+    def __init__(
+        self,
+        client,
+        backend,
+        soft_ttl=60 * 60,
+        hard_ttl=7 * 24 * 60 * 60,
+        missing_ttl=10 * 60,
+        error_ttl=30,
+        workers=2,
+    ):
+        self.client = client
+        self.backend = backend
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.missing_ttl = missing_ttl
+        self.error_ttl = error_ttl
+        self.workers = workers
+
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_config(cls, config, client, backend):
+        """Builds the profile cache from Flask app config."""
+
+        return cls(
+            client,
+            backend,
+            soft_ttl=float(config.get("PLANT_PROFILE_SOFT_TTL", 60 * 60)),
+            hard_ttl=float(config.get("PLANT_PROFILE_HARD_TTL", 7 * 24 * 60 * 60)),
+            missing_ttl=float(config.get("PLANT_PROFILE_MISSING_TTL", 10 * 60)),
+            error_ttl=float(config.get("PLANT_PROFILE_ERROR_TTL", 30)),
+        )
+
+    @property
+    def executor(self):
+        """Refresh pool for the current process, as threads don't survive
+        gunicorn forking its workers."""
+
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="profiles"
+                    )
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def key(slug):
+        return f"profile:{slug}"
+
+    def get(self, slug):
+        """Returns Trefle's data for the plant. Raises PlantNotFound, or
+        TrefleError when it can't be fetched."""
+
+        entry = self._load(slug)
+        if entry is None:
+            entry = self.fetch(slug)
+        elif "data" in entry and self.stale(entry):
+            self.refresh(slug)
+
+        if "missing" in entry:
+            raise PlantNotFound(slug)
+        if "error" in entry:
+            raise TrefleError(entry["error"])
+        return entry["data"]
+
+    def stale(self, entry):
+        """Whether a cached profile is due a refresh. After a failed refresh
+        the next one waits `error_ttl` seconds."""
+
+        now = time.time()
+        return now - entry["fetched"] > self.soft_ttl and now >= entry.get("retry", 0)
+
+    def coalesced(self, slug, func):
+        """Runs func(), sharing it with concurrent calls for the same slug in
+        this and (with lock files) other workers."""
+
+        single_flight = self.client.single_flight
+        if single_flight is None:
+            return func()
+        return single_flight.do(self.key(slug), func)
+
+    def fetch(self, slug):
+        """Fetches a profile from Trefle and caches the outcome, good or bad.
+        Returns the cache entry."""
+
+        # Another worker may have fetched it while we waited for the lock
+        return self.coalesced(slug, lambda: self._load(slug) or self._fetch(slug))
+
+    def _fetch(self, slug):
+        try:
+            data = self.client.fetch(f"plants/{slug}")["data"]
+        except TrefleCircuitOpen:
+            # Failing fast already, nothing to remember
+            raise
+        except TrefleError as e:
+            if e.status_code == 404:
+                return self._store(slug, {"missing": True}, self.missing_ttl)
+            return self._store(slug, {"error": str(e)}, self.error_ttl)
+        except (KeyError, TypeError):
+            return self._store(
+                slug,
+                {"error": f"Unexpected Trefle response for {slug}"},
+                self.error_ttl,
+            )
+
+        return self._store(slug, {"data": data}, self.hard_ttl)
+
+    def refresh(self, slug):
+        """Fetches a fresh copy of a stale profile in the background, unless
+        one is already on its way."""
+
+        with self._lock:
+            if slug in self._refreshing:
+                return
+            self._refreshing.add(slug)
+        self.executor.submit(self._refresh, slug)
+
+    def _refresh(self, slug):
+        try:
+            self.coalesced(slug, lambda: self._refetch(slug))
+        finally:
+            with self._lock:
+                self._refreshing.discard(slug)
+
+    def _refetch(self, slug):
+        entry = self._load(slug)
+        if entry is not None and not ("data" in entry and self.stale(entry)):
+            # Another worker refreshed it first
+            return
+
+        try:
+            data = self.client.fetch(f"plants/{slug}")["data"]
+        except TrefleError as e:
+            if e.status_code == 404:
+                self._store(slug, {"missing": True}, self.missing_ttl)
+            else:
+                logging.warning(f"Couldn't refresh plant profile {slug}: {e}")
+                self._retry_later(slug)
+        except Exception:
+            logging.exception(f"Couldn't refresh plant profile {slug}")
+            self._retry_later(slug)
+        else:
+            self._store(slug, {"data": data}, self.hard_ttl)
+
+    def _retry_later(self, slug):
+        # Keep serving the stale copy, and leave Trefle be for a while
+        entry = self._load(slug)
+        if entry is not None and "data" in entry:
+            entry["retry"] = time.time() + self.error_ttl
+            ttl = self.hard_ttl - (time.time() - entry["fetched"])
+            if ttl > 0:
+                self._save(slug, entry, ttl)
+
+    def _load(self, slug):
+        value = self.backend.get(self.key(slug))
+        return json.loads(value) if value is not None else None
+
+    def _store(self, slug, entry, ttl):
+        entry["fetched"] = time.time()
+        return self._save(slug, entry, ttl)
+
+    def _save(self, slug, entry, ttl):
+        value = json.dumps(entry, separators=(",", ":")).encode("UTF-8")
+        self.backend.set(self.key(slug), value, ttl)
+        return entry
@@ -0,0 +1,220 @@
+"""Token bucket rate limiting for expensive routes.
+
+Every (route, client) pair gets a bucket holding up to `capacity` tokens,
+refilled at `capacity / period` tokens a second; each request takes one, and a
+request finding the bucket empty is answered with 429 and a Retry-After header.
+Clients are the logged in user, or the IP address for anonymous requests.
+
+Budgets are strings like "10/minute" and are configured per route name.
+Buckets live in memory (per worker) or in a SQLite file shared by all workers
+on the box."""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, jsonify, request
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+DEFAULT_MAX_BUCKETS = 10000
+
+
+def parse_rate(rate):
+    """Parses "10/minute" (or "10/30 seconds") into (capacity, period in seconds).
+
+    Returns None for an empty rate, meaning no limit."""
+
+    if not rate:
+        return None
+
+    count, _, period = rate.partition("/")
+    amount, _, unit = period.strip().rpartition(" ")
+    if unit.endswith("s"):
+        unit = unit[:-1]
+    if unit not in PERIODS:
+        raise ValueError(f"Unknown rate limit period in {rate!r}")
+    return int(count), float(amount or 1) * PERIODS[unit]
+
+
+def refill(tokens, updated, capacity, period, now):
+    """Tokens in a bucket last left with `tokens` at time `updated`."""
+
+    if tokens is None:
+        return float(capacity)
+    return min(float(capacity), tokens + (now - updated) * capacity / period)
+
+
+def retry_after(tokens, capacity, period):
+    """Seconds until a bucket holding `tokens` has a whole token again."""
+
+    return (1 - tokens) * period / capacity
+
+
+class MemoryBackend:
+    """Buckets in a dict, private to the worker process."""
+
+    def __init__(self, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period, now=None):
+        """Takes a token from the bucket. Returns 0 if there was one, or else the
+        seconds to wait until there is."""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (None, now))
+            tokens = refill(tokens, updated, capacity, period, now)
+
+            wait = 0 if tokens >= 1 else retry_after(tokens, capacity, period)
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend:
+    """Buckets in a SQLite file, shared by every process using the same path.
+
+    Each thread (and each forked worker) opens its own connection."""
+
+    def __init__(self, path, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.path = path
+        self.max_buckets = max_buckets
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connect().execute(
+            """CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, period, now=None):
+        now = time.time() if now is None else now
+        conn = self._connect()
+        # Takes the write lock up front, so concurrent workers can't both
+        # spend the same token
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = refill(*(row or (None, now)), capacity, period, now)
+
+            wait = 0 if tokens >= 1 else retry_after(tokens, capacity, period)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens - 1 if not wait else tokens, now),
+            )
+            if not row:
+                self._evict(conn)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def _evict(self, conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM buckets").fetchone()
+        if count > self.max_buckets:
+            conn.execute(
+                "DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY updated LIMIT ?)",
+                (count - self.max_buckets,),
+            )
+
+    def clear(self):
+        self._connect().execute("DELETE FROM buckets")
+
+
+def client_key():
+    """The logged in user, or else the client's IP address.
+
+    Behind a proxy (such as Heroku's router) the address the proxy saw is the
+    last one in X-Forwarded-For; earlier entries are up to the client."""
+
+    user = getattr(g, "user", None)
+    if user:
+        return f"user:{user.id}"
+    return f"ip:{request.access_route[-1] if request.access_route else None}"
+
+
+class RateLimiter:
+    """Applies per-route budgets, given as {route name: "10/minute"}."""
+
+    def __init__(self, backend, limits=None, enabled=True):
+        self.backend = backend
+        self.limits = dict(limits or {})
+        self.enabled = enabled
+
+    def check(self, name, key):
+        """Seconds the client must wait before calling the route, 0 if none."""
+
+        rate = parse_rate(self.limits.get(name))
+        if not self.enabled or rate is None:
+            return 0
+        return self.backend.take(f"{name}:{key}", *rate)
+
+    def limit(self, name, methods=None, key_func=client_key):
+        """Decorates a view with the budget configured for `name`, optionally
+        only for some HTTP methods."""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if methods is None or request.method in methods:
+                    wait = self.check(name, key_func())
+                    if wait:
+                        return too_many_requests(wait)
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+def too_many_requests(wait):
+    seconds = max(1, math.ceil(wait))
+    message = f"Too many requests, please try again in {seconds} seconds."
+    resp = jsonify(error=message) if request.is_json else message
+    return resp, 429, {"Retry-After": str(seconds)}
+
+
+def rate_limiter_from_config(config):
+    """Builds a RateLimiter from Flask app config."""
+
+    if config.get("RATE_LIMIT_BACKEND") == "sqlite":
+        backend = SQLiteBackend(config["RATE_LIMIT_PATH"])
+    else:
+        backend = MemoryBackend()
+
+    return RateLimiter(
+        backend,
+        limits=config.get("RATE_LIMITS"),
+        enabled=config.get("RATE_LIMIT_ENABLED", True),
+    )
@@ -1,13 +1,14 @@
-"""Seed file to create db tables"""
-from models import db, Symbol
+"""Seed file to create or update the db tables, keeping any existing data"""
+from models import db, Symbol, default_plant_symbol
 from app import app
+from migrations import migrate
 
-# Create all tables
-db.drop_all()
-db.create_all()
+# Create missing tables and apply pending migrations
+migrate()
 
 
 # Add default symbol
-symbol = Symbol(symbol="<i class='symbol fas fa-seedling' style='color:#228B22;'></i>")
-db.session.add(symbol)
-db.session.commit()
+if not Symbol.query.filter_by(symbol=default_plant_symbol).count():
+    symbol = Symbol(symbol=default_plant_symbol)
+    db.session.add(symbol)
+    db.session.commit()
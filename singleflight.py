@@ -0,0 +1,147 @@
+"""Request coalescing ("single-flight") for Trefle lookups.
+
+When many requests need the same thing at once, such as a class opening the
+same plant profile, only one of them fetches it. In a worker, concurrent
+callers for a key wait for the first caller's fetch and share its result, or
+its exception. Results are shared, so they must be treated as read-only.
+
+Across workers, the fetch is done holding an flock on a lock file. A worker
+that finds the lock taken waits for it, then re-checks the (shared, disk)
+response cache before fetching, so it normally finds the other worker's
+answer there. Lock files are striped over a fixed number of files so they
+don't pile up; unrelated keys only rarely share one. A worker that waits
+longer than `lock_timeout` for a lock fetches without it; that is logged and
+counted in `unlocked`, as it means the lock isn't coalescing anything.
+
+Coalescing across workers needs the shared disk cache, so TrefleClient only
+turns it on with TREFLE_CACHE_BACKEND=disk. With the per-worker memory cache
+it is per worker only."""
+
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+LOCK_STRIPES = 256
+
+
+class Flight:
+    """A fetch in progress, and its outcome once done."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving meanwhile share it.
+
+    `lock_dir` enables coalescing across processes through lock files, waiting
+    at most `lock_timeout` seconds for another worker before going ahead."""
+
+    def __init__(self, lock_dir=None, lock_timeout=15, wait_timeout=30):
+        self.lock_dir = lock_dir
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.shared = 0
+        self.unlocked = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call already running for key."""
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(self.wait_timeout):
+                self.shared += 1
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            # The leader is stuck; don't wait on it any longer
+            return func()
+
+        try:
+            with self.process_lock(key) as lock:
+                if not lock.acquired:
+                    self.unlocked += 1
+                    logging.warning(
+                        f"Fetching {key} without the cross-worker lock, "
+                        f"{lock.path} was held for over {lock.timeout}s"
+                    )
+                flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def lock_path(self, key):
+        digest = hashlib.sha1(key.encode("UTF-8")).digest()
+        stripe = int.from_bytes(digest[:4], "big") % LOCK_STRIPES
+        return os.path.join(self.lock_dir, f"trefle-{stripe:03d}.lock")
+
+    def process_lock(self, key):
+        if not self.lock_dir:
+            return NoLock()
+        return FileLock(self.lock_path(key), self.lock_timeout)
+
+
+class NoLock:
+    acquired = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FileLock:
+    """Exclusive flock on a file, given up on after `timeout` seconds, leaving
+    `acquired` False."""
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+        self.acquired = False
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.acquired = True
+                return self
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(self.fd)
+                    self.fd = None
+                    return self
+                time.sleep(self.POLL_INTERVAL)
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+            self.acquired = False
+        return False
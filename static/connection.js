@@ -36,6 +36,12 @@ class Connection {
 	static async plotCellAddSymbol(plotId, cellX, cellY, plantlistsPlantsId) {
 		const res = await axios.post(`/plots/${plotId}/add/symbol/${plantlistsPlantsId}/x/${cellX}/y/${cellY}`);
 	}
+	//POST request to set or clear many plot cells at once. cells is a list of
+	//{x, y, plantlists_plants_id} objects, a null plantlists_plants_id clears the cell
+	static async plotCellsUpdate(plotId, cells) {
+		const res = await axios.post(`/plots/${plotId}/cells`, { cells });
+		return res.data;
+	}
 	//POST request to delete symbol from a plot cell
 	static async plotCellDeleteSymbol(plotId, cellX, cellY) {
 		const res = await axios.post(`/plots/${plotId}/delete/cell/x/${cellX}/y/${cellY}`);
@@ -4,9 +4,13 @@
 const $plantForm = $('#plant-form');
 const $plantTableBody = $('#plant-table-body');
 const $noResults = $('#no-results');
+const $searchInput = $('#search');
+const $plantSuggestions = $('#plant-suggestions');
 
 // Event handle on search form
 $plantForm.submit(handleSearchSubmit);
+// Suggest plant names as the search box is typed in
+$searchInput.on('input', handleSearchInput);
 
 /* 
 Search Class handles requests and methods associated with updating the
@@ -84,6 +88,12 @@ class Search {
 		$plantTableBody.html(plantTableData);
 	}
 
+	//GET request for plant name suggestions matching a partial search
+	static async autocomplete(term) {
+		const res = await axios.get(`/api/plants/autocomplete`, { params: { q: term } });
+		return res.data;
+	}
+
 	// POST request to return all plants based on search & filter terms
 	// Also calls to display data and updates pagination links
 	static async searchPlants(searchTerms) {
@@ -114,3 +124,27 @@ function handleSearchSubmit(evt) {
 
 	Search.searchPlants(inputsObj);
 }
+
+// Keeps track of the latest suggestion request, so slower responses for
+// earlier keystrokes don't overwrite newer suggestions
+let suggestionRequest = 0;
+
+async function handleSearchInput(evt) {
+	const term = $(this).val().trim();
+	const request = ++suggestionRequest;
+
+	if (term.length < 2) {
+		$plantSuggestions.empty();
+		return;
+	}
+
+	const suggestions = await Search.autocomplete(term);
+	if (request !== suggestionRequest) return;
+
+	$plantSuggestions.empty();
+	for (let plant of suggestions) {
+		const $option = $('<option>').attr('value', plant.common_name || plant.scientific_name);
+		$option.text(plant.scientific_name);
+		$plantSuggestions.append($option);
+	}
+}
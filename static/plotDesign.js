@@ -105,15 +105,20 @@ function handleSelectAll(evt) {
 // On call removes symbols from any selected cells
 // also removes connection in database
 async function handleRemoveSelected(evt) {
+	const cells = [];
 	for (const cell of $plotCols.filter('.selected')) {
 		const $cell = $(cell);
 		if ($cell.html().includes('symbol')) {
 			$cell.empty();
-			const cellX = $cell.attr('data-col');
-			const cellY = $cell.attr('data-row');
-			await Connection.plotCellDeleteSymbol(plotId, cellX, cellY);
+			// Viewer cells mirror the editor's, only send each cell once
+			if ($cell.is(':not(.plot-viewer)')) {
+				cells.push(cellData($cell, null));
+			}
 		}
 	}
+	if (cells.length) {
+		await Connection.plotCellsUpdate(plotId, cells);
+	}
 }
 
 // Selects a full row of cells
@@ -151,29 +156,21 @@ function handleSelectCol(evt) {
 
 // Clones selected symbol and applies to selected cells
 // Also saves connection of cell to symbol in database
-function handleSymbolSelect(evt) {
+async function handleSymbolSelect(evt) {
 	const $symbol = $(evt.currentTarget).clone();
 	const plantlistsPlantsId = $(evt.currentTarget).parent().attr('data-plp-id');
 	$('.selected').html($symbol);
 
-	//save symbol
-	for (let cell of $('.selected')) {
-		const $cell = $(cell);
-		const cellX = $cell.attr('data-col');
-		const cellY = $cell.attr('data-row');
-		Connection.plotCellAddSymbol(plotId, cellX, cellY, plantlistsPlantsId);
+	//save symbol for all selected cells in one request
+	const cells = [];
+	for (let cell of $plotCols.filter('.selected:not(.plot-viewer)')) {
+		cells.push(cellData($(cell), plantlistsPlantsId));
 	}
-	drawPlotSymbols();
+	// Both the editor and viewer cells are already painted, no need to redraw
+	await Connection.plotCellsUpdate(plotId, cells);
 }
 
-// Gets the symbols for each plot cell and displays them.
-async function drawPlotSymbols() {
-	const plotSymbols = await Query.getPlotCellSymbols(plotId);
-	plotSymbols.forEach((el) => {
-		const $cell = $(`[data-col=${el.cell_x}][data-row=${el.cell_y}]`);
-		$cell.html(el.symbol);
-	});
+// Plot cell entry for a batch update. plpId = plantlist_plant_id, null clears the cell
+function cellData($cell, plpId) {
+	return { x: $cell.attr('data-col'), y: $cell.attr('data-row'), plantlists_plants_id: plpId };
 }
-
-// Applies current plot symbols on page load
-$(drawPlotSymbols());
@@ -21,4 +21,10 @@ class Query {
 		const res = await axios.get(`/query/plot_cells/${plotId}`);
 		return res.data;
 	}
+	//GET request to get a plot's painted cells as a palette of symbols and a
+	//run-length encoded grid of palette indexes. See plot_layout.py
+	static async getPlotLayout(plotId) {
+		const res = await axios.get(`/query/plot_layout/${plotId}`);
+		return res.data;
+	}
 }
@@ -0,0 +1,112 @@
+"""Interned plant symbols.
+
+A symbol is a snippet of icon HTML, and the same few are shared by every plant
+list. Each is stored once, keyed by a hash of its HTML, and this per-worker
+cache maps symbol HTML to ids and back, so assigning or rendering a symbol
+doesn't need a query once it's been seen. Symbols never change once made, so
+cached entries don't go stale.
+
+New symbols are created in a savepoint: if another request created the same
+symbol first, the unique hash index rejects the insert and the existing row is
+used instead. Their ids are only cached once the transaction commits."""
+
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import db, symbol_hash, Symbol
+
+
+class SymbolCache:
+    """Size bounded two way map of symbol HTML and symbol ids."""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._ids = {}
+        self._symbols = {}
+        self._lock = threading.Lock()
+
+    def intern(self, symbol):
+        """Returns the id of the symbol, creating it if it's new. The caller
+        commits."""
+
+        with self._lock:
+            symbol_id = self._ids.get(symbol)
+        if symbol_id is not None:
+            return symbol_id
+
+        symbol_id = self._lookup(symbol)
+        if symbol_id is not None:
+            self.set(symbol_id, symbol)
+            return symbol_id
+        return self._create(symbol)
+
+    def _lookup(self, symbol):
+        return (
+            db.session.query(Symbol.id)
+            .filter(Symbol.hash == symbol_hash(symbol))
+            .scalar()
+        )
+
+    def _create(self, symbol):
+        try:
+            with db.session.begin_nested():
+                new_symbol = Symbol.add(symbol=symbol)
+        except IntegrityError:
+            # Someone else created it first
+            symbol_id = self._lookup(symbol)
+            self.set(symbol_id, symbol)
+            return symbol_id
+
+        db.session.info.setdefault("new_symbols", {})[new_symbol.id] = symbol
+        return new_symbol.id
+
+    def symbols(self, symbol_ids):
+        """Returns {id: symbol HTML} for the ids, loading any that aren't cached
+        in one query."""
+
+        symbol_ids = set(symbol_ids)
+        with self._lock:
+            found = {id: self._symbols[id] for id in symbol_ids if id in self._symbols}
+
+        missing = symbol_ids - set(found)
+        if missing:
+            query = db.session.query(Symbol.id, Symbol.symbol).filter(
+                Symbol.id.in_(missing)
+            )
+            for symbol_id, symbol in query:
+                self.set(symbol_id, symbol)
+                found[symbol_id] = symbol
+        return found
+
+    def set(self, symbol_id, symbol):
+        with self._lock:
+            if len(self._symbols) >= self.max_size:
+                self._ids.clear()
+                self._symbols.clear()
+            self._ids[symbol] = symbol_id
+            self._symbols[symbol_id] = symbol
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._symbols.clear()
+
+
+symbol_cache = SymbolCache()
+
+
+@event.listens_for(Session, "after_commit")
+def cache_new_symbols(session):
+    if session.transaction is not None and session.transaction.nested:
+        return
+    for symbol_id, symbol in session.info.pop("new_symbols", {}).items():
+        symbol_cache.set(symbol_id, symbol)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def forget_new_symbols(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop("new_symbols", None)
@@ -0,0 +1,102 @@
+import os, tempfile, time
+from unittest import TestCase
+
+from cache import (
+    MemoryBackend,
+    DiskBackend,
+    ResponseCache,
+    make_key,
+    endpoint_kind,
+)
+
+
+class CacheTestCase(TestCase):
+    """Test Trefle response cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    ######################################################
+    # Keys
+    ######################################################
+
+    def test_make_key_normalizes_params(self):
+        key = make_key("plants", {"filter[flower_color]": "red,blue", "q": "oak"})
+
+        self.assertEqual(
+            key, make_key("/plants/", "q=oak&filter[flower_color]=blue,red")
+        )
+        self.assertEqual(
+            key,
+            make_key(
+                "plants",
+                [("q", "oak"), ("token", "abc"), ("filter[flower_color]", "blue,red")],
+            ),
+        )
+        self.assertNotEqual(key, make_key("plants/search", {"q": "oak"}))
+
+    def test_endpoint_kind(self):
+        self.assertEqual(endpoint_kind("plants"), "plants")
+        self.assertEqual(endpoint_kind("/plants/search"), "search")
+        self.assertEqual(endpoint_kind("plants/quercus-rotundifolia"), "profile")
+
+    ######################################################
+    # Backends
+    ######################################################
+
+    def test_memory_backend_lru_eviction(self):
+        backend = MemoryBackend(max_bytes=10)
+        backend.set("a", b"aaaa", 60)
+        backend.set("b", b"bbbb", 60)
+        # Touch "a" so "b" is least recently used
+        backend.get("a")
+        backend.set("c", b"cccc", 60)
+
+        self.assertEqual(backend.get("a"), b"aaaa")
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("c"), b"cccc")
+        self.assertEqual(backend.size, 8)
+
+    def test_memory_backend_expiry(self):
+        backend = MemoryBackend()
+        backend.set("a", b"aaaa", -1)
+
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual(backend.size, 0)
+
+    def test_disk_backend_shared(self):
+        path = os.path.join(self.tmpdir.name, "cache.sqlite3")
+        writer = DiskBackend(path, max_bytes=10)
+        reader = DiskBackend(path, max_bytes=10)
+
+        writer.set("a", b"aaaa", 60)
+        self.assertEqual(reader.get("a"), b"aaaa")
+
+        writer.set("b", b"bbbb", 60)
+        time.sleep(0.01)
+        reader.get("a")
+        writer.set("c", b"cccc", 60)
+
+        self.assertIsNone(reader.get("b"))
+        self.assertEqual(reader.get("a"), b"aaaa")
+
+    ######################################################
+    # Response Cache
+    ######################################################
+
+    def test_response_cache_counters(self):
+        cache = ResponseCache(MemoryBackend(), ttls={"search": 30})
+
+        self.assertIsNone(cache.get("plants/search", {"q": "oak"}))
+        cache.set("plants/search", {"q": "oak"}, {"data": [1, 2], "links": {}})
+
+        self.assertEqual(
+            cache.get("plants/search", {"q": "oak", "token": "xyz"}),
+            {"data": [1, 2], "links": {}},
+        )
+        self.assertEqual(cache.ttl_for("plants/search"), 30)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
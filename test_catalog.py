@@ -0,0 +1,157 @@
+"""Catalog Tests"""
+
+import os, json, tempfile
+from unittest import TestCase
+
+from models import db, Plant
+
+os.environ["DATABASE_URL"] = "postgresql:///plot_planner_test"
+
+from app import app
+from catalog import Checkpoint, import_plants, iter_dump, search_page, text_search
+
+db.create_all()
+
+
+def trefle_plant(trefle_id, common_name, family="Fagaceae"):
+    return {
+        "id": trefle_id,
+        "slug": f"plant-{trefle_id}",
+        "common_name": common_name,
+        "scientific_name": f"Plantus {trefle_id}",
+        "family": family,
+        "family_common_name": f"{family} family",
+        "genus": "Plantus",
+        "year": 1753,
+        "image_url": None,
+    }
+
+
+class CatalogTestCase(TestCase):
+    """Test local plant catalog import and search"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        # Dump with two pages of plants, one plant per line afterwards
+        self.dump_path = os.path.join(self.tmpdir.name, "plants.jsonl")
+        with open(self.dump_path, "w") as dump:
+            page1 = [trefle_plant(i, f"oak {i}") for i in range(1, 16)]
+            page2 = [
+                trefle_plant(i, f"maple {i}", "Sapindaceae") for i in range(16, 31)
+            ]
+            dump.write(json.dumps({"data": page1, "links": {}}) + "\n")
+            dump.write(json.dumps({"data": page2, "links": {}}) + "\n")
+            dump.write(json.dumps(trefle_plant(31, "lone pine", "Pinaceae")) + "\n")
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmpdir.cleanup()
+
+    def test_import_plants(self):
+        inserted, updated = import_plants(iter_dump(self.dump_path), batch_size=7)
+
+        self.assertEqual(inserted, 31)
+        self.assertEqual(updated, 0)
+        self.assertEqual(Plant.query.count(), 31)
+
+        plant = Plant.query.filter(Plant.trefle_id == 31).one()
+        self.assertEqual(plant.common_name, "lone pine")
+        self.assertIsNotNone(plant.synced_at)
+
+    def test_import_plants_idempotent(self):
+        import_plants(iter_dump(self.dump_path))
+        inserted, updated = import_plants(iter_dump(self.dump_path))
+
+        self.assertEqual(inserted, 0)
+        self.assertEqual(updated, 31)
+        self.assertEqual(Plant.query.count(), 31)
+
+    def test_import_plants_resume(self):
+        checkpoint = Checkpoint(os.path.join(self.tmpdir.name, "ckpt"), "test")
+        checkpoint.save(2)
+
+        inserted, updated = import_plants(iter_dump(self.dump_path), checkpoint)
+
+        self.assertEqual(inserted, 1)
+        self.assertEqual(checkpoint.load(), 3)
+
+    def test_search_page(self):
+        import_plants(iter_dump(self.dump_path))
+
+        plants = search_page("plants")
+        self.assertEqual(len(plants["data"]), 20)
+        self.assertEqual(plants["links"]["next"], "/api/v1/plants?page=2")
+        self.assertNotIn("prev", plants["links"])
+
+        plants = search_page("plants/search", "q=MAPLE&page=1")
+        self.assertEqual(plants["meta"]["total"], 15)
+        self.assertEqual(plants["data"][0]["common_name"], "maple 16")
+        self.assertNotIn("next", plants["links"])
+
+    def test_text_search_prefix(self):
+        import_plants(iter_dump(self.dump_path))
+
+        ids, total = text_search("map 2")
+        plants = Plant.query.filter(Plant.id.in_(ids)).all()
+
+        self.assertEqual(total, 10)
+        self.assertTrue(all(p.common_name.startswith("maple 2") for p in plants))
+
+    def test_text_search_typo(self):
+        import_plants(iter_dump(self.dump_path))
+
+        ids, total = text_search("lone pinr")
+
+        self.assertEqual(total, 1)
+        self.assertEqual(Plant.query.get(ids[0]).common_name, "lone pine")
+
+    def test_autocomplete(self):
+        import_plants(iter_dump(self.dump_path))
+
+        with app.test_client() as c:
+            resp = c.get("/api/plants/autocomplete?q=lone")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json[0]["slug"], "plant-31")
+
+    def test_search_page_facets(self):
+        # Species details carry the filterable attributes
+        details = [
+            dict(
+                trefle_plant(100 + i, f"rose {i}", "Rosaceae"),
+                flower={"color": ["red"] if i % 2 else ["white", "red"]},
+                growth={"bloom_months": ["jun", "jul"] if i < 3 else ["may"]},
+                duration=["perennial"],
+                specifications={"ligneous_type": "shrub"},
+                vegetable=False,
+            )
+            for i in range(6)
+        ]
+        import_plants([(1, details)])
+        # Re-importing the same plants as list items keeps their attributes
+        import_plants([(2, [trefle_plant(100, "rose 0", "Rosaceae")])])
+
+        plants = search_page(
+            "plants", {"filter[flower_color]": "red", "filter[bloom_months]": "jun"},
+        )
+        facets = plants["meta"]["facets"]
+
+        self.assertEqual(plants["meta"]["total"], 3)
+        self.assertEqual(facets["total"], 3)
+        self.assertEqual(facets["flower_color"]["white"], 2)
+        self.assertEqual(facets["bloom_months"]["may"], 3)
+        self.assertEqual(facets["ligneous_type"]["shrub"], 3)
+        self.assertEqual(facets["vegetable"]["true"], 0)
+
+        plants = search_page(
+            "plants/search", {"q": "rose", "filter[flower_color]": "white"}
+        )
+        self.assertEqual(plants["meta"]["total"], 3)
+        self.assertIn("filter", plants["links"]["self"])
+
+    def test_search_page_unknown_filter(self):
+        self.assertIsNone(search_page("plants", {"filter[toxicity]": "high"}))
@@ -0,0 +1,74 @@
+import time
+from unittest import TestCase
+
+from circuitbreaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Test the circuit breaker states"""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            window=60, min_calls=4, failure_rate=0.5, open_for=0.1
+        )
+
+    def call(self, key, ok):
+        self.breaker.before_call(key)
+        self.breaker.record(key, ok)
+
+    def test_opens_on_failure_rate(self):
+        for ok in (True, False, True):
+            self.call("search", ok)
+        self.assertEqual(self.breaker.state("search"), CLOSED)
+
+        self.call("search", False)
+        self.assertEqual(self.breaker.state("search"), OPEN)
+
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call("search")
+        # Other endpoints are unaffected
+        self.call("profile", True)
+
+    def test_stays_closed_below_rate(self):
+        for ok in (True, True, True, False, True, True):
+            self.call("search", ok)
+
+        self.assertEqual(self.breaker.state("search"), CLOSED)
+
+    def test_window(self):
+        self.breaker.window = 0.05
+        self.call("search", False)
+        self.call("search", False)
+        time.sleep(0.1)
+
+        # The old failures have left the window
+        self.call("search", True)
+        self.call("search", True)
+        self.call("search", False)
+        self.assertEqual(self.breaker.state("search"), CLOSED)
+
+    def test_half_open_closes(self):
+        for _ in range(4):
+            self.call("search", False)
+        time.sleep(0.1)
+        self.assertEqual(self.breaker.state("search"), HALF_OPEN)
+
+        # One probe at a time
+        self.breaker.before_call("search")
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call("search")
+
+        self.breaker.record("search", True)
+        self.assertEqual(self.breaker.state("search"), CLOSED)
+        self.call("search", True)
+
+    def test_half_open_reopens(self):
+        for _ in range(4):
+            self.call("search", False)
+        time.sleep(0.1)
+
+        self.call("search", False)
+
+        self.assertEqual(self.breaker.state("search"), OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call("search")
@@ -0,0 +1,193 @@
+"""Migration Tests"""
+
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from models import (
+    db,
+    Plant,
+    Project,
+    Plot,
+    Projects_Plots,
+    PLANT_SEARCH_FTS,
+    PLANT_SEARCH_INDEXES,
+)
+
+os.environ["DATABASE_URL"] = "postgresql:///plot_planner_test"
+
+from app import app
+from catalog import autocomplete
+from migrations import (
+    migrate,
+    applied_versions,
+    backfill_plant_genus,
+    count_plants_missing_genus,
+    AddIndex,
+    AddPostgresIndex,
+    AddSQLiteSearch,
+    Backfill,
+    Migration,
+    MIGRATIONS,
+)
+
+VERSIONS = [migration.version for migration in MIGRATIONS]
+
+
+def index_names(table):
+    return {index["name"] for index in inspect(db.engine).get_indexes(table)}
+
+
+class MigrationsTestCase(TestCase):
+    """Test versioned schema migrations"""
+
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        self.output = []
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_migrate_new_database(self):
+        self.assertEqual(migrate(out=self.output.append), VERSIONS)
+
+        self.assertIn("plants", inspect(db.engine).get_table_names())
+        self.assertEqual(applied_versions(db.engine), set(VERSIONS))
+        self.assertEqual(migrate(out=self.output.append), [])
+
+    def test_dry_run(self):
+        self.assertEqual(migrate(dry_run=True, out=self.output.append), VERSIONS)
+
+        self.assertIn("    CREATE TABLE plants", self.output)
+        self.assertEqual(inspect(db.engine).get_table_names(), [])
+        self.assertEqual(applied_versions(db.engine), set())
+
+    def test_migrate_existing_database(self):
+        # A database made before the association indexes, with duplicate links
+        db.create_all()
+        for index in Projects_Plots.__table__.indexes:
+            index.drop(bind=db.engine)
+        project = Project(name="Project")
+        plot = Plot(name="Plot", width=1, length=1)
+        db.session.add_all([project, plot])
+        db.session.flush()
+        for i in range(2):
+            db.session.add(Projects_Plots(project_id=project.id, plot_id=plot.id))
+        db.session.commit()
+
+        migrate(dry_run=True, out=self.output.append)
+        self.assertIn(
+            "    CREATE UNIQUE INDEX projects_plots_link_idx ON projects_plots (project_id, plot_id)",
+            self.output,
+        )
+        self.assertEqual(Projects_Plots.query.count(), 2)
+
+        migrate(out=self.output.append)
+
+        self.assertEqual(Projects_Plots.query.count(), 1)
+        self.assertIn("projects_plots_link_idx", index_names("projects_plots"))
+        self.assertIn("projects_plots_plot_id_idx", index_names("projects_plots"))
+
+    @skipUnless(db.engine.dialect.name == "postgresql", "Postgres only")
+    def test_rebuild_invalid_index(self):
+        db.create_all()
+        index = next(
+            index
+            for index in Projects_Plots.__table__.indexes
+            if index.name == "projects_plots_link_idx"
+        )
+        index.drop(bind=db.engine)
+        project = Project(name="Project")
+        plot = Plot(name="Plot", width=1, length=1)
+        db.session.add_all([project, plot])
+        db.session.flush()
+        for i in range(2):
+            db.session.add(Projects_Plots(project_id=project.id, plot_id=plot.id))
+        db.session.commit()
+
+        # Building the unique index concurrently fails, leaving it invalid
+        step = AddIndex(index)
+        with self.assertRaises(IntegrityError):
+            step.run(db.engine)
+        self.assertIn("projects_plots_link_idx", index_names("projects_plots"))
+
+        with db.engine.connect() as conn:
+            self.assertEqual(
+                step.plan(conn)[0], "DROP INDEX CONCURRENTLY projects_plots_link_idx"
+            )
+
+        Projects_Plots.query.filter(
+            Projects_Plots.id != Projects_Plots.query.first().id
+        ).delete()
+        db.session.commit()
+        step.run(db.engine)
+
+        with db.engine.connect() as conn:
+            self.assertEqual(step.plan(conn), [])
+
+    def test_postgres_index(self):
+        db.create_all()
+        step = AddPostgresIndex(PLANT_SEARCH_INDEXES[1])
+
+        self.assertEqual(step.name, "ix_plants_common_name_trgm")
+        self.assertEqual(step.table, "plants")
+        if db.engine.dialect.name != "postgresql":
+            with db.engine.connect() as conn:
+                self.assertEqual(step.plan(conn), [])
+
+    @skipUnless(db.engine.dialect.name == "sqlite", "SQLite only")
+    def test_sqlite_search(self):
+        # A database whose plants table was made before the search table
+        db.create_all()
+        with db.engine.begin() as conn:
+            conn.execute("DROP TABLE plants_fts")
+            for name in ("insert", "delete", "update"):
+                conn.execute(f"DROP TRIGGER plants_fts_{name}")
+        db.session.add(Plant(trefle_id=1, slug="quercus-robur", common_name="Oak"))
+        db.session.commit()
+
+        steps = [AddSQLiteSearch(ddl) for ddl in PLANT_SEARCH_FTS]
+        migrate(migrations=[Migration("9999", "Search", steps)], out=self.output.append)
+
+        self.assertEqual(
+            [plant["slug"] for plant in autocomplete("oa")], ["quercus-robur"]
+        )
+        db.session.add(Plant(trefle_id=2, slug="quercus-rubra", common_name="Oak red"))
+        db.session.commit()
+        self.assertEqual(len(autocomplete("oak")), 2)
+        with db.engine.connect() as conn:
+            self.assertEqual([line for step in steps for line in step.plan(conn)], [])
+
+    def test_backfill_plant_genus(self):
+        db.create_all()
+        for i in range(5):
+            db.session.add(
+                Plant(trefle_id=i, slug=f"plant-{i}", scientific_name=f"Genus{i} sp")
+            )
+        db.session.add(Plant(trefle_id=5, slug="plant-5", scientific_name=" "))
+        db.session.commit()
+
+        batches = []
+
+        def batch(conn, after_id, batch_size):
+            batches.append(after_id)
+            return backfill_plant_genus(conn, after_id, batch_size)
+
+        backfill = Backfill(
+            "Set plant genus", Plant.__table__, batch, count_plants_missing_genus, 2
+        )
+        migrate(
+            migrations=[Migration("9999", "Backfill", [backfill])],
+            out=self.output.append,
+        )
+
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(
+            [plant.genus for plant in Plant.query.order_by(Plant.id)],
+            ["Genus0", "Genus1", "Genus2", "Genus3", "Genus4", None],
+        )
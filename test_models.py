@@ -22,6 +22,7 @@ from models import (
     Users_Projects,
     Users_Plots,
     Users_PlantLists,
+    symbol_hash,
 )
 from forms import (
     UserAddForm,
@@ -39,6 +40,8 @@ from forms import (
 os.environ["DATABASE_URL"] = "postgresql:///plot_planner_test"
 
 from app import app, CURR_USER_KEY
+from maintenance import compact_plot_cells, dedupe_links, dedupe_symbols
+from passwords import password_hasher
 from secret import TREFLE_API_KEY, FLASK_SECRET
 
 db.create_all()
@@ -241,6 +244,15 @@ class ModalsTestCase(TestCase):
     def test_wrong_password(self):
         self.assertFalse(User.authenticate(self.testuser.username, "badpassword"))
 
+    def test_authenticate_rehash(self):
+        password_hasher.configure(rounds=5)
+        try:
+            user = User.authenticate("testuser", "testpw")
+            self.assertTrue(user.password.startswith("$2b$05$"))
+            self.assertTrue(User.authenticate("testuser", "testpw"))
+        finally:
+            password_hasher.configure(rounds=app.config["BCRYPT_LOG_ROUNDS"])
+
     def test_user_edit(self):
         self.testuser.edit("edit_username", "edit@email.com", None)
 
@@ -427,7 +439,7 @@ class ModalsTestCase(TestCase):
 
     def test_symbol_model(self):
         symbol = Symbol(
-            id=2, symbol="<i class='symbol fas fa-seedling' style='color:#228B22;'></i>"
+            id=2, symbol="<i class='symbol fas fa-seedling' style='color:#118B24;'></i>"
         )
 
         db.session.add(symbol)
@@ -435,12 +447,25 @@ class ModalsTestCase(TestCase):
 
         symbol = Symbol.query.filter(
             Symbol.symbol
-            == "<i class='symbol fas fa-seedling' style='color:#228B22;'></i>"
+            == "<i class='symbol fas fa-seedling' style='color:#118B24;'></i>"
         ).first()
 
         self.assertIsNotNone(symbol)
+        self.assertEqual(symbol.hash, symbol_hash(symbol.symbol))
+
+    def test_symbol_unique(self):
+        symbol = Symbol(
+            id=2, symbol="<i class='symbol fas fa-seedling' style='color:#228B22;'></i>"
+        )
+
+        db.session.add(symbol)
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
 
     def test_symbol_default(self):
+        # Symbols are unique, so make room for the default one
+        db.session.delete(Symbol.query.get(self.testsymbol_id))
+        db.session.commit()
         symbol = Symbol(id=2, symbol=None)
 
         db.session.add(symbol)
@@ -450,6 +475,7 @@ class ModalsTestCase(TestCase):
             symbol.symbol,
             "<i class='symbol fas fa-seedling' style='color:#228B22;'></i>",
         )
+        self.assertEqual(symbol.hash, symbol_hash(symbol.symbol))
 
     # def test_symbol_add(self):
     #     symbol = Symbol.add(
@@ -693,3 +719,143 @@ class ModalsTestCase(TestCase):
         )
         db.session.commit()
         self.assertIsNotNone(plot_cells_symbols)
+
+    def test_plots_cells_symbols_upsert(self):
+        other_plantlist = PlantList(name="Other Plantlist")
+        db.session.add(other_plantlist)
+        db.session.flush()
+        plantlists_plants = [
+            PlantLists_Plants(
+                plantlist_id=plantlist_id,
+                plant_id=self.testplant_id,
+                symbol_id=self.testsymbol_id,
+            )
+            for plantlist_id in [self.testplantlist_id, other_plantlist.id]
+        ]
+        db.session.add_all(plantlists_plants)
+        db.session.commit()
+        first_id, second_id = [plp.id for plp in plantlists_plants]
+
+        first_cell_id = Plot_Cells_Symbols.add(
+            plot_id=self.testplot_id, plantlists_plants_id=first_id, cell_x=1, cell_y=2,
+        ).id
+        plot_cells_symbols = Plot_Cells_Symbols.add(
+            plot_id=self.testplot_id,
+            plantlists_plants_id=second_id,
+            cell_x=1,
+            cell_y=2,
+        )
+        db.session.commit()
+
+        self.assertEqual(Plot_Cells_Symbols.query.count(), 1)
+        self.assertEqual(plot_cells_symbols.plantlists_plants_id, second_id)
+        # Updated in place, not deleted and re-inserted
+        self.assertEqual(plot_cells_symbols.id, first_cell_id)
+
+        # Duplicate cells are rejected outside the upsert path
+        db.session.add(
+            Plot_Cells_Symbols(
+                plot_id=self.testplot_id,
+                plantlists_plants_id=first_id,
+                cell_x=1,
+                cell_y=2,
+            )
+        )
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_compact_plot_cells(self):
+        plantlists_plants = PlantLists_Plants(
+            plantlist_id=self.testplantlist_id,
+            plant_id=self.testplant_id,
+            symbol_id=self.testsymbol_id,
+        )
+        db.session.add(plantlists_plants)
+        db.session.commit()
+
+        # Rows written before the unique index existed
+        for index in Plot_Cells_Symbols.__table__.indexes:
+            index.drop(bind=db.engine)
+        for cell_x in [0, 0, 0, 1]:
+            db.session.add(
+                Plot_Cells_Symbols(
+                    plot_id=self.testplot_id,
+                    plantlists_plants_id=plantlists_plants.id,
+                    cell_x=cell_x,
+                    cell_y=0,
+                )
+            )
+            db.session.commit()
+        latest_id = max(
+            cell.id for cell in Plot_Cells_Symbols.query.filter_by(cell_x=0)
+        )
+
+        self.assertEqual(compact_plot_cells(), 2)
+        self.assertEqual(
+            [cell.id for cell in Plot_Cells_Symbols.query.filter_by(cell_x=0)],
+            [latest_id],
+        )
+        self.assertEqual(Plot_Cells_Symbols.query.count(), 2)
+        self.assertEqual(compact_plot_cells(), 0)
+
+    def test_dedupe_links(self):
+        # Links written before the unique indexes existed
+        for model in [Projects_Plots, PlantLists_Plants]:
+            for index in model.__table__.indexes:
+                index.drop(bind=db.engine)
+        for i in range(3):
+            db.session.add(
+                Projects_Plots(project_id=self.testproject_id, plot_id=self.testplot_id)
+            )
+        plantlists_plants = [
+            PlantLists_Plants(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            )
+            for i in range(2)
+        ]
+        db.session.add_all(plantlists_plants)
+        db.session.commit()
+        first_id, second_id = [plp.id for plp in plantlists_plants]
+        db.session.add(
+            Plot_Cells_Symbols(
+                plot_id=self.testplot_id,
+                plantlists_plants_id=second_id,
+                cell_x=0,
+                cell_y=0,
+            )
+        )
+        db.session.commit()
+
+        self.assertEqual(dedupe_links(), 3)
+        self.assertEqual(Projects_Plots.query.count(), 1)
+        self.assertEqual([plp.id for plp in PlantLists_Plants.query], [first_id])
+        self.assertEqual(Plot_Cells_Symbols.query.one().plantlists_plants_id, first_id)
+        self.assertEqual(dedupe_links(), 0)
+
+        # Now the indexes are back, duplicates are rejected
+        db.session.add(
+            Projects_Plots(project_id=self.testproject_id, plot_id=self.testplot_id)
+        )
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_dedupe_symbols(self):
+        # Symbols created twice before the unique hash index existed
+        for index in Symbol.__table__.indexes:
+            index.drop(bind=db.engine)
+        duplicate = Symbol.add(symbol=self.testsymbol.symbol)
+        db.session.commit()
+        plantlists_plants = PlantLists_Plants(
+            plantlist_id=self.testplantlist_id,
+            plant_id=self.testplant_id,
+            symbol_id=duplicate.id,
+        )
+        db.session.add(plantlists_plants)
+        db.session.commit()
+
+        self.assertEqual(dedupe_symbols(), 1)
+        self.assertEqual([symbol.id for symbol in Symbol.query], [self.testsymbol_id])
+        self.assertEqual(
+            PlantLists_Plants.query.one().symbol_id, self.testsymbol_id,
+        )
+        self.assertEqual(dedupe_symbols(), 0)
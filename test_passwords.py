@@ -0,0 +1,64 @@
+"""Password Hashing Tests"""
+
+import tempfile
+import threading
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing passwords on the worker pool"""
+
+    def test_hash_check(self):
+        hasher = PasswordHasher(rounds=4)
+
+        hashed = hasher.hash("testpw")
+
+        self.assertTrue(hashed.startswith("$2b$04$"))
+        self.assertTrue(hasher.check(hashed, "testpw"))
+        self.assertFalse(hasher.check(hashed, "wrongpw"))
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(rounds=4)
+        hashed = hasher.hash("testpw")
+
+        self.assertFalse(hasher.needs_rehash(hashed))
+        hasher.configure(rounds=5)
+        self.assertTrue(hasher.needs_rehash(hashed))
+        self.assertTrue(hasher.needs_rehash("not a hash"))
+
+    def test_busy(self):
+        hasher = PasswordHasher(rounds=4, workers=1, queue_size=0, timeout=0.01)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=hasher.run, args=(block,))
+        thread.start()
+        started.wait()
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.hash("testpw")
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertTrue(hasher.check(hasher.hash("testpw"), "testpw"))
+
+    def test_host_busy(self):
+        lock_dir = tempfile.mkdtemp()
+        # Another worker holds the only slot on the box
+        other = PasswordHasher(rounds=4, lock_dir=lock_dir, host_slots=1)
+        fd = other.host_slots.acquire(0)
+
+        hasher = PasswordHasher(rounds=4, timeout=0.05, lock_dir=lock_dir, host_slots=1)
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.hash("testpw")
+        finally:
+            other.host_slots.release(fd)
+
+        self.assertTrue(hasher.check(hasher.hash("testpw"), "testpw"))
@@ -0,0 +1,45 @@
+"""Plot Layout Tests"""
+
+from array import array
+from unittest import TestCase
+
+from plot_layout import PlotLayout, decode_rle, encode_rle, from_bytes, to_bytes
+
+
+class PlotLayoutTestCase(TestCase):
+    """Test plot layout grid encoding"""
+
+    def test_encode_rle(self):
+        grid = array("H", [0, 0, 0, 3, 3, 1, 0])
+
+        pairs = encode_rle(grid)
+
+        self.assertEqual(list(pairs), [0, 3, 3, 2, 1, 1, 0, 1])
+        self.assertEqual(decode_rle(pairs), grid)
+
+    def test_encode_rle_long_runs(self):
+        grid = array("H", [2]) * 200000
+
+        pairs = encode_rle(grid)
+
+        self.assertEqual(len(pairs), 8)
+        self.assertEqual(decode_rle(pairs), grid)
+
+    def test_bytes(self):
+        values = array("H", [1, 0x1234])
+
+        self.assertEqual(to_bytes(values), b"\x01\x00\x34\x12")
+        self.assertEqual(from_bytes(to_bytes(values)), values)
+
+    def test_decode(self):
+        layout = PlotLayout(200, 200, palette=[7])
+        layout.grid[:100] = array("H", [1]) * 100
+
+        decoded = PlotLayout.decode(200, 200, [7], layout.encode())
+
+        self.assertEqual(len(layout.encode()), 8)
+        self.assertEqual(decoded.grid, layout.grid)
+        self.assertEqual(list(decoded.cells())[-1], (99, 0, 7))
+
+        with self.assertRaises(ValueError):
+            PlotLayout.decode(10, 10, [7], layout.encode())
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from unittest import TestCase
+
+from cache import MemoryBackend, ResponseCache
+from circuitbreaker import CircuitBreaker
+from prefetch import Prefetcher, link_request
+from trefle import TrefleClient
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeTrefle:
+    """Stands in for requests.Session, serving numbered pages of plants up to
+    `last`, optionally holding requests until released."""
+
+    def __init__(self, last=5):
+        self.last = last
+        self.pages = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def get(self, url, params=None, timeout=None):
+        self.release.wait(5)
+        query = dict(pair.split("=") for pair in params.split("&"))
+        page = int(query.get("page", 1))
+        self.pages.append(page)
+        return FakeResponse({"data": [page], "links": page_links(page, self.last)})
+
+
+def page_links(page, last):
+    links = {"self": f"/api/v1/plants?page={page}"}
+    if page > 1:
+        links["prev"] = f"/api/v1/plants?page={page - 1}"
+    if page < last:
+        links["next"] = f"/api/v1/plants?page={page + 1}"
+    return links
+
+
+class PrefetcherTestCase(TestCase):
+    """Test prefetching pagination pages"""
+
+    def setUp(self):
+        self.trefle = FakeTrefle()
+        self.client = TrefleClient(
+            "tok", cache=ResponseCache(MemoryBackend()), breaker=CircuitBreaker()
+        )
+        self.client._session = self.trefle
+        self.client._session_pid = os.getpid()
+
+    def make_prefetcher(self, **kwargs):
+        self.prefetcher = Prefetcher(self.client, **kwargs)
+        return self.prefetcher
+
+    def wait(self):
+        while self.prefetcher._pending:
+            time.sleep(0.01)
+
+    def test_link_request(self):
+        self.assertEqual(
+            link_request("/api/v1/plants/search?q=oak&page=2"),
+            ("plants/search", "q=oak&page=2"),
+        )
+        self.assertEqual(link_request("/plants?page=2"), ("plants", "page=2"))
+
+    def test_prefetch_next(self):
+        prefetcher = self.make_prefetcher()
+
+        prefetcher.prefetch(page_links(2, 5))
+        self.wait()
+
+        self.assertEqual(self.trefle.pages, [3])
+        self.client.get("plants", "page=3")
+        self.assertEqual(self.trefle.pages, [3])
+
+    def test_prefetch_pages_and_prev(self):
+        prefetcher = self.make_prefetcher(pages=2, prev=True)
+
+        prefetcher.prefetch(page_links(2, 5))
+        self.wait()
+
+        self.assertEqual(sorted(self.trefle.pages), [1, 3, 4])
+        self.assertEqual(prefetcher.prefetched, 3)
+
+    def test_prefetch_last_page(self):
+        prefetcher = self.make_prefetcher()
+
+        prefetcher.prefetch(page_links(5, 5))
+        self.wait()
+
+        self.assertEqual(self.trefle.pages, [])
+
+    def test_skip_cached(self):
+        prefetcher = self.make_prefetcher()
+        self.client.get("plants", "page=3")
+
+        prefetcher.prefetch(page_links(2, 5))
+        self.wait()
+
+        self.assertEqual(self.trefle.pages, [3])
+
+    def test_budget(self):
+        prefetcher = self.make_prefetcher(budget=1)
+        self.trefle.release.clear()
+
+        self.assertTrue(prefetcher.submit("/api/v1/plants?page=3", 0))
+        self.assertFalse(prefetcher.submit("/api/v1/plants?page=4", 0))
+
+        self.trefle.release.set()
+        self.wait()
+        self.assertEqual(self.trefle.pages, [3])
+
+    def test_skip_when_circuit_open(self):
+        prefetcher = self.make_prefetcher()
+        self.client.breaker = CircuitBreaker(min_calls=1, open_for=60)
+        self.client.breaker.record("plants", False)
+
+        prefetcher.prefetch(page_links(2, 5))
+        self.wait()
+
+        self.assertEqual(self.trefle.pages, [])
@@ -0,0 +1,177 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cache import DiskBackend, MemoryBackend
+from profiles import PlantNotFound, PlantProfiles
+from singleflight import SingleFlight
+from trefle import TrefleCircuitOpen, TrefleError
+
+OAK = {"id": 1, "slug": "quercus-robur", "common_name": "Oak"}
+
+
+class FakeClient:
+    """Stands in for TrefleClient, answering from a list of canned results"""
+
+    def __init__(self, results, single_flight=None, delay=0):
+        self.results = list(results)
+        self.calls = []
+        self.single_flight = single_flight
+        self.delay = delay
+
+    def fetch(self, endpoint, params=None):
+        self.calls.append(endpoint)
+        time.sleep(self.delay)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class PlantProfilesTestCase(TestCase):
+    """Test the stale-while-revalidate plant profile cache"""
+
+    def make_profiles(self, results, **kwargs):
+        self.client = FakeClient(results)
+        return PlantProfiles(self.client, MemoryBackend(), **kwargs)
+
+    def age(self, profiles, slug, seconds):
+        entry = profiles._load(slug)
+        entry["fetched"] = time.time() - seconds
+        profiles.backend.set(profiles.key(slug), json.dumps(entry).encode(), 60)
+
+    def wait_for_refresh(self, profiles):
+        profiles.executor.shutdown(wait=True)
+        profiles._executor = None
+
+    def test_get(self):
+        profiles = self.make_profiles([{"data": OAK}])
+
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+
+        self.assertEqual(self.client.calls, ["plants/quercus-robur"])
+
+    def test_get_coalesced(self):
+        # Two workers sharing a disk cache, each with two request threads
+        directory = tempfile.mkdtemp()
+        backend = DiskBackend(os.path.join(directory, "cache.sqlite3"))
+        clients = []
+        threads = []
+        for worker in range(2):
+            client = FakeClient(
+                [{"data": OAK}] * 4,
+                single_flight=SingleFlight(lock_dir=directory),
+                delay=0.2,
+            )
+            clients.append(client)
+            profiles = PlantProfiles(client, backend)
+            threads += [
+                threading.Thread(target=profiles.get, args=("quercus-robur",))
+                for i in range(2)
+            ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(len(client.calls) for client in clients), 1)
+
+    def test_stale_served_then_refreshed(self):
+        fresher = dict(OAK, common_name="English oak")
+        profiles = self.make_profiles([{"data": OAK}, {"data": fresher}], soft_ttl=60)
+        profiles.get("quercus-robur")
+        self.age(profiles, "quercus-robur", 120)
+
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+        self.wait_for_refresh(profiles)
+
+        self.assertEqual(len(self.client.calls), 2)
+        self.assertEqual(profiles.get("quercus-robur"), fresher)
+
+    def test_refresh_deduped(self):
+        profiles = self.make_profiles([{"data": OAK}], soft_ttl=60)
+        profiles.get("quercus-robur")
+        self.age(profiles, "quercus-robur", 120)
+
+        # A refresh is already on its way
+        profiles._refreshing.add("quercus-robur")
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+        self.wait_for_refresh(profiles)
+
+        self.assertEqual(len(self.client.calls), 1)
+
+    def test_refresh_failure_keeps_stale(self):
+        profiles = self.make_profiles(
+            [{"data": OAK}, TrefleError("Trefle returned 503", status_code=503)],
+            soft_ttl=60,
+            error_ttl=60,
+        )
+        profiles.get("quercus-robur")
+        self.age(profiles, "quercus-robur", 120)
+
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+        self.wait_for_refresh(profiles)
+
+        self.assertEqual(len(self.client.calls), 2)
+
+        # Still served, without retrying straight away
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+        self.wait_for_refresh(profiles)
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_refresh_not_found(self):
+        profiles = self.make_profiles(
+            [{"data": OAK}, TrefleError("Trefle returned 404", status_code=404)],
+            soft_ttl=60,
+        )
+        profiles.get("quercus-robur")
+        self.age(profiles, "quercus-robur", 120)
+
+        profiles.get("quercus-robur")
+        self.wait_for_refresh(profiles)
+
+        with self.assertRaises(PlantNotFound):
+            profiles.get("quercus-robur")
+
+    def test_missing_cached(self):
+        profiles = self.make_profiles(
+            [TrefleError("Trefle returned 404", status_code=404)]
+        )
+
+        for _ in range(2):
+            with self.assertRaises(PlantNotFound):
+                profiles.get("no-such-plant")
+
+        self.assertEqual(len(self.client.calls), 1)
+
+    def test_error_cached(self):
+        profiles = self.make_profiles(
+            [TrefleError("Trefle request to plants failed"), {"data": OAK}],
+            error_ttl=60,
+        )
+
+        for _ in range(2):
+            with self.assertRaises(TrefleError):
+                profiles.get("quercus-robur")
+
+        self.assertEqual(len(self.client.calls), 1)
+
+    def test_circuit_open_not_cached(self):
+        profiles = self.make_profiles(
+            [TrefleCircuitOpen("Circuit for profile is open"), {"data": OAK}]
+        )
+
+        with self.assertRaises(TrefleError):
+            profiles.get("quercus-robur")
+
+        self.assertEqual(profiles.get("quercus-robur"), OAK)
+
+    def test_unexpected_response(self):
+        profiles = self.make_profiles([{"error": True}])
+
+        with self.assertRaises(TrefleError):
+            profiles.get("quercus-robur")
@@ -0,0 +1,54 @@
+"""Rate Limit Tests"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from ratelimit import MemoryBackend, SQLiteBackend, parse_rate
+
+
+class RateLimitTestCase(TestCase):
+    """Test token buckets"""
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate("10/minute"), (10, 60))
+        self.assertEqual(parse_rate("100/5 minutes"), (100, 300))
+        self.assertIsNone(parse_rate(""))
+
+        with self.assertRaises(ValueError):
+            parse_rate("10/fortnight")
+
+    def check_backend(self, backend):
+        # Bucket of 3 tokens, refilled at one token every 20 seconds
+        waits = [backend.take("login:ip:1", 3, 60, now=1000) for i in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 20)
+
+        # Other clients have their own buckets
+        self.assertEqual(backend.take("login:ip:2", 3, 60, now=1000), 0)
+
+        self.assertAlmostEqual(backend.take("login:ip:1", 3, 60, now=1010), 10)
+        self.assertEqual(backend.take("login:ip:1", 3, 60, now=1020), 0)
+        self.assertGreater(backend.take("login:ip:1", 3, 60, now=1020), 0)
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryBackend())
+
+    def test_memory_backend_max_buckets(self):
+        backend = MemoryBackend(max_buckets=2)
+        for client in range(3):
+            backend.take(f"login:ip:{client}", 1, 60, now=1000)
+
+        # The oldest bucket was dropped, so that client starts over
+        self.assertEqual(backend.take("login:ip:0", 1, 60, now=1000), 0)
+        self.assertGreater(backend.take("login:ip:2", 1, 60, now=1000), 0)
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "ratelimit.sqlite3")
+            self.check_backend(SQLiteBackend(path))
+
+            # Buckets are shared with other connections to the same file
+            self.assertGreater(
+                SQLiteBackend(path).take("login:ip:1", 3, 60, now=1020), 0
+            )
@@ -0,0 +1,100 @@
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from singleflight import SingleFlight
+
+
+class SingleFlightTestCase(TestCase):
+    """Test request coalescing"""
+
+    def run_threads(self, target, count):
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_shared_result(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"data": "oak"}
+
+        self.run_threads(lambda: results.append(flight.do("oak", fetch)), 5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"data": "oak"}] * 5)
+        self.assertEqual(flight.shared, 4)
+
+        # Once done, the next call fetches again
+        flight.do("oak", fetch)
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_error(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fetch():
+            time.sleep(0.2)
+            raise ValueError("down")
+
+        def call():
+            try:
+                flight.do("oak", fetch)
+            except ValueError as e:
+                errors.append(e)
+
+        self.run_threads(call, 3)
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(set(map(id, errors))), 1)
+
+    def test_lock_file(self):
+        # Two workers' flights, coordinating through the same directory
+        lock_dir = tempfile.mkdtemp()
+        flights = [SingleFlight(lock_dir=lock_dir), SingleFlight(lock_dir=lock_dir)]
+        spans = []
+
+        def fetch():
+            start = time.monotonic()
+            time.sleep(0.2)
+            spans.append((start, time.monotonic()))
+
+        threads = [
+            threading.Thread(target=flight.do, args=("oak", fetch))
+            for flight in flights
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        (first_start, first_end), (second_start, second_end) = sorted(spans)
+        self.assertGreaterEqual(second_start, first_end)
+
+    def test_lock_timeout(self):
+        lock_dir = tempfile.mkdtemp()
+        holder = SingleFlight(lock_dir=lock_dir)
+        waiter = SingleFlight(lock_dir=lock_dir, lock_timeout=0.1)
+        started = threading.Event()
+
+        def hold():
+            started.set()
+            time.sleep(0.5)
+
+        thread = threading.Thread(target=holder.do, args=("oak", hold))
+        thread.start()
+        started.wait()
+
+        start = time.monotonic()
+        self.assertEqual(waiter.do("oak", lambda: "fetched"), "fetched")
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(waiter.unlocked, 1)
+        thread.join()
+        self.assertEqual(holder.unlocked, 0)
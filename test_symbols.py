@@ -0,0 +1,82 @@
+"""Symbol Cache Tests"""
+
+import os
+from unittest import TestCase
+
+from models import db, symbol_hash, Symbol
+
+os.environ["DATABASE_URL"] = "postgresql:///plot_planner_test"
+
+from app import app
+from symbols import SymbolCache, symbol_cache
+
+LEAF = "<i class='symbol fas fa-leaf'></i>"
+TREE = "<i class='symbol fas fa-tree'></i>"
+
+
+class SymbolCacheTestCase(TestCase):
+    """Test interning symbols"""
+
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        symbol_cache.clear()
+        self.cache = SymbolCache()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_intern(self):
+        leaf_id = self.cache.intern(LEAF)
+        db.session.commit()
+
+        self.assertEqual(self.cache.intern(LEAF), leaf_id)
+        self.assertNotEqual(self.cache.intern(TREE), leaf_id)
+        db.session.commit()
+
+        self.assertEqual(Symbol.query.count(), 2)
+        self.assertEqual(Symbol.query.get(leaf_id).hash, symbol_hash(LEAF))
+
+    def test_intern_existing(self):
+        symbol = Symbol.add(symbol=LEAF)
+        db.session.commit()
+
+        self.assertEqual(self.cache.intern(LEAF), symbol.id)
+        self.assertEqual(Symbol.query.count(), 1)
+
+    def test_create_race(self):
+        # Another request created the symbol after our lookup
+        symbol = Symbol.add(symbol=LEAF)
+        db.session.commit()
+
+        self.assertEqual(self.cache._create(LEAF), symbol.id)
+        db.session.commit()
+        self.assertEqual(Symbol.query.count(), 1)
+
+    def test_new_symbols_cached_on_commit(self):
+        symbol_cache.intern(LEAF)
+        self.assertEqual(symbol_cache._symbols, {})
+
+        # A rolled back symbol is never cached
+        db.session.rollback()
+        self.assertEqual(symbol_cache._symbols, {})
+
+        leaf_id = symbol_cache.intern(LEAF)
+        db.session.commit()
+
+        self.assertEqual(symbol_cache._symbols, {leaf_id: LEAF})
+        self.assertEqual(symbol_cache.intern(LEAF), leaf_id)
+
+    def test_symbols(self):
+        leaf = Symbol.add(symbol=LEAF)
+        tree = Symbol.add(symbol=TREE)
+        db.session.commit()
+
+        self.assertEqual(
+            self.cache.symbols([leaf.id, tree.id, 999]), {leaf.id: LEAF, tree.id: TREE}
+        )
+        # Now both are cached
+        db.session.query(Symbol).delete()
+        db.session.commit()
+        self.assertEqual(self.cache.symbols([leaf.id]), {leaf.id: LEAF})
@@ -0,0 +1,192 @@
+import os
+import tempfile
+import threading
+import time
+import traceback
+from unittest import TestCase
+
+import requests
+
+from cache import DiskBackend, MemoryBackend, ResponseCache
+from circuitbreaker import OPEN, CircuitBreaker
+from singleflight import SingleFlight
+from trefle import TrefleCircuitOpen, TrefleClient, TrefleError
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """Stands in for requests.Session, answering from a list of canned results"""
+
+    def __init__(self, results, delay=0):
+        self.results = list(results)
+        self.calls = []
+        self.delay = delay
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append((url, params, timeout))
+        time.sleep(self.delay)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class TrefleClientTestCase(TestCase):
+    """Test Trefle API client"""
+
+    def make_client(self, results, **kwargs):
+        client = TrefleClient("tok", backoff_factor=0, **kwargs)
+        client._session = FakeSession(results)
+        client._session_pid = os.getpid()
+        return client
+
+    def test_get(self):
+        client = self.make_client([FakeResponse(200, {"data": [], "links": {}})])
+
+        data = client.get("plants/search", {"q": "oak", "filter[flower_color]": "red"})
+        url, params, timeout = client.session.calls[0]
+
+        self.assertEqual(data, {"data": [], "links": {}})
+        self.assertEqual(url, "https://trefle.io/api/v1/plants/search")
+        self.assertEqual(params, "q=oak&filter[flower_color]=red&token=tok")
+        self.assertEqual(timeout, client.timeout)
+
+    def test_get_retries(self):
+        client = self.make_client(
+            [
+                requests.ConnectionError("reset"),
+                FakeResponse(503),
+                FakeResponse(200, {"data": [1]}),
+            ],
+            max_retries=2,
+        )
+
+        self.assertEqual(client.get("plants"), {"data": [1]})
+        self.assertEqual(len(client.session.calls), 3)
+
+    def test_get_gives_up(self):
+        client = self.make_client(
+            [requests.Timeout("slow"), requests.Timeout("slow")], max_retries=1
+        )
+
+        with self.assertRaises(TrefleError):
+            client.get("plants")
+
+    def test_error_hides_token(self):
+        client = TrefleClient(
+            "SECRETTOKEN",
+            base_url="http://127.0.0.1:1/api",
+            max_retries=1,
+            backoff_factor=0,
+        )
+
+        with self.assertLogs(level="WARNING") as logs:
+            with self.assertRaises(TrefleError) as cm:
+                client.get("plants", {"q": "x"})
+
+        error = cm.exception
+        self.assertIn("ConnectionError", str(error))
+        # Including a chained exception's message in the traceback
+        trace = traceback.format_exception(type(error), error, error.__traceback__)
+        self.assertNotIn("SECRETTOKEN", "".join(trace))
+        self.assertNotIn("SECRETTOKEN", "\n".join(logs.output))
+
+    def test_get_not_found(self):
+        client = self.make_client([FakeResponse(404, {"error": True})])
+
+        with self.assertRaises(TrefleError) as cm:
+            client.get("plants/not-a-plant")
+
+        self.assertEqual(cm.exception.status_code, 404)
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_get_circuit_breaker(self):
+        breaker = CircuitBreaker(min_calls=2, open_for=60)
+        client = self.make_client(
+            [FakeResponse(404), FakeResponse(503), FakeResponse(503)],
+            max_retries=0,
+            breaker=breaker,
+        )
+
+        # Trefle answering "not found" is healthy
+        with self.assertRaises(TrefleError):
+            client.get("plants/not-a-plant")
+        with self.assertRaises(TrefleError):
+            client.get("plants/search", {"q": "oak"})
+        with self.assertRaises(TrefleError):
+            client.get("plants/search", {"q": "elm"})
+
+        self.assertEqual(breaker.state("search"), OPEN)
+        with self.assertRaises(TrefleCircuitOpen):
+            client.get("plants/search", {"q": "ash"})
+        self.assertEqual(len(client.session.calls), 3)
+
+    def test_concurrency_bounded(self):
+        client = self.make_client(
+            [FakeResponse(200, {"data": [1]})] * 2, pool_size=1, queue_timeout=0.1
+        )
+        client.session.delay = 0.5
+        thread = threading.Thread(target=client.fetch, args=("plants",))
+        thread.start()
+        time.sleep(0.1)
+
+        # The only slot is taken
+        with self.assertRaises(TrefleError) as cm:
+            client.fetch("plants/search", {"q": "oak"})
+        self.assertTrue(cm.exception.unavailable)
+
+        thread.join()
+        self.assertEqual(client.fetch("plants"), {"data": [1]})
+
+    def test_get_cached(self):
+        cache = ResponseCache(MemoryBackend())
+        client = self.make_client([FakeResponse(200, {"data": [1]})], cache=cache)
+
+        client.get("plants", "page=2")
+        client.get("plants", "page=2")
+
+        self.assertEqual(len(client.session.calls), 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_fetch_uncached(self):
+        cache = ResponseCache(MemoryBackend())
+        client = self.make_client([FakeResponse(200, {"data": [1]})] * 2, cache=cache)
+
+        client.fetch("plants/oak")
+        client.fetch("plants/oak")
+
+        self.assertEqual(len(client.session.calls), 2)
+        self.assertEqual(cache.get("plants/oak"), None)
+
+    def test_get_coalesced(self):
+        # Two workers sharing a disk cache, each with two request threads
+        directory = tempfile.mkdtemp()
+        cache = ResponseCache(DiskBackend(os.path.join(directory, "cache.sqlite3")))
+        sessions = []
+        threads = []
+        for worker in range(2):
+            client = self.make_client(
+                [FakeResponse(200, {"data": [1]})] * 4,
+                cache=cache,
+                single_flight=SingleFlight(lock_dir=directory),
+            )
+            client._session.delay = 0.2
+            sessions.append(client._session)
+            threads += [
+                threading.Thread(target=client.get, args=("plants", "page=2"))
+                for i in range(2)
+            ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(len(session.calls) for session in sessions), 1)
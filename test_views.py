@@ -1,5 +1,7 @@
-import os, logging
+import os, logging, base64
+from contextlib import contextmanager
 from unittest import TestCase
+from sqlalchemy import event
 
 from models import (
     db,
@@ -13,6 +15,12 @@ from models import (
     PlantLists_Plants,
     Plot_Cells_Symbols,
     Users_Projects,
+    Users_Plots,
+    Users_PlantLists,
+    Projects_Plots,
+    Projects_PlantLists,
+    Plots_PlantLists,
+    default_plant_symbol,
 )
 
 from forms import (
@@ -31,8 +39,13 @@ from forms import (
 os.environ["DATABASE_URL"] = "postgresql:///plot_planner_test"
 
 
-from app import app, CURR_USER_KEY
-from flask import jsonify
+from app import app, CURR_USER_KEY, limiter, plant_profiles, trefle
+from choices import user_choices
+from circuitbreaker import CircuitBreaker
+from identity import identity_cache
+from plot_layout import PlotLayout
+from symbols import symbol_cache
+from flask import g, jsonify
 from secret import TREFLE_API_KEY, FLASK_SECRET
 
 logging.debug("Imports finished")
@@ -44,6 +57,22 @@ logging.debug("db created all")
 app.config["WTF_CSRF_ENABLED"] = False
 
 
+@contextmanager
+def count_queries():
+    """Collects the SQL statements executed inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
 class ViewsTestCase(TestCase):
     """Test views for users"""
 
@@ -52,6 +81,8 @@ class ViewsTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        identity_cache.clear()
+        symbol_cache.clear()
 
         self.client = app.test_client()
 
@@ -200,6 +231,22 @@ class ViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("My Content", str(resp.data))
 
+    def test_login_rate_limited(self):
+        limiter.backend.clear()
+        with self.client as c:
+            for i in range(10):
+                resp = c.post("/login", data=dict(username="testuser", password="x"))
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/login", data=dict(username="testuser", password="x"))
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreater(int(resp.headers["Retry-After"]), 0)
+
+            # The form itself is not limited
+            self.assertEqual(c.get("/login").status_code, 200)
+        limiter.backend.clear()
+
     def test_login_post_wrong_pw(self):
         username = self.testuser.username
         password = "wrongpw"
@@ -235,6 +282,56 @@ class ViewsTestCase(TestCase):
     # User Routes
     #####################################################################
 
+    def test_identity_cache(self):
+        with count_queries() as queries:
+            self.client.get("/about")
+        self.assertEqual(len(queries), 0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/about")
+            with count_queries() as queries:
+                resp = c.get("/about")
+
+            self.assertEqual(len(queries), 0)
+            self.assertIn("testuser's Garden Shed", resp.get_data(as_text=True))
+
+            # Edits are seen on the next request
+            c.post(
+                f"/users/{self.testuser_id}/edit",
+                data=dict(username="new_name", password="testpw"),
+            )
+            resp = c.get("/about")
+            self.assertIn("new_name's Garden Shed", resp.get_data(as_text=True))
+
+    def test_form_choices_queries(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/about")
+            with count_queries() as few_queries:
+                c.get("/plots")
+
+            for i in range(5):
+                plot = Plot.add(name=f"plot{i}", width=2, length=2)
+                project = Project.add(name=f"project{i}")
+                db.session.flush()
+                db.session.add(
+                    Users_Projects(user_id=self.testuser_id, project_id=project.id)
+                )
+                db.session.add(Users_Plots(user_id=self.testuser_id, plot_id=plot.id))
+            db.session.commit()
+
+            with count_queries() as more_queries:
+                resp = c.get("/plots")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("project4", resp.get_data(as_text=True))
+            self.assertEqual(len(more_queries), len(few_queries))
+
     def test_user_profile(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -337,6 +434,49 @@ class ViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("My Content", str(resp.data))
 
+    def test_user_content_queries(self):
+        def add_content(n):
+            for i in range(n):
+                project = Project.add(name=f"project{n}-{i}")
+                plot = Plot.add(name=f"plot{n}-{i}", width=2, length=2)
+                plantlist = PlantList.add(name=f"plantlist{n}-{i}")
+                db.session.flush()
+                db.session.add_all(
+                    [
+                        Users_Projects(user_id=self.testuser_id, project_id=project.id),
+                        Users_Plots(user_id=self.testuser_id, plot_id=plot.id),
+                        Users_PlantLists(
+                            user_id=self.testuser_id, plantlist_id=plantlist.id
+                        ),
+                        Projects_Plots(project_id=project.id, plot_id=plot.id),
+                        Projects_PlantLists(
+                            project_id=project.id, plantlist_id=plantlist.id
+                        ),
+                        Plots_PlantLists(plot_id=plot.id, plantlist_id=plantlist.id),
+                    ]
+                )
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            add_content(1)
+            c.get("/about")
+            with count_queries() as few_queries:
+                c.get(f"/users/{self.testuser_id}/content")
+
+            add_content(10)
+            with count_queries() as more_queries:
+                resp = c.get(f"/users/{self.testuser_id}/content")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("plot10-9", html)
+            self.assertIn("<li data-secondary-id=", html)
+            self.assertEqual(len(more_queries), len(few_queries))
+            self.assertLessEqual(len(more_queries), 6)
+
     def test_user_delete(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -421,6 +561,43 @@ class ViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Edit Project Name", str(resp.data))
 
+    def test_edit_project_post_links_in_bulk(self):
+        plots = [Plot.add(name=f"Plot{i}", width=1, length=1) for i in range(30)]
+        db.session.flush()
+        db.session.add_all(
+            Users_Plots(user_id=self.testuser_id, plot_id=plot.id) for plot in plots
+        )
+        db.session.commit()
+        plot_ids = [plot.id for plot in plots]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for i in range(2):
+                with count_queries() as queries:
+                    resp = c.post(
+                        f"/projects/{self.testproject_id}/edit",
+                        data=dict(name="Edit Project Name", plots=plot_ids),
+                    )
+                self.assertEqual(resp.status_code, 302)
+
+                inserts = [
+                    statement
+                    for statement in queries
+                    if statement.startswith("INSERT INTO projects_plots")
+                ]
+                # One insert the first time, none once everything is linked
+                self.assertEqual(len(inserts), 1 - i)
+
+            linked = Projects_Plots.query.filter_by(
+                project_id=self.testproject_id
+            ).all()
+            self.assertEqual(
+                sorted(link.plot_id for link in linked),
+                sorted(plot_ids + [self.testplot_id]),
+            )
+
     def test_delete_project(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -558,6 +735,38 @@ class ViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(self.testplot_name, str(resp.data))
 
+    def test_show_plot_symbols(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
+            db.session.commit()
+
+            Plot_Cells_Symbols.upsert(self.testplot_id, [(1, 2, plantlists_plants.id)])
+            db.session.commit()
+
+            resp = c.get(f"/plots/{self.testplot_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            # Painted in both the plot viewer and the plot editor
+            self.assertEqual(
+                html.count(f'data-row="2" data-col="1">{default_plant_symbol}</div>'),
+                2,
+            )
+            self.assertEqual(html.count('data-row="9" data-col="4"></div>'), 2)
+
+            # The palette's symbols now come from the symbol cache
+            with count_queries() as queries:
+                c.get(f"/plots/{self.testplot_id}")
+            self.assertFalse(
+                [statement for statement in queries if "FROM symbols" in statement]
+            )
+
     def test_edit_plot_get(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -640,12 +849,10 @@ class ViewsTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser_id
 
-            plantlists_plants = PlantLists_Plants(
-                plantlist_id=self.testplantlist_id,
-                plant_id=self.testplant_id,
-                symbol_id=self.testsymbol_id,
-            )
-            db.session.add(plantlists_plants)
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
             db.session.commit()
 
             cell_x = 1
@@ -676,13 +883,10 @@ class ViewsTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser_id
 
-            plantlists_plants = PlantLists_Plants(
-                plantlist_id=self.testplantlist_id,
-                plant_id=self.testplant_id,
-                symbol_id=self.testsymbol_id,
-            )
-
-            db.session.add(plantlists_plants)
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
             db.session.commit()
 
             cell_x = 1
@@ -713,6 +917,62 @@ class ViewsTestCase(TestCase):
                 str(resp.data),
             )
 
+    def test_plot_cells_update(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
+            db.session.commit()
+            plp_id = plantlists_plants.id
+
+            Plot_Cells_Symbols.add(
+                plot_id=self.testplot_id,
+                plantlists_plants_id=plp_id,
+                cell_x=4,
+                cell_y=9,
+            )
+            db.session.commit()
+
+            cells = [
+                {"x": x, "y": y, "plantlists_plants_id": plp_id}
+                for x in range(3)
+                for y in range(10)
+            ]
+            cells.append({"x": 4, "y": 9, "plantlists_plants_id": None})
+
+            with count_queries() as queries:
+                resp = c.post(f"/plots/{self.testplot_id}/cells", json={"cells": cells})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"added": 30, "removed": 1})
+            self.assertEqual(
+                Plot_Cells_Symbols.query.filter_by(plot_id=self.testplot_id).count(),
+                30,
+            )
+            # One delete and one bulk insert, whatever the number of cells
+            writes = [q for q in queries if q.startswith(("INSERT", "DELETE"))]
+            self.assertEqual(len(writes), 2)
+
+            # Painting over cells replaces their symbols
+            resp = c.post(
+                f"/plots/{self.testplot_id}/cells",
+                json={"cells": [{"x": 0, "y": 0, "plantlists_plants_id": plp_id}]},
+            )
+            self.assertEqual(
+                Plot_Cells_Symbols.query.filter_by(plot_id=self.testplot_id).count(),
+                30,
+            )
+
+            resp = c.post(
+                f"/plots/{self.testplot_id}/cells",
+                json={"cells": [{"x": 5, "y": 0, "plantlists_plants_id": plp_id}]},
+            )
+            self.assertEqual(resp.status_code, 400)
+
     ###################################################################
     # Plantlist Routes
     ####################################################################
@@ -868,6 +1128,30 @@ class ViewsTestCase(TestCase):
 
             self.assertEqual(symbol.id, plantlists_plants.symbol_id)
 
+    def test_add_symbol_new(self):
+        symbol = "<i class='symbol fas fa-leaf' style='color:#8B4513;'></i>"
+        url = (
+            f"/plantlists/{self.testplantlist_id}/plant/{self.testplant_id}/symbol/add"
+        )
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(url, json={"symbol": symbol})
+            self.assertEqual(resp.json, symbol)
+
+            with count_queries() as queries:
+                resp = c.post(url, json={"symbol": symbol})
+
+            self.assertEqual(Symbol.query.filter_by(symbol=symbol).count(), 1)
+            self.assertFalse(
+                [statement for statement in queries if "FROM symbols" in statement]
+            )
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
+            self.assertEqual(plantlists_plants.symbol.symbol, symbol)
+
     ###################################################################
     # Plant Routes
     ####################################################################
@@ -880,6 +1164,46 @@ class ViewsTestCase(TestCase):
             self.assertIn("Search Plants", str(resp.data))
             self.assertIn("Evergreen Oak", str(resp.data))
 
+    def test_plant_profile_not_found(self):
+        plant_profiles._store("no-such-plant", {"missing": True}, 60)
+
+        with self.client as c:
+            resp = c.get("/plants/no-such-plant")
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_plant_profile_unavailable(self):
+        plant_profiles._store("plantus-slugs9", {"error": "Trefle is down"}, 60)
+
+        with self.client as c:
+            resp = c.get("/plants/plantus-slugs9")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(resp.location.endswith("/plants"))
+
+    def test_plant_profile_local_fallback(self):
+        plant_profiles._store("plantus-slugs1", {"error": "Trefle is down"}, 60)
+
+        with self.client as c:
+            resp = c.get("/plants/plantus-slugs1")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Full plant details are unavailable", str(resp.data))
+            self.assertIn(self.testplant_common_name, str(resp.data))
+
+    def test_plants_search_table_circuit_open(self):
+        breaker = trefle.breaker
+        trefle.breaker = CircuitBreaker(min_calls=1, open_for=60)
+        trefle.breaker.record("plants", False)
+        try:
+            with self.client as c:
+                resp = c.get("/plants")
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(self.testplant_common_name, str(resp.data))
+        finally:
+            trefle.breaker = breaker
+
     ###################################################################
     # Query Routes
     ##################################################################
@@ -903,3 +1227,133 @@ class ViewsTestCase(TestCase):
             self.assertNotIn([plot.id, plot.name], resp.json["options"])
             self.assertIn([plot2.id, plot2.name], resp.json["options"])
             self.assertNotIn([plot2.id, plot2.name], resp.json["list_items"])
+
+    def test_unlinked_choices(self):
+        def add_plots(n):
+            for i in range(n):
+                plot = Plot.add(name=f"plot{n}-{i}", width=1, length=1)
+                db.session.flush()
+                db.session.add(Users_Plots(user_id=self.testuser_id, plot_id=plot.id))
+                if i % 2:
+                    db.session.add(
+                        Projects_Plots(project_id=self.testproject_id, plot_id=plot.id)
+                    )
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            add_plots(2)
+            c.get("/about")
+            with count_queries() as few_queries:
+                c.get(f"/query/project/{self.testproject_id}/plots")
+
+            add_plots(20)
+            with count_queries() as more_queries:
+                resp = c.get(f"/query/project/{self.testproject_id}/plots")
+
+            options = [name for id, name in resp.json["options"]]
+            linked = [name for id, name in resp.json["list_items"]]
+
+            self.assertIn("plot20-0", options)
+            self.assertNotIn("plot20-1", options)
+            self.assertIn("plot20-1", linked)
+            self.assertEqual(len(options) + len(linked), 23)
+            self.assertEqual(len(more_queries), len(few_queries))
+
+    def test_user_choices(self):
+        with app.test_request_context():
+            g.user = User.query.get(self.testuser_id)
+
+            with count_queries() as queries:
+                plots = user_choices("plots")
+                user_choices("plots")
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(plots, [(self.testplot_id, self.testplot_name)])
+
+            # Writes drop the memoized choices
+            plot = Plot.add(name="Plot2", width=1, length=1)
+            db.session.flush()
+            db.session.add(Users_Plots(user_id=self.testuser_id, plot_id=plot.id))
+            db.session.commit()
+
+            self.assertIn((plot.id, "Plot2"), user_choices("plots"))
+
+    def test_query_plot_layout(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
+            db.session.commit()
+            plp_id = plantlists_plants.id
+
+            Plot_Cells_Symbols.upsert(
+                self.testplot_id, [(x, y, plp_id) for x in range(5) for y in range(4)]
+            )
+            db.session.commit()
+
+            # Loads the palette's symbols into the symbol cache
+            c.get(f"/query/plot_layout/{self.testplot_id}")
+            with count_queries() as queries:
+                resp = c.get(f"/query/plot_layout/{self.testplot_id}")
+
+            layout = PlotLayout.decode(
+                resp.json["width"],
+                resp.json["length"],
+                [entry["plantlists_plants_id"] for entry in resp.json["palette"]],
+                base64.b64decode(resp.json["cells"]),
+            )
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["palette"][0]["symbol"], default_plant_symbol)
+            # The first four rows are one run, the rest of the plot another
+            self.assertEqual(len(base64.b64decode(resp.json["cells"])), 8)
+            self.assertEqual(len(list(layout.cells())), 20)
+            self.assertLessEqual(len(queries), 4)
+
+    def test_query_plot_cells(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Linked in setUp, and each pair is only linked once
+            plantlists_plants = PlantLists_Plants.query.filter_by(
+                plantlist_id=self.testplantlist_id, plant_id=self.testplant_id
+            ).one()
+            db.session.commit()
+            plp_id = plantlists_plants.id
+
+            def add_cells(width, length):
+                for cell_x in range(width):
+                    for cell_y in range(length):
+                        Plot_Cells_Symbols.add(
+                            plot_id=self.testplot_id,
+                            plantlists_plants_id=plp_id,
+                            cell_x=cell_x,
+                            cell_y=cell_y,
+                        )
+                db.session.commit()
+
+            add_cells(1, 2)
+            # Load the user into the identity cache first
+            c.get(f"/query/plot_cells/{self.testplot_id}")
+            with count_queries() as small_plot_queries:
+                resp = c.get(f"/query/plot_cells/{self.testplot_id}")
+            self.assertEqual(len(resp.json), 2)
+
+            add_cells(5, 10)
+            with count_queries() as large_plot_queries:
+                resp = c.get(f"/query/plot_cells/{self.testplot_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            # Cells already set are updated, not duplicated
+            self.assertEqual(len(resp.json), 50)
+            self.assertEqual(resp.json[0]["symbol"], default_plant_symbol)
+            # Query count doesn't grow with the number of cells
+            self.assertEqual(len(large_plot_queries), len(small_plot_queries))
+            self.assertLessEqual(len(large_plot_queries), 1)
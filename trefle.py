@@ -0,0 +1,262 @@
+"""Client for the Trefle plant API.
+
+Each worker process gets its own pooled, keep-alive requests.Session, every
+request has connect/read timeouts, and transient failures are retried a
+bounded number of times with jittered exponential backoff. Concurrent requests
+for the same data share a single fetch (see singleflight.py), and a circuit
+breaker per kind of endpoint fails requests fast while Trefle is down (see
+circuitbreaker.py).
+
+Under gunicorn's gevent workers (see gunicorn.conf.py) a request waiting on
+Trefle only holds its greenlet, so a worker can have hundreds waiting at once.
+At most `pool_size` of them are in flight per worker, one per pooled
+connection; the rest wait up to `queue_timeout` seconds for a turn, then fail
+as unavailable."""
+
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import endpoint_kind, make_key
+from circuitbreaker import CircuitBreaker, CircuitOpen
+from singleflight import SingleFlight
+
+API_BASE_URL = "https://trefle.io/api/v1"
+
+# Statuses worth retrying: rate limited or an upstream hiccup
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TrefleError(Exception):
+    """Raised when Trefle can't be reached or answers with an error."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def unavailable(self):
+        """Whether the error means Trefle itself is down or overloaded, rather
+        than this request being wrong."""
+
+        return self.status_code is None or self.status_code in RETRY_STATUSES
+
+
+class TrefleCircuitOpen(TrefleError):
+    """Raised without calling Trefle while its circuit breaker is open."""
+
+
+class TrefleClient:
+    """Fetches JSON from Trefle through a response cache and a pooled session."""
+
+    def __init__(
+        self,
+        token,
+        base_url=API_BASE_URL,
+        cache=None,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        max_retries=2,
+        backoff_factor=0.3,
+        backoff_max=5,
+        queue_timeout=5,
+        single_flight=None,
+        breaker=None,
+    ):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        # Coalesces concurrent fetches of the same endpoint and params, see
+        # singleflight.py
+        self.single_flight = single_flight
+        # Fails requests fast while an endpoint keeps failing, see
+        # circuitbreaker.py
+        self.breaker = breaker
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, token, cache=None):
+        """Builds a client from Flask app config."""
+
+        # Coalescing across workers needs the response cache they share
+        shared_cache = config.get("TREFLE_CACHE_BACKEND") == "disk"
+
+        return cls(
+            token,
+            base_url=config.get("TREFLE_API_BASE_URL", API_BASE_URL),
+            cache=cache,
+            single_flight=SingleFlight(
+                lock_dir=config.get("TREFLE_LOCK_DIR") if shared_cache else None
+            ),
+            breaker=CircuitBreaker.from_config(config),
+            pool_size=int(config.get("TREFLE_POOL_SIZE", 10)),
+            connect_timeout=float(config.get("TREFLE_CONNECT_TIMEOUT", 3.05)),
+            read_timeout=float(config.get("TREFLE_READ_TIMEOUT", 10)),
+            max_retries=int(config.get("TREFLE_MAX_RETRIES", 2)),
+            queue_timeout=float(config.get("TREFLE_QUEUE_TIMEOUT", 5)),
+        )
+
+    @property
+    def session(self):
+        """Session for the current process.
+
+        gunicorn forks workers after the app is imported, so a session created
+        in the master must not be shared; a new one is made per pid."""
+
+        if self._session is None or self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    self._session = self._new_session()
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def query_string(self, params):
+        """Builds the query string sent to Trefle, including the token.
+
+        The string is built "manually", as requests' own encoding replaces the
+        brackets in filter[...] params and the API then rejects them."""
+
+        if isinstance(params, str):
+            query = params.lstrip("?&")
+        else:
+            query = "&".join("%s=%s" % (k, v) for k, v in (params or {}).items())
+        return f"{query}&token={self.token}" if query else f"token={self.token}"
+
+    def get(self, endpoint, params=None):
+        """Returns parsed JSON for a Trefle endpoint (e.g. 'plants/search').
+
+        `params` may be a dict or an already encoded query string, such as
+        the one in a Trefle pagination link. Raises TrefleError on failure."""
+
+        endpoint = endpoint.strip("/")
+
+        if self.cache is not None:
+            data = self.cache.get(endpoint, params)
+            if data is not None:
+                return data
+
+        if self.single_flight is None:
+            return self._fetch_and_cache(endpoint, params)
+        return self.single_flight.do(
+            make_key(endpoint, params),
+            lambda: self._fetch_and_cache(endpoint, params, recheck=True),
+        )
+
+    def _fetch_and_cache(self, endpoint, params, recheck=False):
+        # After waiting on another worker's fetch of the same thing, its
+        # response is usually in the cache by now
+        if recheck and self.cache is not None:
+            data = self.cache.get(endpoint, params)
+            if data is not None:
+                return data
+
+        data = self.fetch(endpoint, params)
+
+        if self.cache is not None:
+            self.cache.set(endpoint, params, data)
+
+        return data
+
+    def fetch(self, endpoint, params=None):
+        """Requests an endpoint from Trefle, skipping the response cache and
+        coalescing, for callers that do their own (see profiles.py). Raises
+        TrefleError on failure."""
+
+        endpoint = endpoint.strip("/")
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise TrefleError(f"Too many Trefle requests in progress for {endpoint}")
+        try:
+            return self._call(endpoint, params)
+        finally:
+            self._slots.release()
+
+    def _call(self, endpoint, params):
+        if self.breaker is None:
+            return self._request(endpoint, params)
+
+        key = endpoint_kind(endpoint)
+        try:
+            self.breaker.before_call(key)
+        except CircuitOpen as e:
+            raise TrefleCircuitOpen(f"Not calling Trefle for {endpoint}: {e}")
+
+        ok = False
+        try:
+            data = self._request(endpoint, params)
+            ok = True
+            return data
+        except TrefleError as e:
+            ok = not e.unavailable
+            raise
+        finally:
+            self.breaker.record(key, ok)
+
+    def _request(self, endpoint, params):
+        url = f"{self.base_url}/{endpoint}"
+        query = self.query_string(params)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                resp = self.session.get(url, params=query, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Not the exception itself: its message has the URL, token and all
+                error = type(e).__name__
+                if last_attempt:
+                    raise TrefleError(
+                        f"Trefle request to {endpoint} failed: {error}"
+                    ) from None
+                logging.warning(
+                    f"Trefle request to {endpoint} failed, retrying: {error}"
+                )
+            else:
+                if resp.status_code == 200:
+                    try:
+                        return resp.json()
+                    except ValueError:
+                        raise TrefleError(
+                            f"Trefle returned invalid JSON for {endpoint}",
+                            status_code=resp.status_code,
+                        )
+                if resp.status_code not in RETRY_STATUSES or last_attempt:
+                    raise TrefleError(
+                        f"Trefle returned {resp.status_code} for {endpoint}",
+                        status_code=resp.status_code,
+                    )
+                logging.warning(
+                    f"Trefle returned {resp.status_code} for {endpoint}, retrying"
+                )
+
+            time.sleep(self.backoff(attempt))
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number `attempt` (full jitter)."""
+
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_factor * 2 ** attempt)
+        )